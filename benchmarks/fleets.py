@@ -0,0 +1,116 @@
+import boto3
+
+# Builders for synthetic fleets. Each one spreads `size` resources evenly over
+# `regions` inside an active moto mock and returns the environment variables
+# the matching handler needs on top of the common ones.
+
+AMI_ID = 'ami-12c6146b'
+
+
+def _per_region(size, regions):
+    base, extra = divmod(size, len(regions))
+    return [(region, base + (1 if index < extra else 0)) for index, region in enumerate(regions)]
+
+
+def _create_table(region, table_name, key_name):
+    boto3.client('dynamodb', region_name=region).create_table(
+        TableName=table_name,
+        KeySchema=[{'AttributeName': key_name, 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': key_name, 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+
+
+def _run_instances(ec2_client, count):
+    instance_ids = []
+    while count > 0:
+        batch = min(count, 1000)
+        response = ec2_client.run_instances(ImageId=AMI_ID, MinCount=batch, MaxCount=batch, InstanceType='t3.micro')
+        instance_ids.extend(instance['InstanceId'] for instance in response['Instances'])
+        count -= batch
+    return instance_ids
+
+
+def _subnets(ec2_client, region):
+    vpc_id = ec2_client.create_vpc(CidrBlock='10.0.0.0/16')['Vpc']['VpcId']
+    return [
+        ec2_client.create_subnet(VpcId=vpc_id, CidrBlock=f'10.0.{index}.0/24', AvailabilityZone=f'{region}{zone}')['Subnet']['SubnetId']
+        for index, zone in enumerate('ab')
+    ], vpc_id
+
+
+def build_ec2(size, regions):
+    for region, count in _per_region(size, regions):
+        _run_instances(boto3.client('ec2', region_name=region), count)
+        _create_table(region, 'ec2-idle-usage-table', 'InstanceId')
+    # moto launches every instance "now"; evaluate them anyway
+    return {'DYNAMODB_TABLE_NAME': 'ec2-idle-usage-table', 'MIN_INSTANCE_AGE_DAYS': '0'}
+
+
+def build_rds(size, regions):
+    classes = ['db.t3.micro', 'db.t2.micro', 'db.t3.small', 'db.t3.medium']
+    for region, count in _per_region(size, regions):
+        rds_client = boto3.client('rds', region_name=region)
+        for index in range(count):
+            rds_client.create_db_instance(
+                DBInstanceIdentifier=f'bench-db-{index}',
+                DBInstanceClass=classes[index % len(classes)],
+                Engine='postgres',
+                MasterUsername='bench',
+                MasterUserPassword='benchmark-password',
+                AllocatedStorage=20
+            )
+    return {}
+
+
+def build_ecs(size, regions, services_per_cluster=50):
+    for region, count in _per_region(size, regions):
+        ecs_client = boto3.client('ecs', region_name=region)
+        ecs_client.register_task_definition(family='bench', containerDefinitions=[{'name': 'app', 'image': 'app', 'memory': 128}])
+        for index in range(count):
+            cluster = f'bench-cluster-{index // services_per_cluster}'
+            if index % services_per_cluster == 0:
+                ecs_client.create_cluster(clusterName=cluster)
+            ecs_client.create_service(cluster=cluster, serviceName=f'bench-service-{index}', taskDefinition='bench', desiredCount=index % 3)
+    return {}
+
+
+def build_alb(size, regions):
+    for region, count in _per_region(size, regions):
+        ec2_client = boto3.client('ec2', region_name=region)
+        elbv2_client = boto3.client('elbv2', region_name=region)
+        subnets, vpc_id = _subnets(ec2_client, region)
+        for index in range(count):
+            load_balancer = elbv2_client.create_load_balancer(Name=f'bench-alb-{index}', Subnets=subnets, Scheme='internet-facing')['LoadBalancers'][0]
+            target_group = elbv2_client.create_target_group(Name=f'bench-tg-{index}', Protocol='HTTP', Port=80, VpcId=vpc_id)['TargetGroups'][0]
+            elbv2_client.create_listener(
+                LoadBalancerArn=load_balancer['LoadBalancerArn'],
+                Protocol='HTTP',
+                Port=80,
+                DefaultActions=[{'Type': 'forward', 'TargetGroupArn': target_group['TargetGroupArn']}]
+            )
+    return {}
+
+
+def build_eip(size, regions):
+    for region, count in _per_region(size, regions):
+        ec2_client = boto3.client('ec2', region_name=region)
+        # Half of the addresses are associated, half of those with stopped instances
+        instance_ids = _run_instances(ec2_client, count // 2)
+        if instance_ids:
+            ec2_client.stop_instances(InstanceIds=instance_ids[::2])
+        for index in range(count):
+            allocation_id = ec2_client.allocate_address(Domain='vpc')['AllocationId']
+            if index < len(instance_ids):
+                ec2_client.associate_address(AllocationId=allocation_id, InstanceId=instance_ids[index])
+    return {}
+
+
+def build_logs(size, regions):
+    for region, count in _per_region(size, regions):
+        logs_client = boto3.client('logs', region_name=region)
+        for index in range(count):
+            logs_client.create_log_group(logGroupName=f'/bench/group-{index}')
+            if index % 4 == 0:
+                logs_client.put_retention_policy(logGroupName=f'/bench/group-{index}', retentionInDays=30)
+    return {}
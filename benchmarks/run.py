@@ -0,0 +1,147 @@
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from functools import partial
+
+# Offline scale benchmarks: runs each lambda_handler against moto with synthetic
+# fleets and reports wall time, AWS API calls per service/operation and peak
+# Python memory. Usage:
+#   python benchmarks/run.py --sizes 100 1000 --output bench.json
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'layers', 'CostOptimisationCommon', 'python'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# moto needs credentials and a default region before boto3 is imported
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_REGION', os.environ['AWS_DEFAULT_REGION'])
+
+import boto3  # noqa: E402
+from moto import mock_aws  # noqa: E402
+
+import fleets  # noqa: E402
+from cost_optimisation import clients  # noqa: E402
+from cost_optimisation.invocation import LocalContext, LocalInvoker, set_invoker  # noqa: E402
+
+CHECKS = {
+    'ec2': ('EC2LowUtilizationCheck', fleets.build_ec2),
+    'rds-under': ('RDSUnderUtilization', fleets.build_rds),
+    'rds-high': ('RDSHighUtilization', fleets.build_rds),
+    'ecs': ('ECSServiceUnderUtilization', fleets.build_ecs),
+    'alb': ('ALBUnderUtilization', fleets.build_alb),
+    'eip': ('ElasticIPUnderUtilization', fleets.build_eip),
+    'logs': ('CloudwatchLogGroupRetention', fleets.build_logs)
+}
+
+FUNCTION_ARN = 'arn:aws:lambda:us-east-1:123456789012:function:benchmark'
+
+
+class ApiCallCounter:
+    def __init__(self):
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def __call__(self, model, **kwargs):
+        with self._lock:
+            self.calls[f"{model.service_model.service_name}.{model.name}"] += 1
+
+
+def load_handler(function_name):
+    path = os.path.join(ROOT, 'lambdas', function_name, 'index.py')
+    spec = importlib.util.spec_from_file_location(f'benchmark_{function_name}', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.lambda_handler
+
+
+def run_check(check, size, regions, track_memory, timeout_seconds, shards=1):
+    function_name, build_fleet = CHECKS[check]
+    with mock_aws():
+        topic_arn = boto3.client('sns').create_topic(Name='benchmark')['TopicArn']
+        environment = {'SNS_TOPIC_ARN': topic_arn, 'REGION_ALLOWLIST': ','.join(regions)}
+        environment.update(build_fleet(size, regions))
+        if shards > 1:
+            # Dispatcher/worker mode, with workers run in-process one after another
+            fleets._create_table(os.environ['AWS_REGION'], 'shard-run-table', 'RunKey')
+            environment.update({'SHARD_COUNT': str(shards), 'SHARD_TABLE_NAME': 'shard-run-table'})
+        previous = {name: os.environ.get(name) for name in environment}
+        os.environ.update(environment)
+
+        # Fresh client pool, so every client created by the handler is counted
+        clients.clear_clients()
+        counter = ApiCallCounter()
+        clients.get_session().events.register('before-call', counter)
+        handler = load_handler(function_name)
+        context_factory = partial(LocalContext, timeout_seconds=timeout_seconds)
+        invoker = LocalInvoker(handler, context_factory)
+        set_invoker(invoker)
+
+        if track_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        try:
+            handler({}, context_factory(FUNCTION_ARN))
+            invoker.drain()
+        finally:
+            wall_time = time.perf_counter() - started
+            peak_memory = tracemalloc.get_traced_memory()[1] if track_memory else None
+            if track_memory:
+                tracemalloc.stop()
+            set_invoker(None)
+            clients.clear_clients()
+            for name, value in previous.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+
+    return {
+        'check': check,
+        'function': function_name,
+        'size': size,
+        'regions': len(regions),
+        'invocations': 1 + invoker.invocations,
+        'wall_time_seconds': round(wall_time, 3),
+        'api_calls': sum(counter.calls.values()),
+        'api_calls_by_operation': dict(sorted(counter.calls.items())),
+        'peak_memory_bytes': peak_memory
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline scale benchmarks for the cost-optimisation checks')
+    parser.add_argument('--checks', nargs='+', choices=sorted(CHECKS), default=sorted(CHECKS))
+    parser.add_argument('--sizes', nargs='+', type=int, default=[100, 1000, 10000])
+    parser.add_argument('--regions', nargs='+', default=['us-east-1', 'eu-west-1', 'ap-southeast-2'])
+    parser.add_argument('--shards', type=int, default=1, help='split each run into this many worker invocations')
+    parser.add_argument('--timeout', type=int, default=300, help='remaining time reported by the Lambda context')
+    parser.add_argument('--no-memory', action='store_true', help='skip tracemalloc, which slows runs down')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args(argv)
+
+    results = []
+    print(f"{'check':<10} {'size':>6} {'wall s':>9} {'calls':>7} {'peak MB':>9}  top operations")
+    for check in args.checks:
+        for size in args.sizes:
+            result = run_check(check, size, args.regions, not args.no_memory, args.timeout, args.shards)
+            results.append(result)
+            top = sorted(result['api_calls_by_operation'].items(), key=lambda item: -item[1])[:3]
+            peak = f"{result['peak_memory_bytes'] / (1024 * 1024):.1f}" if result['peak_memory_bytes'] is not None else '-'
+            print(f"{check:<10} {size:>6} {result['wall_time_seconds']:>9.2f} {result['api_calls']:>7} {peak:>9}  "
+                  + ', '.join(f"{operation}={count}" for operation, count in top))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
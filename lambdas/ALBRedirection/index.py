@@ -1,38 +1,43 @@
-import boto3
 import logging
 import os
+from functools import partial
+from cost_optimisation.clients import get_client
+from cost_optimisation.fanout import map_concurrently
+from cost_optimisation.findings import INFO, Finding
+from cost_optimisation.ratelimit import log_rate_limit_stats
+from cost_optimisation.regions import ActiveRegionIndex
+from cost_optimisation.report import publish_report
+from cost_optimisation.shards import run_sweep
 
 # Configure logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-def lambda_handler(event, context):
-    sns_topic_arn = os.environ['SNS_TOPIC_ARN']
-    all_findings = ["Here is ALB HTTP to HTTPS Redirection Report for all regions:"]
-
-    # Get a list of all regions
-    ec2_client = boto3.client('ec2')
-    regions = [region['RegionName'] for region in ec2_client.describe_regions()['Regions']]
+LISTENER_CONCURRENCY = 8
 
-    for region in regions:
-        elb_client = boto3.client('elbv2', region_name=region)
-        # List all Application Load Balancers (ALBs) in the current region
-        albs = elb_client.describe_load_balancers()['LoadBalancers']
-        modified_albs = []
+# What every HTTP listener should do by default
+HTTPS_REDIRECT = {
+    'Protocol': 'HTTPS',
+    'Port': '443',
+    'StatusCode': 'HTTP_301'
+}
 
-        for alb in albs:
-            if alb['Scheme'] == 'internet-facing':
-                # Manage listeners for each ALB
-                manage_alb_listeners(alb, modified_albs, elb_client, region)
+def lambda_handler(event, context):
+    sns_topic_arn = os.environ['SNS_TOPIC_ARN']
 
-        if modified_albs:
-            all_findings.extend(modified_albs)
+    # Check every region concurrently, sharded across invocations if configured
+    # and checkpointed before the deadline
+    region_index = ActiveRegionIndex('ALBRedirection', 'AWS::ElasticLoadBalancingV2::LoadBalancer')
+    findings = run_sweep('ALBRedirection', event, context, region_index.regions(), partial(check_region, region_index=region_index))
+    region_index.save()
+    log_rate_limit_stats()
+    if findings is None:
+        return {'statusCode': 202, 'body': 'Sweep continues in other invocations, which send the report.'}
 
     # Send a notification if any ALBs were modified
-    if len(all_findings) > 1:
-        message = "\n".join(all_findings)
-        sns_client = boto3.client('sns')
-        sns_client.publish(TopicArn=sns_topic_arn, Message=message)
+    if findings:
+        sns_client = get_client('sns')
+        publish_report(sns_client, sns_topic_arn, 'ALBRedirection', "Here is ALB HTTP to HTTPS Redirection Report for all regions:", findings)
         logger.info("Notification sent to SNS topic.")
 
     return {
@@ -40,16 +45,44 @@ def lambda_handler(event, context):
         'body': 'Processed ALBs for HTTP to HTTPS redirection across all regions.'
     }
 
-def manage_alb_listeners(alb, modified_albs, elb_client, region):
-    listeners = elb_client.describe_listeners(LoadBalancerArn=alb['LoadBalancerArn'])['Listeners']
+def check_region(region, region_index):
+    elb_client = get_client('elbv2', region_name=region)
+    # List all internet-facing Application Load Balancers (ALBs) in the current region
+    paginator = elb_client.get_paginator('describe_load_balancers')
+    load_balancers = [alb for page in paginator.paginate() for alb in page['LoadBalancers']]
+    region_index.record(region, len(load_balancers))
+    albs = [alb for alb in load_balancers if alb['Scheme'] == 'internet-facing']
+    modified_albs = []
+
+    listeners = map_concurrently(partial(describe_listeners, elb_client), [alb['LoadBalancerArn'] for alb in albs], LISTENER_CONCURRENCY)
+
+    for alb, alb_listeners in zip(albs, listeners):
+        # Manage listeners for each ALB
+        manage_alb_listeners(alb, alb_listeners, modified_albs, elb_client, region)
+
+    return modified_albs
+
+def describe_listeners(elb_client, load_balancer_arn):
+    paginator = elb_client.get_paginator('describe_listeners')
+    return [listener for page in paginator.paginate(LoadBalancerArn=load_balancer_arn) for listener in page['Listeners']]
+
+def redirects_to_https(listener):
+    # Whether the listener already redirects to HTTPS by default; AWS fills in
+    # the host, path and query of the redirect, so only these fields are compared
+    default_actions = listener.get('DefaultActions', [])
+    return len(default_actions) == 1 and default_actions[0]['Type'] == 'redirect' and all(
+        default_actions[0].get('RedirectConfig', {}).get(name) == value for name, value in HTTPS_REDIRECT.items()
+    )
+
+def manage_alb_listeners(alb, listeners, modified_albs, elb_client, region):
     http_listener = next((l for l in listeners if l['Protocol'] == 'HTTP'), None)
     https_listener = next((l for l in listeners if l['Protocol'] == 'HTTPS'), None)
 
     if https_listener and not http_listener:
         # Create HTTP listener
         create_http_listener(alb, elb_client, modified_albs, region)
-    elif http_listener:
-        # Modify existing HTTP listener
+    elif http_listener and not redirects_to_https(http_listener):
+        # Modify existing HTTP listener; one that already redirects is left alone
         modify_http_listener(http_listener, elb_client, modified_albs, region)
 
 def create_http_listener(alb, elb_client, modified_albs, region):
@@ -61,17 +94,14 @@ def create_http_listener(alb, elb_client, modified_albs, region):
             DefaultActions=[
                 {
                     'Type': 'redirect',
-                    'RedirectConfig': {
-                        'Protocol': 'HTTPS',
-                        'Port': '443',
-                        'StatusCode': 'HTTP_301'
-                    }
+                    'RedirectConfig': dict(HTTPS_REDIRECT)
                 }
             ]
         )
         listener_arn = response['Listeners'][0]['ListenerArn']
-        message = f"Region {region}: Created HTTP listener for ALB: {alb['LoadBalancerName']} (ARN: {listener_arn})"
-        modified_albs.append(message)
+        modified_albs.append(Finding('ALBRedirection', region, alb['LoadBalancerArn'],
+                                     "Region {region}: Created HTTP listener for ALB: {name} (ARN: {listener_arn})",
+                                     {'name': alb['LoadBalancerName'], 'listener_arn': listener_arn}, severity=INFO, kind='CreateListener'))
     except Exception as e:
         logger.error(f"Error in region {region}: Failed to create HTTP listener for ALB: {alb['LoadBalancerName']} - {e}")
 
@@ -82,15 +112,12 @@ def modify_http_listener(http_listener, elb_client, modified_albs, region):
             DefaultActions=[
                 {
                     'Type': 'redirect',
-                    'RedirectConfig': {
-                        'Protocol': 'HTTPS',
-                        'Port': '443',
-                        'StatusCode': 'HTTP_301'
-                    }
+                    'RedirectConfig': dict(HTTPS_REDIRECT)
                 }
             ]
         )
-        message = f"Region {region}: Modified HTTP listener for ALB: {http_listener['ListenerArn']} to redirect to HTTPS"
-        modified_albs.append(message)
+        modified_albs.append(Finding('ALBRedirection', region, http_listener['LoadBalancerArn'],
+                                     "Region {region}: Modified HTTP listener for ALB: {listener_arn} to redirect to HTTPS",
+                                     {'listener_arn': http_listener['ListenerArn']}, severity=INFO, kind='ModifyListener'))
     except Exception as e:
         logger.error(f"Error in region {region}: Failed to modify HTTP listener for ALB: {http_listener['ListenerArn']} - {e}")
@@ -1,105 +1,173 @@
-import boto3
 import os
 import logging
 import datetime
 import json
+from functools import partial
 from botocore.exceptions import ClientError
+from cost_optimisation.checkpoint import RegionIncomplete
+from cost_optimisation.clients import get_client
+from cost_optimisation.fanout import map_concurrently
+from cost_optimisation.findings import MEDIUM, Finding
+from cost_optimisation.metrics import MetricDataBatch
+from cost_optimisation.ratelimit import log_rate_limit_stats
+from cost_optimisation.regions import ActiveRegionIndex
+from cost_optimisation.report import publish_report
+from cost_optimisation.shards import run_sweep, swept_regions
 
 # Configure logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+TARGET_HEALTH_CONCURRENCY = 8
+
+# Connection metric per load balancer type
+CONNECTION_METRICS = {
+    'application': ('AWS/ApplicationELB', 'NewConnectionCount'),
+    'network': ('AWS/NetworkELB', 'NewFlowCount')
+}
+
 def lambda_handler(event, context):
     sns_topic_arn = os.environ['SNS_TOPIC_ARN']
-    sns_client = boto3.client('sns')
-    all_findings = ["Here is ALB Underutilisation Report for all regions:"]
+    sns_client = get_client('sns')
 
-    # Get a list of all regions
-    ec2_client = boto3.client('ec2')
-    regions = [region['RegionName'] for region in ec2_client.describe_regions()['Regions']]
+    # Check every region concurrently, sharded across invocations if configured
+    # and checkpointed before the deadline
+    region_index = ActiveRegionIndex('ALBUnderUtilization', 'AWS::ElasticLoadBalancingV2::LoadBalancer')
+    regions = region_index.regions()
+    findings = run_sweep('ALBUnderUtilization', event, context, regions, partial(check_region, region_index=region_index))
+    region_index.save()
+    log_rate_limit_stats()
+    if findings is None:
+        return {'statusCode': 202, 'body': 'Sweep continues in other invocations, which send the report.'}
 
-    # Iterate through each region
-    for region in regions:
-        logger.info(f"Checking region {region} for Elastic Load Balancers")
-        elbv2_client = boto3.client('elbv2', region_name=region)
-        cw_client = boto3.client('cloudwatch', region_name=region)
+    publish_report(sns_client, sns_topic_arn, 'ALBUnderUtilization', "Here is ALB Underutilisation Report for all regions:", findings,
+                   regions=swept_regions(event, regions))
 
-        paginator = elbv2_client.get_paginator('describe_load_balancers')
-        page_iterator = paginator.paginate()
+    return "ELB evaluation across regions completed."
 
-        for page in page_iterator:
-            for elb in page['LoadBalancers']:
-                elb_arn = elb['LoadBalancerArn']
-                elb_name = elb['LoadBalancerName']
+def check_region(region, region_index):
+    logger.info(f"Checking region {region} for Elastic Load Balancers")
+    elbv2_client = get_client('elbv2', region_name=region)
+    cw_client = get_client('cloudwatch', region_name=region)
+    findings = []
 
-                target_groups = get_target_groups(elbv2_client, elb_arn)
-                no_targets = check_no_targets(elbv2_client, target_groups)
-                failed_targets = check_failed_targets(elbv2_client, target_groups)
-                low_connection_count = check_low_connection_count(cw_client, elb_name)
+    paginator = elbv2_client.get_paginator('describe_load_balancers')
+    page_iterator = paginator.paginate()
+    load_balancers = [elb for page in page_iterator for elb in page['LoadBalancers']]
+    region_index.record(region, len(load_balancers))
+    if not load_balancers:
+        return findings
 
-                if no_targets or failed_targets or low_connection_count:
-                    finding_message = create_detailed_message(region, elb_name, no_targets, failed_targets, low_connection_count)
-                    all_findings.append(finding_message)
+    # Fetch every target group and its health once per region, shared by all checks
+    target_groups_by_elb = get_target_groups(elbv2_client)
+    target_health = build_target_health_index(elbv2_client, target_groups_by_elb or {})
+    connection_counts = get_connection_counts(cw_client, load_balancers)
 
-    if len(all_findings) > 1:
-        consolidated_message = "\n".join(all_findings)
-        sns_client.publish(TopicArn=sns_topic_arn, Message=consolidated_message)
+    for elb in load_balancers:
+        elb_arn = elb['LoadBalancerArn']
+        elb_name = elb['LoadBalancerName']
 
-    return "ELB evaluation across regions completed."
+        target_groups = (target_groups_by_elb or {}).get(elb_arn, [])
+        no_targets = check_no_targets(target_health, target_groups)
+        failed_targets = check_failed_targets(target_health, target_groups)
+        low_connection_count = check_low_connection_count(connection_counts, elb)
+
+        if no_targets or failed_targets or low_connection_count:
+            findings.append(create_finding(region, elb_arn, elb_name, no_targets, failed_targets, low_connection_count))
+
+    # Load balancers whose checks failed may still have issues
+    unknown_health = sum(1 for descriptions in target_health.values() if descriptions is None)
+    unknown_connections = sum(1 for elb in load_balancers if elb.get('Type', 'application') in CONNECTION_METRICS and elb['LoadBalancerArn'] not in connection_counts)
+    if target_groups_by_elb is None:
+        raise RegionIncomplete("target groups could not be listed", findings)
+    if unknown_health or unknown_connections:
+        raise RegionIncomplete(f"{unknown_health} target groups lack health and {unknown_connections} load balancers lack connection counts", findings)
+    return findings
+
+def get_target_groups(elbv2_client):
+    # Map each load balancer ARN to its target groups with a single paginated
+    # listing; None if they could not be listed
+    target_groups_by_elb = {}
+    try:
+        paginator = elbv2_client.get_paginator('describe_target_groups')
+        for page in paginator.paginate():
+            for target_group in page['TargetGroups']:
+                for load_balancer_arn in target_group.get('LoadBalancerArns', []):
+                    target_groups_by_elb.setdefault(load_balancer_arn, []).append(target_group)
+    except ClientError as e:
+        logger.error(f"Error retrieving target groups: {e}")
+        return None
+    return target_groups_by_elb
 
-def get_target_groups(elbv2_client, load_balancer_arn):
+def build_target_health_index(elbv2_client, target_groups_by_elb):
+    # Target groups shared by several load balancers are only described once
+    target_group_arns = sorted({
+        target_group['TargetGroupArn']
+        for target_groups in target_groups_by_elb.values()
+        for target_group in target_groups
+    })
+    descriptions = map_concurrently(partial(describe_target_health, elbv2_client), target_group_arns, TARGET_HEALTH_CONCURRENCY)
+    return dict(zip(target_group_arns, descriptions))
+
+def describe_target_health(elbv2_client, target_group_arn):
     try:
-        response = elbv2_client.describe_target_groups(LoadBalancerArn=load_balancer_arn)
-        return response['TargetGroups']
+        response = elbv2_client.describe_target_health(TargetGroupArn=target_group_arn)
+        return response['TargetHealthDescriptions']
     except ClientError as e:
-        logger.error(f"Error retrieving target groups for ELB {load_balancer_arn}: {e}")
-        return []
+        logger.error(f"Error checking target health for target group {target_group_arn}: {e}")
+        return None
 
-def check_no_targets(elbv2_client, target_groups):
+def check_no_targets(target_health, target_groups):
     for target_group in target_groups:
-        try:
-            response = elbv2_client.describe_target_health(TargetGroupArn=target_group['TargetGroupArn'])
-            if not response['TargetHealthDescriptions']:
-                return True
-        except ClientError as e:
-            logger.error(f"Error checking targets for target group {target_group['TargetGroupArn']}: {e}")
+        descriptions = target_health.get(target_group['TargetGroupArn'])
+        if descriptions is not None and not descriptions:
+            return True
     return False
 
-def check_failed_targets(elbv2_client, target_groups):
+def check_failed_targets(target_health, target_groups):
     for target_group in target_groups:
-        try:
-            response = elbv2_client.describe_target_health(TargetGroupArn=target_group['TargetGroupArn'])
-            if any(target['TargetHealth']['State'] == 'unhealthy' for target in response['TargetHealthDescriptions']):
-                return True
-        except ClientError as e:
-            logger.error(f"Error checking target health for target group {target_group['TargetGroupArn']}: {e}")
+        descriptions = target_health.get(target_group['TargetGroupArn']) or []
+        if any(target['TargetHealth']['State'] == 'unhealthy' for target in descriptions):
+            return True
     return False
 
-def check_low_connection_count(cw_client, elb_name):
-    try:
-        end_time = datetime.datetime.now()
-        start_time = end_time - datetime.timedelta(days=7)
-        response = cw_client.get_metric_statistics(
-            Namespace='AWS/ApplicationELB',
-            MetricName='NewConnectionCount',
-            Dimensions=[{'Name': 'LoadBalancer', 'Value': elb_name}],
-            StartTime=start_time,
-            EndTime=end_time,
-            Period=86400,
-            Statistics=['Sum']
-        )
-        total_connections = sum(datapoint['Sum'] for datapoint in response['Datapoints'])
-        return total_connections < 20
-    except ClientError as e:
-        logger.error(f"Error checking connection count for ELB {elb_name}: {e}")
+def get_connection_counts(cw_client, load_balancers):
+    # Weekly connection totals for every load balancer in one batched metric request
+    end_time = datetime.datetime.now(datetime.timezone.utc)
+    start_time = end_time - datetime.timedelta(days=7)
+    batch = MetricDataBatch(cw_client, start_time, end_time)
+    for elb in load_balancers:
+        if elb.get('Type', 'application') not in CONNECTION_METRICS:
+            continue
+        namespace, metric_name = CONNECTION_METRICS[elb.get('Type', 'application')]
+        batch.add(elb['LoadBalancerArn'], namespace, metric_name,
+                  [{'Name': 'LoadBalancer', 'Value': get_metric_dimension(elb['LoadBalancerArn'])}], 86400, 'Sum')
+    datapoints = batch.fetch()
+    # Failed queries are left out: an unknown count is not a low one
+    return {elb_arn: sum(datapoint['Sum'] for datapoint in points) for elb_arn, points in datapoints.items() if elb_arn not in batch.failed}
+
+def get_metric_dimension(elb_arn):
+    # CloudWatch identifies load balancers by the ARN suffix, e.g. app/my-alb/50dc6c495c0c9188
+    return elb_arn.split(':loadbalancer/', 1)[-1]
+
+def check_low_connection_count(connection_counts, elb):
+    total_connections = connection_counts.get(elb['LoadBalancerArn'])
+    if total_connections is None:
         return False
+    return total_connections < 20
 
-def create_detailed_message(region, elb_name, no_targets, failed_targets, low_connection_count):
-    message_parts = [f"ELB '{elb_name}' in region '{region}' detected issues:"]
+def create_finding(region, elb_arn, elb_name, no_targets, failed_targets, low_connection_count):
+    message_parts = ["ELB '{name}' in region '{region}' detected issues:"]
     if no_targets:
         message_parts.append("No targets in target groups associated.")
     if failed_targets:
         message_parts.append("Failed targets in target groups.")
     if low_connection_count:
         message_parts.append("Low connection count (< 20 connections per week).")
-    return " ".join(message_parts)
\ No newline at end of file
+    metrics = {
+        'name': elb_name,
+        'no_targets': no_targets,
+        'failed_targets': failed_targets,
+        'low_connection_count': low_connection_count
+    }
+    return Finding('ALBUnderUtilization', region, elb_arn, " ".join(message_parts), metrics, severity=MEDIUM)
\ No newline at end of file
@@ -1,58 +1,135 @@
-import boto3
 import os
 import logging
+from functools import partial
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from cost_optimisation.adaptive import AdaptiveWriter
+from cost_optimisation.checkpoint import SweepPaused
+from cost_optimisation.clients import get_client
+from cost_optimisation.findings import INFO, Finding
+from cost_optimisation.ratelimit import log_rate_limit_stats
+from cost_optimisation.regions import ActiveRegionIndex
+from cost_optimisation.report import publish_report
+from cost_optimisation.shards import run_sweep
 
 # Configure logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+NO_RETRY_CONFIG = Config(retries={'total_max_attempts': 1})
+
 def lambda_handler(event, context):
     sns_topic_arn = os.environ['SNS_TOPIC_ARN']
-    all_findings = ["Here is CloudWatch Log Group Retention Policy Update Report for all regions:"]
-
-    # Get a list of all regions
-    ec2_client = boto3.client('ec2')
-    regions = [region['RegionName'] for region in ec2_client.describe_regions()['Regions']]
-
-    for region in regions:
-        logger.info(f"Checking region {region} for CloudWatch Log Groups")
-        try:
-            # Initialize clients for the specific region
-            logs_client = boto3.client('logs', region_name=region)
-            paginator = logs_client.get_paginator('describe_log_groups')
-            page_iterator = paginator.paginate()
-
-            updated_log_groups = []
-
-            # Iterate through log groups with pagination
-            for page in page_iterator:
-                for log_group in page['logGroups']:
-                    # Check if the retention policy is set
-                    if 'retentionInDays' not in log_group:
-                        # Set the retention policy to 14 days
-                        logs_client.put_retention_policy(
-                            logGroupName=log_group['logGroupName'],
-                            retentionInDays=14
-                        )
-                        updated_log_groups.append(log_group['logGroupName'])
-                        logger.info(f"Updated retention policy for {log_group['logGroupName']} in region {region}")
-
-            if updated_log_groups:
-                message = f"Region: {region}, Updated log groups with 14-day retention: {', '.join(updated_log_groups)}"
-                all_findings.append(message)
 
-        except ClientError as e:
-            logger.error(f"An error occurred in region {region}: {e}")
-            continue
+    # Check every region concurrently, sharded across invocations if configured
+    # and checkpointed before the deadline
+    region_index = ActiveRegionIndex('CloudwatchLogGroupRetention', 'AWS::Logs::LogGroup')
+    findings = run_sweep('CloudwatchLogGroupRetention', event, context, region_index.regions(), partial(check_region, region_index=region_index), with_checkpoint=True)
+    region_index.save()
+    log_rate_limit_stats()
+    if findings is None:
+        return {"statusCode": 202, "body": "Sweep continues in other invocations, which send the report."}
 
-    if len(all_findings) > 1:
-        consolidated_message = "\n".join(all_findings)
+    if findings:
         try:
-            sns_client = boto3.client('sns')
-            sns_client.publish(TopicArn=sns_topic_arn, Message=consolidated_message)
+            sns_client = get_client('sns')
+            publish_report(sns_client, sns_topic_arn, 'CloudwatchLogGroupRetention', "Here is CloudWatch Log Group Retention Policy Update Report for all regions:", findings)
             logger.info("Sent SNS notification about updated log groups across all regions.")
         except ClientError as e:
             logger.error(f"An error occurred while sending SNS notification: {e}")
 
     return {"statusCode": 200, "body": "CloudWatch Log Group retention policy check completed across all regions."}
+
+def check_region(region, region_index, checkpoint):
+    logger.info(f"Checking region {region} for CloudWatch Log Groups")
+    # Initialize clients for the specific region
+    logs_client = get_client('logs', region_name=region)
+    # Pick up where an earlier invocation ran out of time, if it did
+    request = {}
+    if checkpoint.cursor(region):
+        request['nextToken'] = checkpoint.cursor(region)
+
+    # Writes go through a client without botocore retries, so throttling
+    # reaches the writer and drives its concurrency down
+    writer_client = get_client('logs', region_name=region, config=NO_RETRY_CONFIG)
+    writer = AdaptiveWriter(
+        partial(set_retention_policy, writer_client),
+        max_concurrency=int(os.environ.get('RETENTION_WRITE_CONCURRENCY', 16))
+    )
+
+    # Iterate through log groups with pagination, overlapping with the writes,
+    # and stop between pages when the invocation is running out of time
+    log_group_count = 0
+    paused_at = None
+    try:
+        while True:
+            page = logs_client.describe_log_groups(**request)
+            log_group_count += len(page['logGroups'])
+            for log_group in page['logGroups']:
+                # Check if the retention policy is set
+                if 'retentionInDays' not in log_group:
+                    writer.submit(log_group['logGroupName'])
+            if not page.get('nextToken'):
+                break
+            request['nextToken'] = page['nextToken']
+            if not checkpoint.has_time():
+                paused_at = page['nextToken']
+                break
+    finally:
+        writer.close()
+
+    logger.info(f"Retention writes in region {region}: {writer.summary()}")
+    findings = []
+    if writer.succeeded:
+        updated_log_groups = sorted(writer.succeeded)
+        # One finding per region, listing every log group updated there
+        findings.append(Finding('CloudwatchLogGroupRetention', region, region,
+                                "Region: {region}, Updated log groups with 14-day retention: {log_groups} ({summary})",
+                                {'log_groups': ', '.join(updated_log_groups), 'summary': writer.summary()}, severity=INFO))
+
+    if paused_at:
+        raise SweepPaused(paused_at, findings)
+    # A resumed region only counted its remaining pages, but it is not empty
+    region_index.record(region, max(log_group_count, 1) if 'nextToken' in request else log_group_count)
+    return findings
+
+def set_retention_policy(logs_client, log_group_name):
+    # Set the retention policy to 14 days
+    logs_client.put_retention_policy(
+        logGroupName=log_group_name,
+        retentionInDays=14
+    )
+
+def event_handler(event, context):
+    # Incremental mode: EventBridge delivers CloudTrail events for CreateLogGroup,
+    # PutRetentionPolicy and DeleteRetentionPolicy, and only the affected log
+    # group is checked. The scheduled sweep (lambda_handler) reconciles the rest.
+    detail = event.get('detail', {})
+    log_group_name = (detail.get('requestParameters') or {}).get('logGroupName')
+    region = detail.get('awsRegion') or event.get('region')
+    if not log_group_name or not region:
+        logger.info(f"Ignoring event without a log group: {detail.get('eventName')}")
+        return {"statusCode": 200, "body": "No log group in event."}
+
+    logs_client = get_client('logs', region_name=region)
+    log_group = find_log_group(logs_client, log_group_name)
+    if log_group is None:
+        logger.info(f"Log group {log_group_name} no longer exists in region {region}")
+        return {"statusCode": 200, "body": f"Log group {log_group_name} not found."}
+
+    if 'retentionInDays' in log_group:
+        return {"statusCode": 200, "body": f"Log group {log_group_name} already has a retention policy."}
+
+    set_retention_policy(logs_client, log_group_name)
+    logger.info(f"Updated retention policy for {log_group_name} in region {region} after {detail.get('eventName')}")
+    return {"statusCode": 200, "body": f"Updated retention policy for {log_group_name}."}
+
+def find_log_group(logs_client, log_group_name):
+    # Look at the current state rather than trusting the event, so out-of-order
+    # or duplicate deliveries are harmless
+    paginator = logs_client.get_paginator('describe_log_groups')
+    for page in paginator.paginate(logGroupNamePrefix=log_group_name):
+        for log_group in page['logGroups']:
+            if log_group['logGroupName'] == log_group_name:
+                return log_group
+    return None
@@ -1,96 +1,182 @@
-import boto3
 import os
 import logging
+from functools import partial
 from datetime import datetime, timedelta, timezone
 import json
+import numpy as np
+from cost_optimisation.actions import StopActionQueue
+from cost_optimisation.clients import get_client
+from cost_optimisation.findings import INFO, Finding
+from cost_optimisation.metrics import MetricDataBatch
+from cost_optimisation.pricing import add_monthly_cost, ec2_instance_monthly_cost
+from cost_optimisation.ratelimit import log_rate_limit_stats
+from cost_optimisation.regions import ActiveRegionIndex
+from cost_optimisation.report import publish_report
+from cost_optimisation.rolling import RollingAggregates
+from cost_optimisation.series import summarize, to_matrix
+from cost_optimisation.shards import run_sweep
 
 # Configure logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Percentile mode: "<Metric>.<p<N>|max>=<limit>" rules, all of which must hold
+# for an instance to be stopped
+DEFAULT_PERCENTILE_RULES = 'CPUUtilization.p95=10,CPUUtilization.max=50,NetworkIn.p95=5242880'
+PERCENTILE_METRICS = ('CPUUtilization', 'NetworkIn')
+
 def lambda_handler(event, context):
     sns_topic_arn = os.environ['SNS_TOPIC_ARN']
     dynamodb_table = os.environ['DYNAMODB_TABLE_NAME']
-    sns_client = boto3.client('sns')
-    all_findings = ["Here is EC2 Low Utilization Report for all regions:"]
-
-    # Get a list of all regions
-    ec2_client = boto3.client('ec2')
-    regions = [region['RegionName'] for region in ec2_client.describe_regions()['Regions']]
-
-    for region in regions:
-        ec2_client = boto3.client('ec2', region_name=region)
-        cw_client = boto3.client('cloudwatch', region_name=region)
-        dynamodb_client = boto3.client('dynamodb', region_name=region)
-
-        end_time = datetime.utcnow()
-        start_time = end_time - timedelta(days=14)
-
-        paginator = ec2_client.get_paginator('describe_instances')
-        page_iterator = paginator.paginate(Filters=[{'Name': 'instance-state-name', 'Values': ['running']}])
-
-        for page in page_iterator:
-            for reservation in page['Reservations']:
-                for instance in reservation['Instances']:
-                    instance_id = instance['InstanceId']
-                    launch_time = instance['LaunchTime']
-                    current_time = datetime.now(timezone.utc)
-                    instance_age_days = (current_time - launch_time).total_seconds() / (3600 * 24)
-
-                    # Only consider instances older than 1 month
-                    if instance_age_days < 30:
-                        continue
-
-                    cpu_stats = fetch_cloudwatch_metrics(cw_client, 'CPUUtilization', instance_id, start_time, end_time)
-                    network_in_stats = fetch_cloudwatch_metrics(cw_client, 'NetworkIn', instance_id, start_time, end_time)
-
-                    avg_cpu_utilization = calculate_average(cpu_stats)
-                    avg_network_io = calculate_average(network_in_stats)
+    sns_client = get_client('sns')
 
-                    if avg_cpu_utilization <= 10 and avg_network_io <= 5 * 1024 * 1024:  # 5 MB in Bytes
-                        finding_message = f"Region: {region}, Instance {instance_id}: Stopped due to low utilization. It will be deleted if not restarted within 3 days. If this instance is no longer needed - leave it in stopped state."
-                        all_findings.append(finding_message)
-                        stop_instance_and_record(ec2_client, dynamodb_client, dynamodb_table, instance_id)
+    # Check every region concurrently, sharded across invocations if configured
+    # and checkpointed before the deadline
+    region_index = ActiveRegionIndex('EC2LowUtilizationCheck', 'AWS::EC2::Instance')
+    findings = run_sweep('EC2LowUtilizationCheck', event, context, region_index.regions(), partial(check_region, dynamodb_table=dynamodb_table, region_index=region_index))
+    region_index.save()
+    log_rate_limit_stats()
+    if findings is None:
+        return {'statusCode': 202, 'body': 'Sweep continues in other invocations, which send the report.'}
 
-    if len(all_findings) > 1:
-        consolidated_message = "\n".join(all_findings)
-        sns_client.publish(TopicArn=sns_topic_arn, Message=consolidated_message)
+    if findings:
+        publish_report(sns_client, sns_topic_arn, 'EC2LowUtilizationCheck', "Here is EC2 Low Utilization Report for all regions:", findings)
 
     return {'statusCode': 200, 'body': 'EC2 evaluation across regions completed.'}
 
-def fetch_cloudwatch_metrics(cw_client, metric_name, instance_id, start_time, end_time):
-    try:
-        response = cw_client.get_metric_statistics(
-            Namespace='AWS/EC2',
-            MetricName=metric_name,
-            Dimensions=[{'Name': 'InstanceId', 'Value': instance_id}],
-            StartTime=start_time,
-            EndTime=end_time,
-            Period=86400,
-            Statistics=['Average']
-        )
-        return response['Datapoints']
-    except Exception as error:
-        logger.error(f"Error fetching metrics for instance {instance_id}: {error}")
-        return []
-
-def calculate_average(datapoints):
-    if not datapoints:
-        return 0
-    total = sum([dp['Average'] for dp in datapoints])
-    return total / len(datapoints)
-
-def stop_instance_and_record(ec2_client, dynamodb_client, dynamodb_table, instance_id):
-    try:
-        ec2_client.stop_instances(InstanceIds=[instance_id])
-        logger.info(f"Instance {instance_id} stopped due to low utilization.")
-        dynamodb_client.put_item(
-            TableName=dynamodb_table,
-            Item={
-                'InstanceId': {'S': instance_id},
-                'Timestamp': {'S': datetime.utcnow().isoformat()},
-                'Note': {'S': 'Instance stopped due to low utilization.'}
-            }
-        )
-    except Exception as error:
-        logger.error(f"Error processing instance {instance_id}: {error}")
\ No newline at end of file
+def check_region(region, dynamodb_table, region_index):
+    ec2_client = get_client('ec2', region_name=region)
+    cw_client = get_client('cloudwatch', region_name=region)
+    dynamodb_client = get_client('dynamodb', region_name=region)
+    findings = []
+
+    min_instance_age_days = int(os.environ.get('MIN_INSTANCE_AGE_DAYS', 30))
+
+    paginator = ec2_client.get_paginator('describe_instances')
+    page_iterator = paginator.paginate(Filters=[{'Name': 'instance-state-name', 'Values': ['running']}])
+
+    # Collect instances old enough to evaluate before fetching any metrics
+    instance_ids = []
+    instance_types = {}
+    instance_count = 0
+    for page in page_iterator:
+        for reservation in page['Reservations']:
+            instance_count += len(reservation['Instances'])
+            for instance in reservation['Instances']:
+                launch_time = instance['LaunchTime']
+                current_time = datetime.now(timezone.utc)
+                instance_age_days = (current_time - launch_time).total_seconds() / (3600 * 24)
+
+                # Only consider instances older than 1 month
+                if instance_age_days < min_instance_age_days:
+                    continue
+
+                instance_ids.append(instance['InstanceId'])
+                instance_types[instance['InstanceId']] = instance['InstanceType']
+
+    region_index.record(region, instance_count)
+
+    # Stop decisions are queued and applied in bulk once evaluation is done
+    stop_queue = StopActionQueue(ec2_client, dynamodb_client, dynamodb_table, 'Instance stopped due to low utilization.')
+    if os.environ.get('EVALUATION_MODE', 'average') == 'percentile':
+        idle = evaluate_percentiles(cw_client, instance_ids)
+        template = "Region: {region}, Instance {resource_id}: Stopped due to low utilization (CPU p50 {cpu_p50}%, p95 {cpu_p95}%, max {cpu_max}%). It will be deleted if not restarted within 3 days. If this instance is no longer needed - leave it in stopped state."
+    else:
+        idle = evaluate_averages(cw_client, instance_ids)
+        template = "Region: {region}, Instance {resource_id}: Stopped due to low utilization. It will be deleted if not restarted within 3 days. If this instance is no longer needed - leave it in stopped state."
+    for instance_id in idle:
+        stop_queue.add(instance_id)
+
+    # Only report instances that were both stopped and recorded
+    for instance_id in stop_queue.flush():
+        finding = Finding('EC2LowUtilizationCheck', region, instance_id, template, dict(idle[instance_id]), severity=INFO)
+        findings.append(add_monthly_cost(finding, ec2_instance_monthly_cost(region, instance_types[instance_id])))
+
+    return findings
+
+def evaluate_averages(cw_client, instance_ids):
+    # Instances whose 14-day average CPU and network are low, each with the
+    # metrics to report
+    metrics = fetch_cloudwatch_metrics(cw_client, instance_ids)
+    idle = {}
+    for instance_id in instance_ids:
+        cpu_utilization = metrics.get((instance_id, 'CPUUtilization'))
+        network_io = metrics.get((instance_id, 'NetworkIn'))
+        if not cpu_utilization or not network_io or not cpu_utilization.count or not network_io.count:
+            # A failed fetch or no datapoints is unknown, not idle
+            continue
+        avg_cpu_utilization = cpu_utilization.average
+        avg_network_io = network_io.average
+
+        if avg_cpu_utilization <= 10 and avg_network_io <= 5 * 1024 * 1024:  # 5 MB in Bytes
+            idle[instance_id] = {}
+    return idle
+
+def evaluate_percentiles(cw_client, instance_ids):
+    # Pull hourly (or PERCENTILE_PERIOD_SECONDS) series for every instance in
+    # one batch and summarize them in one vectorized pass, so a burst that an
+    # average would hide keeps an instance running
+    rules = parse_percentile_rules(os.environ.get('PERCENTILE_RULES', DEFAULT_PERCENTILE_RULES))
+    period = int(os.environ.get('PERCENTILE_PERIOD_SECONDS', 3600))
+    length = int(os.environ.get('PERCENTILE_WINDOW_DAYS', 14)) * 86400 // period
+    if not instance_ids or not rules:
+        return {}
+
+    end_time = datetime.fromtimestamp(datetime.now(timezone.utc).timestamp() // period * period, timezone.utc)
+    start_time = end_time - timedelta(seconds=length * period)
+    batch = MetricDataBatch(cw_client, start_time, end_time)
+    series_keys = [(instance_id, metric_name) for instance_id in instance_ids for metric_name in PERCENTILE_METRICS]
+    for instance_id, metric_name in series_keys:
+        batch.add((instance_id, metric_name), 'AWS/EC2', metric_name,
+                  [{'Name': 'InstanceId', 'Value': instance_id}], period, 'Average')
+    datapoints = batch.fetch()
+
+    # One row per instance and metric, in series_keys order
+    values = to_matrix([datapoints[key] for key in series_keys], ['Average'] * len(series_keys), start_time, period, length)
+    percentiles = sorted({50, 95} | {float(stat[1:]) for _, stat, _ in rules if stat != 'max'})
+    summary = summarize(values, percentiles)
+
+    # Instances with a failed or empty series are never stopped
+    has_data = np.array([key not in batch.failed for key in series_keys]) & ~np.isnan(summary['max'])
+    stop = has_data.reshape(len(instance_ids), len(PERCENTILE_METRICS)).all(axis=1)
+    for metric_name, stat, limit in rules:
+        # NaN never compares as within the limit
+        stop &= summary[stat][PERCENTILE_METRICS.index(metric_name)::len(PERCENTILE_METRICS)] <= limit
+
+    cpu = PERCENTILE_METRICS.index('CPUUtilization')
+    idle = {}
+    for index in np.flatnonzero(stop):
+        row = index * len(PERCENTILE_METRICS) + cpu
+        idle[instance_ids[index]] = {
+            'cpu_p50': round(float(summary['p50'][row]), 2),
+            'cpu_p95': round(float(summary['p95'][row]), 2),
+            'cpu_max': round(float(summary['max'][row]), 2)
+        }
+    return idle
+
+def parse_percentile_rules(spec):
+    # (metric, statistic key in summarize()'s result, limit) per valid rule
+    rules = []
+    for entry in spec.split(','):
+        if not entry.strip():
+            continue
+        name, _, limit = entry.partition('=')
+        metric_name, _, stat = name.strip().partition('.')
+        try:
+            if metric_name not in PERCENTILE_METRICS or not (stat == 'max' or (stat.startswith('p') and 0 <= float(stat[1:]) <= 100)):
+                raise ValueError(name)
+            rules.append((metric_name, stat if stat == 'max' else f"p{float(stat[1:]):g}", float(limit)))
+        except ValueError:
+            logger.warning(f"Ignoring invalid percentile rule {entry.strip()!r}")
+    return rules
+
+def fetch_cloudwatch_metrics(cw_client, instance_ids):
+    # 14-day aggregates of the daily averages; only days since the last run are fetched
+    rolling = RollingAggregates('EC2LowUtilizationCheck', cw_client)
+    for instance_id in instance_ids:
+        for metric_name in ('CPUUtilization', 'NetworkIn'):
+            rolling.add((instance_id, metric_name), 'AWS/EC2', metric_name,
+                        [{'Name': 'InstanceId', 'Value': instance_id}], 86400, 'Average')
+    aggregates = rolling.fetch()
+    # A stretch that failed to fetch leaves the window incomplete; those series are left out
+    return {key: aggregate for key, aggregate in aggregates.items() if key not in rolling.failed}
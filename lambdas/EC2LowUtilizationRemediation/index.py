@@ -1,66 +1,109 @@
-import boto3
 import os
 import logging
+from functools import partial
 from datetime import datetime
+from botocore.exceptions import ClientError
+from cost_optimisation.clients import get_client
+from cost_optimisation.dynamodb import batch_write, scan_all
+from cost_optimisation.findings import INFO, Finding
+from cost_optimisation.instances import get_instance_states
+from cost_optimisation.ratelimit import log_rate_limit_stats
+from cost_optimisation.regions import ActiveRegionIndex
+from cost_optimisation.report import publish_report
+from cost_optimisation.shards import run_sweep
 
 # Configure logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+TERMINATE_BATCH_SIZE = 1000
+
 def lambda_handler(event, context):
     dynamodb_table = os.environ['DYNAMODB_TABLE_NAME']
     sns_topic_arn = os.environ['SNS_TOPIC_ARN']
-    all_findings = ["Here is EC2 Instance Cleanup Report for all regions:"]
 
-    ec2 = boto3.client('ec2')
-    regions = [region['RegionName'] for region in ec2.describe_regions()['Regions']]
+    # Check every region concurrently, sharded across invocations if configured
+    # and checkpointed before the deadline
+    region_index = ActiveRegionIndex('EC2LowUtilizationRemediation')
+    findings = run_sweep('EC2LowUtilizationRemediation', event, context, region_index.regions(), partial(check_region, dynamodb_table=dynamodb_table, region_index=region_index))
+    region_index.save()
+    log_rate_limit_stats()
+    if findings is None:
+        return {'statusCode': 202, 'body': 'Sweep continues in other invocations, which send the report.'}
 
-    for region in regions:
-        try:
-            ec2_client = boto3.client('ec2', region_name=region)
-            dynamodb_client = boto3.client('dynamodb', region_name=region)
-
-            # Check if DynamoDB table exists in the region
-            try:
-                dynamodb_client.describe_table(TableName=dynamodb_table)
-                response = dynamodb_client.scan(TableName=dynamodb_table)
-                for record in response['Items']:
-                    finding_message = process_record(ec2_client, dynamodb_client, record, region, dynamodb_table)
-                    if finding_message:
-                        all_findings.append(f"Region: {region}, {finding_message}")
-            except dynamodb_client.exceptions.ResourceNotFoundException:
-                logger.info(f"DynamoDB table {dynamodb_table} not found in {region}")
-
-        except Exception as e:
-            logger.error(f"Error processing region {region}: {e}")
-
-    if len(all_findings) > 1:
-        consolidated_message = "\n".join(all_findings)
-        sns_client = boto3.client('sns', region_name=os.environ['AWS_REGION'])
-        sns_client.publish(TopicArn=sns_topic_arn, Message=consolidated_message)
+    if findings:
+        sns_client = get_client('sns', region_name=os.environ['AWS_REGION'])
+        publish_report(sns_client, sns_topic_arn, 'EC2LowUtilizationRemediation', "Here is EC2 Instance Cleanup Report for all regions:", findings)
 
     return {'statusCode': 200, 'body': 'EC2 instance cleanup across regions completed.'}
 
-def process_record(ec2_client, dynamodb_client, record, region, table_name):
-    instance_id = record['InstanceId']['S']
-    timestamp = datetime.fromisoformat(record['Timestamp']['S'])
+def check_region(region, dynamodb_table, region_index):
+    ec2_client = get_client('ec2', region_name=region)
+    dynamodb_client = get_client('dynamodb', region_name=region)
 
-    if (datetime.utcnow() - timestamp).days >= 3:
-        try:
-            instance = ec2_client.describe_instances(InstanceIds=[instance_id])
-            instance_state = instance['Reservations'][0]['Instances'][0]['State']['Name']
+    # Check if DynamoDB table exists in the region
+    try:
+        dynamodb_client.describe_table(TableName=dynamodb_table)
+    except dynamodb_client.exceptions.ResourceNotFoundException:
+        logger.info(f"DynamoDB table {dynamodb_table} not found in {region}")
+        region_index.record(region, 0)
+        return []
+
+    records = scan_all(dynamodb_client, dynamodb_table, int(os.environ.get('SCAN_SEGMENTS', 4)))
+    region_index.record(region, len(records))
+    return process_records(ec2_client, dynamodb_client, records, region, dynamodb_table)
 
-            if instance_state == 'stopped':
-                ec2_client.terminate_instances(InstanceIds=[instance_id])
-                dynamodb_client.delete_item(TableName=table_name, Key={'InstanceId': {'S': instance_id}})
-                return f"Instance {instance_id} stopped for over 3 days, terminated and removed from DynamoDB."
+def process_records(ec2_client, dynamodb_client, records, region, table_name):
+    # Only records older than 3 days are due for remediation
+    due = [
+        record['InstanceId']['S'] for record in records
+        if (datetime.utcnow() - datetime.fromisoformat(record['Timestamp']['S'])).days >= 3
+    ]
+    if not due:
+        return []
 
-            elif instance_state == 'running':
-                dynamodb_client.delete_item(TableName=table_name, Key={'InstanceId': {'S': instance_id}})
-                return f"Instance {instance_id} is running, removed from DynamoDB tracking."
+    instance_states = get_instance_states(ec2_client, due)
+    stopped = [instance_id for instance_id in due if instance_states.get(instance_id) == 'stopped']
+    running = [instance_id for instance_id in due if instance_states.get(instance_id) == 'running']
 
-        except Exception as e:
-            logger.error(f"Error processing instance {instance_id} in {region}: {e}")
-            return None
+    terminated = terminate_instances(ec2_client, stopped, region)
+
+    # Remove tracking only for instances that were terminated or are running again
+    removed = delete_records(dynamodb_client, table_name, terminated + running)
+
+    findings = []
+    for instance_id in terminated:
+        if instance_id in removed:
+            findings.append(Finding('EC2LowUtilizationRemediation', region, instance_id,
+                                    "Region: {region}, Instance {resource_id} stopped for over 3 days, terminated and removed from DynamoDB.",
+                                    severity=INFO, kind='Terminated'))
+    for instance_id in running:
+        if instance_id in removed:
+            findings.append(Finding('EC2LowUtilizationRemediation', region, instance_id,
+                                    "Region: {region}, Instance {resource_id} is running, removed from DynamoDB tracking.",
+                                    severity=INFO, kind='Untracked'))
+    return findings
+
+def terminate_instances(ec2_client, instance_ids, region):
+    terminated = []
+    for offset in range(0, len(instance_ids), TERMINATE_BATCH_SIZE):
+        chunk = instance_ids[offset:offset + TERMINATE_BATCH_SIZE]
+        try:
+            response = ec2_client.terminate_instances(InstanceIds=chunk)
+            terminated.extend(instance['InstanceId'] for instance in response['TerminatingInstances'])
+        except ClientError as e:
+            # One bad ID fails the whole call; fall back to single calls to isolate it
+            logger.warning(f"Batch termination failed in {region}, retrying instances individually: {e}")
+            for instance_id in chunk:
+                try:
+                    ec2_client.terminate_instances(InstanceIds=[instance_id])
+                    terminated.append(instance_id)
+                except ClientError as error:
+                    logger.error(f"Error processing instance {instance_id} in {region}: {error}")
+    return terminated
 
-    return None
\ No newline at end of file
+def delete_records(dynamodb_client, table_name, instance_ids):
+    write_requests = [{'DeleteRequest': {'Key': {'InstanceId': {'S': instance_id}}}} for instance_id in instance_ids]
+    failed = batch_write(dynamodb_client, table_name, write_requests)
+    failed_ids = {request['DeleteRequest']['Key']['InstanceId']['S'] for request in failed}
+    return {instance_id for instance_id in instance_ids if instance_id not in failed_ids}
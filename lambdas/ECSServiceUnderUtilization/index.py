@@ -1,103 +1,181 @@
-import boto3
 import os
 import datetime
 import logging
 import json
+from functools import partial
 from botocore.exceptions import ClientError
+from cost_optimisation.checkpoint import RegionIncomplete
+from cost_optimisation.clients import get_client
+from cost_optimisation.fanout import map_concurrently
+from cost_optimisation.findings import MEDIUM, Finding
+from cost_optimisation.pricing import add_monthly_cost, fargate_monthly_cost, get_price_index
+from cost_optimisation.ratelimit import log_rate_limit_stats
+from cost_optimisation.regions import ActiveRegionIndex
+from cost_optimisation.report import publish_report
+from cost_optimisation.rolling import RollingAggregates
+from cost_optimisation.shards import run_sweep, swept_regions
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-def lambda_handler(event, context):
-    sns_topic_arn = os.environ['SNS_TOPIC_ARN']
-    all_findings = ["Here is ECS Service Underutilisation Report for all regions:"]
-
-    # Get a list of all regions
-    ec2_client = boto3.client('ec2')
-    regions = [region['RegionName'] for region in ec2_client.describe_regions()['Regions']]
+CLUSTER_CONCURRENCY = 8
 
-    for region in regions:
-        logger.info(f"Checking ECS services in region {region}")
-        ecs = boto3.client('ecs', region_name=region)
-        cw = boto3.client('cloudwatch', region_name=region)
+# DescribeServices accepts at most 10 services per call
+DESCRIBE_SERVICES_BATCH_SIZE = 10
 
-        try:
-            paginator_clusters = ecs.get_paginator('list_clusters')
-            cluster_pages = paginator_clusters.paginate()
-
-            for cluster_page in cluster_pages:
-                clusters = cluster_page['clusterArns']
-                for cluster in clusters:
-                    cluster_name = cluster.split('/')[-1]  # Extract the cluster name
-                    paginator_services = ecs.get_paginator('list_services')
-                    service_pages = paginator_services.paginate(cluster=cluster)
-
-                    for service_page in service_pages:
-                        services = service_page['serviceArns']
-                        for service in services:
-                            service_name = service.split('/')[-1]  # Extract the service name
-                            findings = process_service(cluster_name, service_name, region, cw)
-                            if findings:
-                                all_findings.extend(findings)
+def lambda_handler(event, context):
+    sns_topic_arn = os.environ['SNS_TOPIC_ARN']
 
-        except ClientError as e:
-            logger.error(f"Error in Lambda execution: {e}")
+    # Check every region concurrently, sharded across invocations if configured
+    # and checkpointed before the deadline
+    region_index = ActiveRegionIndex('ECSServiceUnderUtilization', 'AWS::ECS::Cluster')
+    regions = region_index.regions()
+    findings = run_sweep('ECSServiceUnderUtilization', event, context, regions, partial(check_region, region_index=region_index))
+    region_index.save()
+    log_rate_limit_stats()
+    if findings is None:
+        return {'statusCode': 202, 'body': 'Sweep continues in other invocations, which send the report.'}
 
-    if len(all_findings) > 1:
-        consolidated_message = "\n".join(all_findings)
-        sns = boto3.client('sns')
-        sns.publish(TopicArn=sns_topic_arn, Message=consolidated_message)
+    sns = get_client('sns')
+    publish_report(sns, sns_topic_arn, 'ECSServiceUnderUtilization', "Here is ECS Service Underutilisation Report for all regions:", findings,
+                   regions=swept_regions(event, regions))
 
     return {'statusCode': 200, 'body': json.dumps('Lambda function execution completed.')}
 
-def process_service(cluster, service, region, cw):
-    findings = []
-    try:
-        logger.info(f"Processing service: {service} in cluster: {cluster}")
-
-        start_time = datetime.datetime.now() - datetime.timedelta(days=14)
-        end_time = datetime.datetime.now()
-
-        cpu_dimensions = [
-            {'Name': 'ClusterName', 'Value': cluster},
-            {'Name': 'ServiceName', 'Value': service}
-        ]
-        memory_dimensions = [
-            {'Name': 'ClusterName', 'Value': cluster},
-            {'Name': 'ServiceName', 'Value': service}
+def check_region(region, region_index):
+    logger.info(f"Checking ECS services in region {region}")
+    ecs = get_client('ecs', region_name=region)
+    cw = get_client('cloudwatch', region_name=region)
+
+    paginator_clusters = ecs.get_paginator('list_clusters')
+    cluster_pages = paginator_clusters.paginate()
+    clusters = [cluster for cluster_page in cluster_pages for cluster in cluster_page['clusterArns']]
+    region_index.record(region, len(clusters))
+
+    # Services are listed and described for each cluster in parallel
+    end_time = datetime.datetime.now(datetime.timezone.utc)
+    start_time = end_time - datetime.timedelta(days=14)
+    services_by_cluster = map_concurrently(partial(list_cluster_services, ecs, start_time), clusters, CLUSTER_CONCURRENCY)
+    failed_clusters = [cluster for cluster, cluster_services in zip(clusters, services_by_cluster) if cluster_services is None]
+    services = [
+        (cluster.split('/')[-1], service)  # Extract the cluster name
+        for cluster, cluster_services in zip(clusters, services_by_cluster)
+        for service in cluster_services or []
+    ]
+
+    # CPU and memory for every service in the region, as 14-day rolling
+    # aggregates, so the metric requests do not grow with the number of clusters
+    rolling = RollingAggregates('ECSServiceUnderUtilization', cw)
+    for cluster_name, service in services:
+        dimensions = [
+            {'Name': 'ClusterName', 'Value': cluster_name},
+            {'Name': 'ServiceName', 'Value': service['serviceName']}
         ]
+        for metric_name in ('CPUUtilization', 'MemoryUtilization'):
+            rolling.add((cluster_name, service['serviceName'], metric_name), 'AWS/ECS', metric_name, dimensions, 86400, 'Average')
+    aggregates = rolling.fetch()
+
+    underutilized = [
+        (cluster_name, service) for cluster_name, service in services
+        if all(
+            (cluster_name, service['serviceName'], metric_name) not in rolling.failed
+            and check_utilization(aggregates[(cluster_name, service['serviceName'], metric_name)])
+            for metric_name in ('CPUUtilization', 'MemoryUtilization')
+        )
+    ]
+    costs = get_fargate_costs(ecs, region, [service for _, service in underutilized])
 
-        cpu_utilization = get_metric_statistics(cw, 'AWS/ECS', 'CPUUtilization', cpu_dimensions, start_time, end_time)
-        memory_utilization = get_metric_statistics(cw, 'AWS/ECS', 'MemoryUtilization', memory_dimensions, start_time, end_time)
-
-        if check_utilization(cpu_utilization) and check_utilization(memory_utilization):
-            message = build_message(cluster, service, region, cpu_utilization, memory_utilization)
-            findings.append(message)
-
-    except ClientError as e:
-        logger.error(f"Error processing service {service} in cluster {cluster}: {e}")
+    findings = []
+    for cluster_name, service in underutilized:
+        service_name = service['serviceName']
+        cpu_utilization = aggregates[(cluster_name, service_name, 'CPUUtilization')]
+        memory_utilization = aggregates[(cluster_name, service_name, 'MemoryUtilization')]
+        finding = build_finding(cluster_name, service_name, region, cpu_utilization, memory_utilization)
+        findings.append(add_monthly_cost(finding, costs.get(service['serviceArn'])))
+
+    # Services that could not be evaluated may still be underutilized
+    failed_services = {(cluster_name, service_name) for cluster_name, service_name, _ in rolling.failed}
+    if failed_clusters or failed_services:
+        raise RegionIncomplete(f"{len(failed_clusters)} clusters could not be listed and {len(failed_services)} services lack metrics", findings)
     return findings
 
-def get_metric_statistics(cw_client, namespace, metric_name, dimensions, start_time, end_time):
-    return cw_client.get_metric_statistics(
-        Namespace=namespace,
-        MetricName=metric_name,
-        Dimensions=dimensions,
-        StartTime=start_time,
-        EndTime=end_time,
-        Period=86400,
-        Statistics=['Average']
-    )
-
-def check_utilization(metric_data):
-    if 'Datapoints' in metric_data and metric_data['Datapoints']:
-        avg_utilization = sum(d['Average'] for d in metric_data['Datapoints']) / len(metric_data['Datapoints'])
-        return avg_utilization < 20
-    return False
-
-def build_message(cluster, service, region, cpu_utilization, memory_utilization):
-    avg_cpu = sum(d['Average'] for d in cpu_utilization['Datapoints']) / len(cpu_utilization['Datapoints'])
-    avg_memory = sum(d['Average'] for d in memory_utilization['Datapoints']) / len(memory_utilization['Datapoints'])
-    return (f"ECS Service '{service}' in the cluster '{cluster}' and region '{region}' has consistently "
-            f"recorded low resource utilization over the past two weeks. CPU Usage: {avg_cpu}%, Memory Usage: {avg_memory}%. "
-            f"Consider downsizing or removing it if not needed.")
+def list_cluster_services(ecs, start_time, cluster):
+    # The services of one cluster that are worth evaluating, or None if they
+    # could not be listed
+    try:
+        services = [service for service in describe_services(ecs, cluster) if should_evaluate(service, start_time)]
+    except ClientError as e:
+        logger.error(f"Error processing cluster {cluster.split('/')[-1]}: {e}")
+        return None
+    if services:
+        logger.info(f"Processing {len(services)} services in cluster: {cluster.split('/')[-1]}")
+    return services
+
+def describe_services(ecs, cluster):
+    paginator_services = ecs.get_paginator('list_services')
+    service_arns = [service for service_page in paginator_services.paginate(cluster=cluster, PaginationConfig={'PageSize': 100}) for service in service_page['serviceArns']]
+
+    services = []
+    for offset in range(0, len(service_arns), DESCRIBE_SERVICES_BATCH_SIZE):
+        response = ecs.describe_services(cluster=cluster, services=service_arns[offset:offset + DESCRIBE_SERVICES_BATCH_SIZE])
+        services.extend(response['services'])
+    return services
+
+def should_evaluate(service, start_time):
+    # Services scaled to zero have no utilization to measure, and services created
+    # inside the evaluation window do not have two weeks of history yet
+    if service.get('desiredCount', 0) == 0:
+        return False
+    created_at = service.get('createdAt')
+    if created_at and created_at > start_time:
+        return False
+    return True
+
+def get_fargate_costs(ecs, region, services):
+    # Monthly cost of each Fargate service at its desired count, by service ARN, from the size of
+    # its task definition. Services on EC2 capacity are paid for through their
+    # instances, so they get no cost here.
+    if get_price_index() is None:
+        return {}
+    fargate_services = [service for service in services if is_fargate(service)]
+
+    sizes = {}
+    for task_definition in sorted({service['taskDefinition'] for service in fargate_services}):
+        try:
+            definition = ecs.describe_task_definition(taskDefinition=task_definition)['taskDefinition']
+        except ClientError as e:
+            logger.error(f"Error describing task definition {task_definition}: {e}")
+            continue
+        if definition.get('cpu') and definition.get('memory'):
+            # CPU units (1024 per vCPU) and MiB
+            sizes[task_definition] = (int(definition['cpu']) / 1024, int(definition['memory']) / 1024)
+
+    costs = {}
+    for service in fargate_services:
+        if service['taskDefinition'] not in sizes:
+            continue
+        task_cost = fargate_monthly_cost(region, *sizes[service['taskDefinition']])
+        if task_cost is not None:
+            costs[service['serviceArn']] = task_cost * service.get('desiredCount', 0)
+    return costs
+
+def is_fargate(service):
+    if service.get('launchType') == 'FARGATE':
+        return True
+    return any(strategy.get('capacityProvider', '').startswith('FARGATE') for strategy in service.get('capacityProviderStrategy', []))
+
+def check_utilization(aggregate):
+    # Services without datapoints are not reported
+    return aggregate.count > 0 and aggregate.average < 20
+
+def build_finding(cluster, service, region, cpu_utilization, memory_utilization):
+    template = ("ECS Service '{service}' in the cluster '{cluster}' and region '{region}' has consistently "
+                "recorded low resource utilization over the past two weeks. CPU Usage: {cpu}%, Memory Usage: {memory}%. "
+                "Consider downsizing or removing it if not needed.")
+    metrics = {
+        'cluster': cluster,
+        'service': service,
+        'cpu': cpu_utilization.average,
+        'memory': memory_utilization.average
+    }
+    return Finding('ECSServiceUnderUtilization', region, f"{cluster}/{service}", template, metrics, severity=MEDIUM)
@@ -1,7 +1,15 @@
-import boto3
 import os
 import logging
 import json
+from functools import partial
+from cost_optimisation.clients import get_client
+from cost_optimisation.findings import HIGH, Finding
+from cost_optimisation.instances import get_instance_states
+from cost_optimisation.pricing import add_monthly_cost, elastic_ip_monthly_cost
+from cost_optimisation.ratelimit import log_rate_limit_stats
+from cost_optimisation.regions import ActiveRegionIndex
+from cost_optimisation.report import publish_report
+from cost_optimisation.shards import run_sweep, swept_regions
 
 # Configure logging
 logger = logging.getLogger()
@@ -9,24 +17,42 @@ logger.setLevel(logging.INFO)
 
 def lambda_handler(event, context):
     sns_topic_arn = os.environ['SNS_TOPIC_ARN']
-    sns_client = boto3.client('sns')
-    ec2_client = boto3.client('ec2')
+    sns_client = get_client('sns')
 
-    regions = [region['RegionName'] for region in ec2_client.describe_regions()['Regions']]
-    all_findings = []
+    # Check every region concurrently, sharded across invocations if configured
+    # and checkpointed before the deadline
+    region_index = ActiveRegionIndex('ElasticIPUnderUtilization', 'AWS::EC2::EIP')
+    regions = region_index.regions()
+    findings = run_sweep('ElasticIPUnderUtilization', event, context, regions, partial(check_region, region_index=region_index))
+    region_index.save()
+    log_rate_limit_stats()
+    if findings is None:
+        return {"statusCode": 202, "body": "Sweep continues in other invocations, which send the report."}
 
-    for region in regions:
-        logger.info(f"Checking region {region} for Elastic IPs")
-        ec2_client = boto3.client('ec2', region_name=region)
-        eips = ec2_client.describe_addresses()['Addresses']
+    publish_report(sns_client, sns_topic_arn, 'ElasticIPUnderUtilization', "Here is Unassociated Elastic IP Report for all regions:", findings,
+                   regions=swept_regions(event, regions))
 
-        for eip in eips:
-            if 'InstanceId' not in eip or (eip['InstanceId'] and ec2_client.describe_instances(InstanceIds=[eip['InstanceId']])['Reservations'][0]['Instances'][0]['State']['Name'] == 'stopped'):
-                finding = f"Region {region}: Elastic IP {eip['PublicIp']} is either unassociated or associated with a stopped instance. It is strongly recommended to release Elastic IP to avoid unneccessary costs "
-                all_findings.append(finding)
+    return {"statusCode": 200, "body": "Elastic IP check completed."}
 
-    if all_findings:
-        message = "Here is Unassociated Elastic IP Report for all regions:\n" + "\n".join(all_findings)
-        sns_client.publish(TopicArn=sns_topic_arn, Message=message)
+def check_region(region, region_index):
+    logger.info(f"Checking region {region} for Elastic IPs")
+    ec2_client = get_client('ec2', region_name=region)
+    eips = ec2_client.describe_addresses()['Addresses']
+    region_index.record(region, len(eips))
+    findings = []
 
-    return {"statusCode": 200, "body": "Elastic IP check completed."}
\ No newline at end of file
+    # Resolve the state of every associated instance up front instead of once per address
+    instance_ids = sorted({eip['InstanceId'] for eip in eips if eip.get('InstanceId')})
+    instance_states = get_instance_states(ec2_client, instance_ids)
+
+    monthly_cost = elastic_ip_monthly_cost(region)
+    for eip in eips:
+        if 'InstanceId' not in eip or (eip['InstanceId'] and instance_states.get(eip['InstanceId']) == 'stopped'):
+            finding = Finding(
+                'ElasticIPUnderUtilization', region, eip['PublicIp'],
+                "Region {region}: Elastic IP {resource_id} is either unassociated or associated with a stopped instance. It is strongly recommended to release Elastic IP to avoid unneccessary costs ",
+                severity=HIGH
+            )
+            findings.append(add_monthly_cost(finding, monthly_cost))
+
+    return findings
@@ -1,56 +1,96 @@
-import boto3
 import os
 import logging
-from datetime import datetime, timedelta
+from functools import partial
+from datetime import datetime, timedelta, timezone
 import json
+import numpy as np
+from cost_optimisation.capacity import instance_class_capacity
+from cost_optimisation.checkpoint import RegionIncomplete
+from cost_optimisation.clients import get_client
+from cost_optimisation.findings import HIGH, Finding
+from cost_optimisation.metrics import MetricDataBatch, MetricStatistics
+from cost_optimisation.ratelimit import log_rate_limit_stats
+from cost_optimisation.regions import ActiveRegionIndex
+from cost_optimisation.report import publish_report
+from cost_optimisation.shards import run_sweep, swept_regions
+from cost_optimisation.series import n_of_m_breaches, to_matrix
 
 # Configure logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Thresholds applied to every instance in breach mode, independent of class
+BREACH_METRICS = {
+    'ReadIOPS': 900,
+    'WriteIOPS': 900,
+    'SwapUsage': 400000000
+}
+
 def lambda_handler(event, context):
     sns_topic_arn = os.environ['SNS_TOPIC_ARN']
-    all_findings = ["Here is RDS High Utilization Report for all regions:"]
-
-    # Get a list of all regions
-    ec2_client = boto3.client('ec2')
-    regions = [region['RegionName'] for region in ec2_client.describe_regions()['Regions']]
-
-    for region in regions:
-        rds_client = boto3.client('rds', region_name=region)
-        cw_client = boto3.client('cloudwatch', region_name=region)
 
-        end_time = datetime.utcnow()
-        start_time = end_time - timedelta(hours=2)
-
-        thresholds = {
-            'db.t3.micro': {'freeable_memory': 100, 'cpu': 50},
-            'db.t2.micro': {'freeable_memory': 100, 'cpu': 50},
-            'db.t3.small': {'freeable_memory': 200, 'cpu': 50},
-            'db.t3.medium': {'freeable_memory': 400, 'cpu': 50}
-        }
+    # Check every region concurrently, sharded across invocations if configured
+    # and checkpointed before the deadline
+    region_index = ActiveRegionIndex('RDSHighUtilization', 'AWS::RDS::DBInstance')
+    regions = region_index.regions()
+    findings = run_sweep('RDSHighUtilization', event, context, regions, partial(check_region, region_index=region_index))
+    region_index.save()
+    log_rate_limit_stats()
+    if findings is None:
+        return {'statusCode': 202, 'body': 'Sweep continues in other invocations, which send the report.'}
 
-        try:
-            response = rds_client.describe_db_instances()
-            for instance in response['DBInstances']:
-                instance_id = instance['DBInstanceIdentifier']
-                db_class = instance['DBInstanceClass']
-                findings = evaluate_instance_metrics(cw_client, instance_id, start_time, end_time, db_class, thresholds, region)
-
-                if findings:
-                    all_findings.extend(findings)
-
-        except Exception as e:
-            logger.error(f"Error in region {region}: {e}")
-
-    if len(all_findings) > 1:
-        consolidated_message = "\n".join(all_findings)
-        sns_client = boto3.client('sns')
-        sns_client.publish(TopicArn=sns_topic_arn, Message=consolidated_message)
+    sns_client = get_client('sns')
+    publish_report(sns_client, sns_topic_arn, 'RDSHighUtilization', "Here is RDS High Utilization Report for all regions:", findings,
+                   regions=swept_regions(event, regions))
 
     return {'statusCode': 200, 'body': 'RDS evaluation across regions completed.'}
 
-def evaluate_instance_metrics(cw_client, instance_id, start_time, end_time, db_class, thresholds, region):
+def check_region(region, region_index):
+    rds_client = get_client('rds', region_name=region)
+    cw_client = get_client('cloudwatch', region_name=region)
+    all_findings = []
+
+    end_time = datetime.utcnow()
+    start_time = end_time - timedelta(hours=2)
+
+    paginator = rds_client.get_paginator('describe_db_instances')
+    db_instances = [instance for page in paginator.paginate() for instance in page['DBInstances']]
+    region_index.record(region, len(db_instances))
+    thresholds = class_thresholds(db_instances, region)
+    if os.environ.get('EVALUATION_MODE', 'hourly') == 'breach':
+        return evaluate_breaches(cw_client, db_instances, thresholds, region)
+
+    metric_stats = MetricStatistics(cw_client)
+    for instance in db_instances:
+        instance_id = instance['DBInstanceIdentifier']
+        db_class = instance['DBInstanceClass']
+        findings = evaluate_instance_metrics(metric_stats, instance_id, start_time, end_time, db_class, thresholds, region)
+
+        if findings:
+            all_findings.extend(findings)
+
+    return all_findings
+
+def class_thresholds(instances, region):
+    # Freeable memory (bytes) and CPU thresholds per instance class, relative
+    # to the capacity of the class. Classes without a known capacity are left
+    # out, so only the absolute metrics are checked for their instances.
+    freeable_memory_ratio = float(os.environ.get('FREEABLE_MEMORY_RATIO', 0.1))
+    cpu_threshold = float(os.environ.get('CPU_THRESHOLD', 50))
+    thresholds = {}
+    for instance in instances:
+        db_class = instance['DBInstanceClass']
+        if db_class in thresholds:
+            continue
+        capacity = instance_class_capacity(db_class)
+        if capacity is None:
+            logger.warning(f"Region: {region}, no capacity known for {db_class}, checking only absolute thresholds for its instances")
+            thresholds[db_class] = None
+            continue
+        thresholds[db_class] = {'freeable_memory': round(freeable_memory_ratio * capacity.memory_bytes), 'cpu': cpu_threshold}
+    return {db_class: threshold for db_class, threshold in thresholds.items() if threshold is not None}
+
+def evaluate_instance_metrics(metric_stats, instance_id, start_time, end_time, db_class, thresholds, region):
     findings = []
     metrics = {
         'ReadIOPS': {'threshold': 900, 'statistic': 'Maximum'},
@@ -58,46 +98,107 @@ def evaluate_instance_metrics(cw_client, instance_id, start_time, end_time, db_c
         'SwapUsage': {'threshold': 400000000, 'statistic': 'Maximum'}
     }
 
-    freeable_memory = get_metric_average(cw_client, 'AWS/RDS', 'FreeableMemory', instance_id, start_time, end_time)
-    cpu_utilization = get_metric_average(cw_client, 'AWS/RDS', 'CPUUtilization', instance_id, start_time, end_time)
+    freeable_memory = get_metric_average(metric_stats, 'AWS/RDS', 'FreeableMemory', instance_id, start_time, end_time)
+    cpu_utilization = get_metric_average(metric_stats, 'AWS/RDS', 'CPUUtilization', instance_id, start_time, end_time)
 
     if db_class in thresholds:
         if freeable_memory is not None and freeable_memory < thresholds[db_class]['freeable_memory']:
-            findings.append(f"Region: {region}, RDS Instance ID: {instance_id} has low freeable memory ({freeable_memory} MB).")
+            findings.append(Finding('RDSHighUtilization', region, instance_id,
+                                    "Region: {region}, RDS Instance ID: {resource_id} has low freeable memory ({value} MB).",
+                                    {'value': round(freeable_memory / (1024 * 1024), 2)}, severity=HIGH, kind='FreeableMemory'))
         if cpu_utilization is not None and cpu_utilization > thresholds[db_class]['cpu']:
-            findings.append(f"Region: {region}, RDS Instance ID: {instance_id} has high CPU utilization ({cpu_utilization}%).")
+            findings.append(Finding('RDSHighUtilization', region, instance_id,
+                                    "Region: {region}, RDS Instance ID: {resource_id} has high CPU utilization ({value}%).",
+                                    {'value': cpu_utilization}, severity=HIGH, kind='CPUUtilization'))
 
     for metric_name, details in metrics.items():
-        metric_value = get_metric_max(cw_client, 'AWS/RDS', metric_name, instance_id, start_time, end_time, details['statistic'])
+        metric_value = get_metric_max(metric_stats, 'AWS/RDS', metric_name, instance_id, start_time, end_time, details['statistic'])
         if metric_value > details['threshold']:
-            findings.append(f"Region: {region}, RDS Instance ID: {instance_id} triggered alarm for {metric_name} with value {metric_value}")
+            findings.append(Finding('RDSHighUtilization', region, instance_id,
+                                    "Region: {region}, RDS Instance ID: {resource_id} triggered alarm for {metric} with value {value}",
+                                    {'metric': metric_name, 'value': metric_value}, severity=HIGH, kind=metric_name))
 
     return findings
 
-def get_metric_average(cw_client, namespace, metric_name, instance_id, start_time, end_time):
-    response = cw_client.get_metric_statistics(
-        Namespace=namespace,
-        MetricName=metric_name,
-        Dimensions=[{'Name': 'DBInstanceIdentifier', 'Value': instance_id}],
-        StartTime=start_time,
-        EndTime=end_time,
-        Period=3600,
-        Statistics=['Average']
+def evaluate_breaches(cw_client, instances, thresholds, region):
+    # Pull 1-minute series for the whole fleet and apply "N of M datapoints"
+    # rules to every instance and metric in one vectorized pass
+    datapoints_to_alarm = int(os.environ.get('BREACH_DATAPOINTS_TO_ALARM', 3))
+    evaluation_periods = int(os.environ.get('BREACH_EVALUATION_PERIODS', 5))
+    window_minutes = int(os.environ.get('BREACH_WINDOW_HOURS', 6)) * 60
+
+    end_time = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+    start_time = end_time - timedelta(minutes=window_minutes)
+
+    rules = []
+    for instance in instances:
+        instance_id = instance['DBInstanceIdentifier']
+        db_class = instance['DBInstanceClass']
+        if db_class in thresholds:
+            rules.append((instance_id, 'FreeableMemory', 'Minimum', thresholds[db_class]['freeable_memory'], True))
+            rules.append((instance_id, 'CPUUtilization', 'Maximum', thresholds[db_class]['cpu'], False))
+        for metric_name, threshold in BREACH_METRICS.items():
+            rules.append((instance_id, metric_name, 'Maximum', threshold, False))
+    if not rules:
+        return []
+
+    batch = MetricDataBatch(cw_client, start_time, end_time)
+    for instance_id, metric_name, statistic, _, _ in rules:
+        batch.add((instance_id, metric_name), 'AWS/RDS', metric_name,
+                  [{'Name': 'DBInstanceIdentifier', 'Value': instance_id}], 60, statistic)
+    datapoints = batch.fetch()
+
+    values = to_matrix(
+        [datapoints[(instance_id, metric_name)] for instance_id, metric_name, _, _, _ in rules],
+        [statistic for _, _, statistic, _, _ in rules],
+        start_time, 60, window_minutes
+    )
+    breached = n_of_m_breaches(
+        values,
+        [threshold for _, _, _, threshold, _ in rules],
+        [below for _, _, _, _, below in rules],
+        datapoints_to_alarm, evaluation_periods
     )
-    datapoints = response.get('Datapoints', [])
+
+    findings = []
+    for index in np.flatnonzero(breached):
+        instance_id, metric_name, _, threshold, below = rules[index]
+        peak = np.nanmin(values[index]) if below else np.nanmax(values[index])
+        direction = "below" if below else "above"
+        metrics = {
+            'metric': metric_name,
+            'direction': direction,
+            'threshold': threshold,
+            'datapoints_to_alarm': datapoints_to_alarm,
+            'evaluation_periods': evaluation_periods,
+            'peak': round(float(peak), 2)
+        }
+        findings.append(Finding('RDSHighUtilization', region, instance_id,
+                                "Region: {region}, RDS Instance ID: {resource_id} had {metric} {direction} {threshold} in at least {datapoints_to_alarm} of {evaluation_periods} consecutive minutes (peak {peak}).",
+                                metrics, severity=HIGH, kind=metric_name))
+    if batch.failed:
+        raise RegionIncomplete(f"{len(batch.failed)} series could not be fetched", findings)
+    return findings
+
+def get_metric_average(metric_stats, namespace, metric_name, instance_id, start_time, end_time):
+    datapoints = get_metric_datapoints(metric_stats, namespace, metric_name, instance_id, start_time, end_time)
     if datapoints:
         return sum(dp['Average'] for dp in datapoints) / len(datapoints)
-    return 0
-
-def get_metric_max(cw_client, namespace, metric_name, instance_id, start_time, end_time, statistic):
-    response = cw_client.get_metric_statistics(
-        Namespace=namespace,
-        MetricName=metric_name,
-        Dimensions=[{'Name': 'DBInstanceIdentifier', 'Value': instance_id}],
-        StartTime=start_time,
-        EndTime=end_time,
-        Period=3600,
-        Statistics=[statistic]
-    )
-    datapoints = response.get('Datapoints', [])
+    # No data is not low memory
+    return None
+
+def get_metric_max(metric_stats, namespace, metric_name, instance_id, start_time, end_time, statistic):
+    datapoints = get_metric_datapoints(metric_stats, namespace, metric_name, instance_id, start_time, end_time)
     return max([dp[statistic] for dp in datapoints], default=0) if datapoints else 0
+
+def get_metric_datapoints(metric_stats, namespace, metric_name, instance_id, start_time, end_time):
+    # Average and Maximum come back together, so the second lookup of a series is served from memory
+    return metric_stats.get(
+        namespace,
+        metric_name,
+        [{'Name': 'DBInstanceIdentifier', 'Value': instance_id}],
+        start_time,
+        end_time,
+        3600,
+        ['Average', 'Maximum']
+    )
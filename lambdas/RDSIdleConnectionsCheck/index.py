@@ -1,8 +1,18 @@
-import boto3
 import os
+import math
 import logging
-from datetime import datetime, timedelta
+from functools import partial
+from datetime import datetime, timezone
 import json
+from botocore.exceptions import ClientError
+from cost_optimisation.clients import get_client
+from cost_optimisation.findings import INFO, Finding
+from cost_optimisation.metrics import MetricDataBatch
+from cost_optimisation.ratelimit import log_rate_limit_stats
+from cost_optimisation.regions import ActiveRegionIndex
+from cost_optimisation.report import publish_report
+from cost_optimisation.rolling import RollingAggregates
+from cost_optimisation.shards import run_sweep
 
 # Configure logging
 logger = logging.getLogger()
@@ -11,58 +21,93 @@ logger.setLevel(logging.INFO)
 def lambda_handler(event, context):
     sns_topic_arn = os.environ['SNS_TOPIC_ARN']
     dynamodb_table = os.environ['DYNAMODB_TABLE_NAME']
-    all_findings = ["Here is RDS Service Underutilization Report for all regions:"]
 
-    # Get a list of all regions
-    ec2_client = boto3.client('ec2')
-    regions = [region['RegionName'] for region in ec2_client.describe_regions()['Regions']]
+    # Check every region concurrently, sharded across invocations if configured
+    # and checkpointed before the deadline
+    region_index = ActiveRegionIndex('RDSIdleConnectionsCheck', 'AWS::RDS::DBInstance')
+    findings = run_sweep('RDSIdleConnectionsCheck', event, context, region_index.regions(), partial(check_region, dynamodb_table=dynamodb_table, region_index=region_index))
+    region_index.save()
+    log_rate_limit_stats()
+    if findings is None:
+        return {'statusCode': 202, 'body': 'Sweep continues in other invocations, which send the report.'}
 
-    for region in regions:
-        cloudwatch = boto3.client('cloudwatch', region_name=region)
-        dynamodb = boto3.client('dynamodb', region_name=region)
-        rds = boto3.client('rds', region_name=region)
-        sns = boto3.client('sns', region_name=region)
+    if findings:
+        sns = get_client('sns')
+        publish_report(sns, sns_topic_arn, 'RDSIdleConnectionsCheck', "Here is RDS Service Underutilization Report for all regions:", findings)
 
-        end_time = datetime.utcnow()
-        start_time = end_time - timedelta(days=14)
+    return {'statusCode': 200, 'body': 'RDS evaluation across regions completed.'}
 
-        try:
-            db_instances = rds.describe_db_instances()['DBInstances']
-            for db_instance in db_instances:
-                db_instance_id = db_instance['DBInstanceIdentifier']
-                response = cloudwatch.get_metric_statistics(
-                    Namespace='AWS/RDS',
-                    MetricName='DatabaseConnections',
-                    Dimensions=[{'Name': 'DBInstanceIdentifier', 'Value': db_instance_id}],
-                    StartTime=start_time,
-                    EndTime=end_time,
-                    Period=86400,
-                    Statistics=['Maximum']
-                )
-                max_connections = max([dp['Maximum'] for dp in response['Datapoints']], default=0)
-                if max_connections == 0:
-                    snapshot_name = f'{db_instance_id}-lambda-snapshot'
-                    rds.create_db_snapshot(DBInstanceIdentifier=db_instance_id, DBSnapshotIdentifier=snapshot_name)
-                    rds.stop_db_instance(DBInstanceIdentifier=db_instance_id)
+def check_region(region, dynamodb_table, region_index):
+    cloudwatch = get_client('cloudwatch', region_name=region)
+    dynamodb = get_client('dynamodb', region_name=region)
+    rds = get_client('rds', region_name=region)
+    findings = []
 
-                    message = f"Region: {region}, RDS instance {db_instance_id} has been stopped due to inactivity. A snapshot has been taken."
-                    all_findings.append(message)
+    paginator = rds.get_paginator('describe_db_instances')
+    db_instances = [db_instance for page in paginator.paginate() for db_instance in page['DBInstances']]
+    region_index.record(region, len(db_instances))
 
-                    dynamodb.put_item(
-                        TableName=dynamodb_table,
-                        Item={
-                            'DBInstanceIdentifier': {'S': db_instance_id},
-                            'DBSnapshotIdentifier': {'S': snapshot_name},
-                            'Timestamp': {'S': datetime.utcnow().isoformat()},
-                            'Note': {'S': 'Instance stopped due to inactivity'}
-                        }
-                    )
-        except Exception as e:
-            logger.error(f"Error in region {region}: {e}")
+    # Daily peak connections over 14 days; only days since the last run are fetched
+    rolling = RollingAggregates('RDSIdleConnectionsCheck', cloudwatch)
+    for db_instance in db_instances:
+        db_instance_id = db_instance['DBInstanceIdentifier']
+        rolling.add(db_instance_id, 'AWS/RDS', 'DatabaseConnections',
+                    [{'Name': 'DBInstanceIdentifier', 'Value': db_instance_id}], 86400, 'Maximum')
+    connections = rolling.fetch()
 
-    if len(all_findings) > 1:
-        consolidated_message = "\n".join(all_findings)
-        sns.publish(TopicArn=sns_topic_arn, Message=consolidated_message)
+    # A full window of days without a connection is required, so instances
+    # created during the window are left alone
+    idle = [
+        db_instance['DBInstanceIdentifier'] for db_instance in db_instances
+        if db_instance['DBInstanceIdentifier'] not in rolling.failed
+        and connections[db_instance['DBInstanceIdentifier']].days >= rolling.window_days
+        and not connections[db_instance['DBInstanceIdentifier']].maximum
+    ]
 
-    return {'statusCode': 200, 'body': 'RDS evaluation across regions completed.'}
+    # The rolling window ends at the last complete day, so check today before stopping anything
+    for db_instance_id in idle_today(cloudwatch, rolling, idle):
+        snapshot_name = f'{db_instance_id}-lambda-snapshot'
+        try:
+            rds.create_db_snapshot(DBInstanceIdentifier=db_instance_id, DBSnapshotIdentifier=snapshot_name)
+            rds.stop_db_instance(DBInstanceIdentifier=db_instance_id)
+        except ClientError as e:
+            logger.error(f"Error stopping RDS instance {db_instance_id} in region {region}: {e}")
+            continue
+
+        findings.append(Finding('RDSIdleConnectionsCheck', region, db_instance_id,
+                                "Region: {region}, RDS instance {resource_id} has been stopped due to inactivity. A snapshot has been taken.",
+                                severity=INFO))
+
+        try:
+            dynamodb.put_item(
+                TableName=dynamodb_table,
+                Item={
+                    'DBInstanceIdentifier': {'S': db_instance_id},
+                    'DBSnapshotIdentifier': {'S': snapshot_name},
+                    'Timestamp': {'S': datetime.utcnow().isoformat()},
+                    'Note': {'S': 'Instance stopped due to inactivity'}
+                }
+            )
+        except ClientError as e:
+            logger.error(f"Error recording stopped RDS instance {db_instance_id} in region {region}: {e}")
+
+    return findings
 
+def idle_today(cloudwatch, rolling, db_instance_ids):
+    # The instances that have had no connections since the end of the rolling
+    # window either, from one Maximum over that stretch per instance
+    if not db_instance_ids:
+        return []
+    end_time = datetime.now(timezone.utc)
+    period = max(60, math.ceil((end_time - rolling.end_time).total_seconds() / 60) * 60)
+    batch = MetricDataBatch(cloudwatch, rolling.end_time, end_time)
+    for db_instance_id in db_instance_ids:
+        batch.add(db_instance_id, 'AWS/RDS', 'DatabaseConnections',
+                  [{'Name': 'DBInstanceIdentifier', 'Value': db_instance_id}], period, 'Maximum')
+    datapoints = batch.fetch()
+    # No datapoints today is unknown, not idle
+    return [
+        db_instance_id for db_instance_id in db_instance_ids
+        if db_instance_id not in batch.failed and datapoints[db_instance_id]
+        and max(datapoint['Maximum'] for datapoint in datapoints[db_instance_id]) == 0
+    ]
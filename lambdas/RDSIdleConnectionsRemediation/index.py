@@ -1,8 +1,15 @@
-import boto3
 import os
 import logging
+from functools import partial
 from datetime import datetime, timedelta
 import json
+from cost_optimisation.clients import get_client
+from cost_optimisation.findings import INFO, Finding
+from cost_optimisation.metrics import MetricDataBatch
+from cost_optimisation.ratelimit import log_rate_limit_stats
+from cost_optimisation.regions import ActiveRegionIndex
+from cost_optimisation.report import publish_report
+from cost_optimisation.shards import run_sweep
 
 # Configure logging
 logger = logging.getLogger()
@@ -11,64 +18,76 @@ logger.setLevel(logging.INFO)
 def lambda_handler(event, context):
     sns_topic_arn = os.environ['SNS_TOPIC_ARN']
     dynamodb_table = os.environ['DYNAMODB_TABLE_NAME']
-    sns_client = boto3.client('sns')
-    all_findings = ["Here is EC2 Low Utilization Report for all regions:"]
+    sns_client = get_client('sns')
 
-    # Get a list of all regions
-    ec2_client = boto3.client('ec2')
-    regions = [region['RegionName'] for region in ec2_client.describe_regions()['Regions']]
+    # Check every region concurrently, sharded across invocations if configured
+    # and checkpointed before the deadline
+    region_index = ActiveRegionIndex('RDSIdleConnectionsRemediation', 'AWS::EC2::Instance')
+    findings = run_sweep('RDSIdleConnectionsRemediation', event, context, region_index.regions(), partial(check_region, dynamodb_table=dynamodb_table, region_index=region_index))
+    region_index.save()
+    log_rate_limit_stats()
+    if findings is None:
+        return {'statusCode': 202, 'body': 'Sweep continues in other invocations, which send the report.'}
 
-    for region in regions:
-        ec2_client = boto3.client('ec2', region_name=region)
-        cw_client = boto3.client('cloudwatch', region_name=region)
-        dynamodb_client = boto3.client('dynamodb', region_name=region)
+    if findings:
+        publish_report(sns_client, sns_topic_arn, 'RDSIdleConnectionsRemediation', "Here is EC2 Low Utilization Report for all regions:", findings)
 
-        end_time = datetime.utcnow()
-        start_time = end_time - timedelta(days=14)
+    return {'statusCode': 200, 'body': 'EC2 evaluation across regions completed.'}
 
-        paginator = ec2_client.get_paginator('describe_instances')
-        page_iterator = paginator.paginate(Filters=[{'Name': 'instance-state-name', 'Values': ['running']}])
+def check_region(region, dynamodb_table, region_index):
+    ec2_client = get_client('ec2', region_name=region)
+    cw_client = get_client('cloudwatch', region_name=region)
+    dynamodb_client = get_client('dynamodb', region_name=region)
+    findings = []
 
-        for page in page_iterator:
-            for reservation in page['Reservations']:
-                for instance in reservation['Instances']:
-                    instance_id = instance['InstanceId']
-                    cpu_stats = fetch_cloudwatch_metrics(cw_client, 'CPUUtilization', instance_id, start_time, end_time)
-                    network_in_stats = fetch_cloudwatch_metrics(cw_client, 'NetworkIn', instance_id, start_time, end_time)
+    end_time = datetime.utcnow()
+    start_time = end_time - timedelta(days=14)
 
-                    avg_cpu_utilization = calculate_average(cpu_stats)
-                    avg_network_io = calculate_average(network_in_stats)
+    paginator = ec2_client.get_paginator('describe_instances')
+    page_iterator = paginator.paginate(Filters=[{'Name': 'instance-state-name', 'Values': ['running']}])
 
-                    if avg_cpu_utilization <= 10 and avg_network_io <= 5 * 1024 * 1024:  # 5 MB in Bytes
-                        finding_message = f"Region: {region}, Instance {instance_id}: Stopped due to low utilization. It will be deleted if not restarted within 3 days. If this instance is no longer needed - leave it in stopped state."
-                        all_findings.append(finding_message)
-                        stop_instance_and_record(ec2_client, dynamodb_client, dynamodb_table, instance_id)
+    # Collect running instances before fetching any metrics
+    instance_ids = []
+    instance_count = 0
+    for page in page_iterator:
+        for reservation in page['Reservations']:
+            instance_count += len(reservation['Instances'])
+            instance_ids.extend(instance['InstanceId'] for instance in reservation['Instances'])
 
-    if len(all_findings) > 1:
-        consolidated_message = "\n".join(all_findings)
-        sns_client.publish(TopicArn=sns_topic_arn, Message=consolidated_message)
+    region_index.record(region, instance_count)
+    metrics, failed = fetch_cloudwatch_metrics(cw_client, instance_ids, start_time, end_time)
 
-    return {'statusCode': 200, 'body': 'EC2 evaluation across regions completed.'}
+    for instance_id in instance_ids:
+        if (instance_id, 'CPUUtilization') in failed or (instance_id, 'NetworkIn') in failed:
+            # Unknown is not idle; never stop an instance on a failed metric fetch
+            continue
+        avg_cpu_utilization = calculate_average(metrics[(instance_id, 'CPUUtilization')])
+        avg_network_io = calculate_average(metrics[(instance_id, 'NetworkIn')])
+        if avg_cpu_utilization is None or avg_network_io is None:
+            continue
 
-def fetch_cloudwatch_metrics(cw_client, metric_name, instance_id, start_time, end_time):
-    try:
-        response = cw_client.get_metric_statistics(
-            Namespace='AWS/EC2',
-            MetricName=metric_name,
-            Dimensions=[{'Name': 'InstanceId', 'Value': instance_id}],
-            StartTime=start_time,
-            EndTime=end_time,
-            Period=86400,
-            Statistics=['Average']
-        )
-        return response['Datapoints']
-    except Exception as error:
-        logger.error(f"Error fetching metrics for instance {instance_id}: {error}")
-        return []
+        if avg_cpu_utilization <= 10 and avg_network_io <= 5 * 1024 * 1024:  # 5 MB in Bytes
+            findings.append(Finding('RDSIdleConnectionsRemediation', region, instance_id,
+                                    "Region: {region}, Instance {resource_id}: Stopped due to low utilization. It will be deleted if not restarted within 3 days. If this instance is no longer needed - leave it in stopped state.",
+                                    severity=INFO))
+            stop_instance_and_record(ec2_client, dynamodb_client, dynamodb_table, instance_id)
+
+    return findings
+
+def fetch_cloudwatch_metrics(cw_client, instance_ids, start_time, end_time):
+    # Returns the datapoints and the keys whose queries failed
+    batch = MetricDataBatch(cw_client, start_time, end_time)
+    for instance_id in instance_ids:
+        for metric_name in ('CPUUtilization', 'NetworkIn'):
+            batch.add((instance_id, metric_name), 'AWS/EC2', metric_name,
+                      [{'Name': 'InstanceId', 'Value': instance_id}], 86400, 'Average')
+    datapoints = batch.fetch()
+    return datapoints, batch.failed
 
 def calculate_average(datapoints):
+    # None without data, which is not the same as idle
     if not datapoints:
-        return 0
+        return None
     total = sum([dp['Average'] for dp in datapoints])
     return total / len(datapoints)
 
@@ -1,7 +1,16 @@
-import boto3
 import os
 import logging
-from datetime import datetime, timedelta
+from functools import partial
+from cost_optimisation.capacity import instance_class_capacity
+from cost_optimisation.checkpoint import RegionIncomplete
+from cost_optimisation.clients import get_client
+from cost_optimisation.findings import LOW, MEDIUM, Finding
+from cost_optimisation.pricing import add_monthly_cost, rds_instance_monthly_cost
+from cost_optimisation.ratelimit import log_rate_limit_stats
+from cost_optimisation.regions import ActiveRegionIndex
+from cost_optimisation.report import publish_report
+from cost_optimisation.rolling import RollingAggregates
+from cost_optimisation.shards import run_sweep, swept_regions
 
 # Configure logging
 logger = logging.getLogger()
@@ -9,85 +18,91 @@ logger.setLevel(logging.INFO)
 
 def lambda_handler(event, context):
     sns_topic_arn = os.environ['SNS_TOPIC_ARN']
-    all_findings = ["Here is RDS Underutilization Report for all regions:"]
 
-    # Get a list of all regions
-    ec2_client = boto3.client('ec2')
-    regions = [region['RegionName'] for region in ec2_client.describe_regions()['Regions']]
+    # Check every region concurrently, sharded across invocations if configured
+    # and checkpointed before the deadline
+    region_index = ActiveRegionIndex('RDSUnderUtilization', 'AWS::RDS::DBInstance')
+    regions = region_index.regions()
+    findings = run_sweep('RDSUnderUtilization', event, context, regions, partial(check_region, region_index=region_index))
+    region_index.save()
+    log_rate_limit_stats()
+    if findings is None:
+        return {'statusCode': 202, 'body': 'Sweep continues in other invocations, which send the report.'}
 
-    for region in regions:
-        logger.info(f"Checking region {region} for RDS instances")
-        rds_client = boto3.client('rds', region_name=region)
-        cw_client = boto3.client('cloudwatch', region_name=region)
+    sns_client = get_client('sns')
+    publish_report(sns_client, sns_topic_arn, 'RDSUnderUtilization', "Here is RDS Underutilization Report for all regions:", findings,
+                   regions=swept_regions(event, regions))
 
-        # Time range for metric evaluation
-        end_time = datetime.utcnow()
-        start_time = end_time - timedelta(days=14)
+    return {'statusCode': 200, 'body': 'RDS underutilization evaluation across regions completed.'}
 
-        # Set thresholds for identifying underutilized instances
-        thresholds = {
-            'db.t3.micro': {'freeable_memory': 230 * 1024 * 1024, 'cpu': 15},
-            'db.t2.micro': {'freeable_memory': 230 * 1024 * 1024, 'cpu': 15},
-            'db.t3.small': {'freeable_memory': 800 * 1024 * 1024, 'cpu': 15},
-            'db.t3.medium': {'freeable_memory': 2 * 1024 * 1024 * 1024, 'cpu': 15}
-        }
+def check_region(region, region_index):
+    logger.info(f"Checking region {region} for RDS instances")
+    rds_client = get_client('rds', region_name=region)
+    cw_client = get_client('cloudwatch', region_name=region)
+    findings = []
 
-        try:
-            response = rds_client.describe_db_instances()
-            for instance in response['DBInstances']:
-                instance_id = instance['DBInstanceIdentifier']
-                db_class = instance['DBInstanceClass']
+    # Thresholds for identifying underutilized instances, relative to the capacity of their class
+    freeable_memory_ratio = float(os.environ.get('FREEABLE_MEMORY_RATIO', 0.5))
+    cpu_threshold = float(os.environ.get('CPU_THRESHOLD', 15))
 
-                if db_class in thresholds:
-                    freeable_memory = get_metric_average(cw_client, instance_id, 'FreeableMemory', start_time, end_time, 'Bytes')
-                    cpu_utilization_avg = get_metric_average(cw_client, instance_id, 'CPUUtilization', start_time, end_time, 'Percent')
-                    cpu_utilization_max = get_metric_maximum(cw_client, instance_id, 'CPUUtilization', start_time, end_time, 'Percent')
+    paginator = rds_client.get_paginator('describe_db_instances')
+    db_instances = [instance for page in paginator.paginate() for instance in page['DBInstances']]
+    region_index.record(region, len(db_instances))
+    instances = []
+    capacities = {}
+    for instance in db_instances:
+        capacity = instance_class_capacity(instance['DBInstanceClass'])
+        if capacity is None:
+            logger.warning(f"Region: {region}, RDS Instance ID: {instance['DBInstanceIdentifier']} skipped, no capacity known for {instance['DBInstanceClass']}")
+            continue
+        instances.append(instance)
+        capacities[instance['DBInstanceIdentifier']] = capacity
 
-                    underutilized = freeable_memory > thresholds[db_class]['freeable_memory'] and cpu_utilization_avg < thresholds[db_class]['cpu']
-                    if underutilized:
-                        recommendation = "strongly recommended to downsize instance." if cpu_utilization_max < 50 else "recommended to figure out spikes reason and after that downsize instance."
-                        message = f"Region: {region}, RDS Instance ID: {instance_id}, Type: {db_class} is underutilized. Freeable Memory: {round(freeable_memory / (1024 * 1024), 2)} MB, Average CPU Utilization: {round(cpu_utilization_avg, 2)}%, Maximum CPU Utilization: {round(cpu_utilization_max, 2)}%. It is {recommendation}"
-                        all_findings.append(message)
-                        logger.info(message)
+    # Hourly memory and CPU over 14 days as rolling aggregates; only days since the last run are fetched
+    rolling = RollingAggregates('RDSUnderUtilization', cw_client)
+    for instance in instances:
+        dimensions = [{'Name': 'DBInstanceIdentifier', 'Value': instance['DBInstanceIdentifier']}]
+        rolling.add((instance['DBInstanceIdentifier'], 'FreeableMemory'), 'AWS/RDS', 'FreeableMemory', dimensions, 3600, 'Average', 'Bytes')
+        for statistic in ('Average', 'Maximum'):
+            rolling.add((instance['DBInstanceIdentifier'], 'CPUUtilization', statistic), 'AWS/RDS', 'CPUUtilization', dimensions, 3600, statistic, 'Percent')
+    aggregates = rolling.fetch()
 
-        except Exception as e:
-            logger.error(f"Error in region {region}: {e}")
+    failed_instances = {key[0] for key in rolling.failed}
+    for instance in instances:
+        instance_id = instance['DBInstanceIdentifier']
+        db_class = instance['DBInstanceClass']
+        if instance_id in failed_instances:
+            # A window with a gap says nothing either way
+            continue
 
-    if len(all_findings) > 1:
-        consolidated_message = "\n".join(all_findings)
-        sns_client = boto3.client('sns')
-        sns_client.publish(TopicArn=sns_topic_arn, Message=consolidated_message)
+        freeable_memory = aggregates[(instance_id, 'FreeableMemory')].average
+        cpu_utilization_avg = aggregates[(instance_id, 'CPUUtilization', 'Average')].average
+        cpu_utilization_max = aggregates[(instance_id, 'CPUUtilization', 'Maximum')].maximum or 0
 
-    return {'statusCode': 200, 'body': 'RDS underutilization evaluation across regions completed.'}
+        capacity = capacities[instance_id]
 
-def get_metric_average(cw_client, instance_id, metric_name, start_time, end_time, unit):
-    response = cw_client.get_metric_statistics(
-        Namespace='AWS/RDS',
-        MetricName=metric_name,
-        Dimensions=[{'Name': 'DBInstanceIdentifier', 'Value': instance_id}],
-        StartTime=start_time,
-        EndTime=end_time,
-        Period=3600,
-        Statistics=['Average'],
-        Unit=unit
-    )
-    datapoints = response.get('Datapoints', [])
-    if datapoints:
-        return sum(dp['Average'] for dp in datapoints) / len(datapoints)
-    return 0
+        underutilized = freeable_memory > freeable_memory_ratio * capacity.memory_bytes and cpu_utilization_avg < cpu_threshold
+        if underutilized:
+            if cpu_utilization_max < 50:
+                recommendation, severity = "strongly recommended to downsize instance.", MEDIUM
+            else:
+                recommendation, severity = "recommended to figure out spikes reason and after that downsize instance.", LOW
+            metrics = {
+                'db_class': db_class,
+                'vcpus': capacity.vcpus,
+                'memory_gib': capacity.memory_gib,
+                'freeable_memory_mb': round(freeable_memory / (1024 * 1024), 2),
+                'cpu_average': round(cpu_utilization_avg, 2),
+                'cpu_maximum': round(cpu_utilization_max, 2),
+                'recommendation': recommendation
+            }
+            finding = Finding('RDSUnderUtilization', region, instance_id,
+                              "Region: {region}, RDS Instance ID: {resource_id}, Type: {db_class} ({vcpus} vCPU, {memory_gib} GiB) is underutilized. Freeable Memory: {freeable_memory_mb} MB, Average CPU Utilization: {cpu_average}%, Maximum CPU Utilization: {cpu_maximum}%. It is {recommendation}",
+                              metrics, severity=severity)
+            add_monthly_cost(finding, rds_instance_monthly_cost(region, instance))
+            findings.append(finding)
+            logger.info(finding.message())
 
-def get_metric_maximum(cw_client, instance_id, metric_name, start_time, end_time, unit):
-    response = cw_client.get_metric_statistics(
-        Namespace='AWS/RDS',
-        MetricName=metric_name,
-        Dimensions=[{'Name': 'DBInstanceIdentifier', 'Value': instance_id}],
-        StartTime=start_time,
-        EndTime=end_time,
-        Period=3600,
-        Statistics=['Maximum'],
-        Unit=unit
-    )
-    datapoints = response.get('Datapoints', [])
-    if datapoints:
-        return max(dp['Maximum'] for dp in datapoints)
-    return 0
\ No newline at end of file
+    if failed_instances:
+        raise RegionIncomplete(f"{len(failed_instances)} instances lack metrics", findings)
+    return findings
@@ -0,0 +1,2 @@
+# Shared helpers for the cost-optimisation Lambda functions.
+# Deployed as a Lambda layer, so every function can `import cost_optimisation`.
@@ -0,0 +1,76 @@
+import logging
+from datetime import datetime
+
+from botocore.exceptions import ClientError
+
+from cost_optimisation.dynamodb import batch_write
+
+logger = logging.getLogger()
+
+STOP_BATCH_SIZE = 1000
+
+
+class StopActionQueue:
+    # Collects stop decisions during evaluation and applies them at the end with
+    # multi-instance stop_instances calls and BatchWriteItem writes to the
+    # tracking table. flush() returns only instances that were both stopped and
+    # recorded; everything else ends up in stop_failures or record_failures.
+
+    def __init__(self, ec2_client, dynamodb_client, table_name, note):
+        self.ec2_client = ec2_client
+        self.dynamodb_client = dynamodb_client
+        self.table_name = table_name
+        self.note = note
+        self.instance_ids = []
+        self.stop_failures = {}
+        self.record_failures = []
+
+    def add(self, instance_id):
+        self.instance_ids.append(instance_id)
+
+    def flush(self):
+        stopped = []
+        for offset in range(0, len(self.instance_ids), STOP_BATCH_SIZE):
+            stopped.extend(self._stop(self.instance_ids[offset:offset + STOP_BATCH_SIZE]))
+        recorded = self._record(stopped)
+        self.instance_ids = []
+        return recorded
+
+    def _stop(self, instance_ids):
+        try:
+            response = self.ec2_client.stop_instances(InstanceIds=instance_ids)
+            stopped = [instance['InstanceId'] for instance in response['StoppingInstances']]
+            logger.info(f"Stopped {len(stopped)} instances due to low utilization.")
+            return stopped
+        except ClientError as e:
+            if len(instance_ids) == 1:
+                self.stop_failures[instance_ids[0]] = e
+                logger.error(f"Error processing instance {instance_ids[0]}: {e}")
+                return []
+            # A single bad instance fails the whole call; retry one by one to find it
+            logger.warning(f"Batch stop of {len(instance_ids)} instances failed, retrying individually: {e}")
+            stopped = []
+            for instance_id in instance_ids:
+                stopped.extend(self._stop([instance_id]))
+            return stopped
+
+    def _record(self, instance_ids):
+        timestamp = datetime.utcnow().isoformat()
+        write_requests = [
+            {
+                'PutRequest': {
+                    'Item': {
+                        'InstanceId': {'S': instance_id},
+                        'Timestamp': {'S': timestamp},
+                        'Note': {'S': self.note}
+                    }
+                }
+            }
+            for instance_id in instance_ids
+        ]
+        failed = batch_write(self.dynamodb_client, self.table_name, write_requests)
+        failed_ids = {request['PutRequest']['Item']['InstanceId']['S'] for request in failed}
+        for instance_id in sorted(failed_ids):
+            logger.error(f"Instance {instance_id} was stopped but could not be recorded in {self.table_name}")
+        self.record_failures.extend(sorted(failed_ids))
+        return [instance_id for instance_id in instance_ids if instance_id not in failed_ids]
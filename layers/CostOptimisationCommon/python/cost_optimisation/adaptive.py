@@ -0,0 +1,111 @@
+import logging
+import queue
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+
+THROTTLE_ERROR_CODES = {
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'TooManyRequestsException',
+    'RequestLimitExceeded'
+}
+
+
+def is_throttle_error(error):
+    return isinstance(error, ClientError) and error.response.get('Error', {}).get('Code') in THROTTLE_ERROR_CODES
+
+
+class AdaptiveWriter:
+    # Applies `action(item)` from a pool of worker threads while the caller keeps
+    # submitting items (e.g. from a paginator). The number of calls allowed in
+    # flight follows AIMD: +1 for every `limit` successes, halved on throttling.
+    # Throttled items are retried after a jittered backoff; other errors are
+    # logged and counted as failures.
+
+    def __init__(self, action, max_concurrency=16, initial_concurrency=2, max_attempts=8):
+        self.action = action
+        self.max_concurrency = max_concurrency
+        self.max_attempts = max_attempts
+        self.limit = float(min(initial_concurrency, max_concurrency))
+        self.succeeded = []
+        self.failed = []
+        self.throttled = 0
+        self.peak_concurrency = 0
+        self._active = 0
+        self._condition = threading.Condition()
+        self._queue = queue.Queue(maxsize=max_concurrency * 4)
+        self._started = time.monotonic()
+        self._elapsed = None
+        self._workers = [threading.Thread(target=self._work, daemon=True) for _ in range(max_concurrency)]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, item):
+        # Blocks when the queue is full, so pagination never runs far ahead of the writes
+        self._queue.put(item)
+
+    def close(self):
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._elapsed = time.monotonic() - self._started
+        return self
+
+    @property
+    def throughput(self):
+        elapsed = self._elapsed if self._elapsed is not None else time.monotonic() - self._started
+        return len(self.succeeded) / elapsed if elapsed > 0 else 0.0
+
+    def summary(self):
+        return (f"{len(self.succeeded)} succeeded, {len(self.failed)} failed, {self.throttled} throttled, "
+                f"{round(self.throughput, 1)} calls/s, peak concurrency {self.peak_concurrency}")
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            self._process(item)
+
+    def _process(self, item):
+        for attempt in range(self.max_attempts):
+            self._acquire()
+            try:
+                self.action(item)
+            except Exception as e:
+                self._release(throttled=is_throttle_error(e))
+                if not is_throttle_error(e):
+                    logger.error(f"Error processing {item}: {e}")
+                    self.failed.append(item)
+                    return
+                time.sleep(random.uniform(0, min(0.05 * 2 ** attempt, 5)))
+                continue
+            self._release(throttled=False)
+            self.succeeded.append(item)
+            return
+        logger.error(f"Giving up on {item} after {self.max_attempts} throttled attempts")
+        self.failed.append(item)
+
+    def _acquire(self):
+        with self._condition:
+            while self._active >= int(self.limit):
+                self._condition.wait()
+            self._active += 1
+            self.peak_concurrency = max(self.peak_concurrency, self._active)
+
+    def _release(self, throttled):
+        with self._condition:
+            self._active -= 1
+            if throttled:
+                self.throttled += 1
+                self.limit = max(1.0, self.limit / 2)
+            else:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+            self._condition.notify_all()
@@ -0,0 +1,120 @@
+import csv
+import gzip
+import json
+import logging
+import os
+import re
+import threading
+
+logger = logging.getLogger()
+
+DEFAULT_INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance-classes.json')
+
+GIB = 1024 * 1024 * 1024
+
+# Used when there is no index, so the classes the checks always knew about are
+# still evaluated
+BUILTIN_CAPACITIES = {
+    'db.t2.micro': (1, 1),
+    'db.t3.micro': (2, 1),
+    'db.t3.small': (2, 2),
+    'db.t3.medium': (2, 4)
+}
+
+MEMORY = re.compile(r'^\s*([\d.,]+)\s*(GiB|GB)?\s*$', re.IGNORECASE)
+
+
+class ClassCapacity:
+    # vCPUs and memory of one DB instance class
+
+    __slots__ = ('vcpus', 'memory_gib')
+
+    def __init__(self, vcpus, memory_gib):
+        self.vcpus = vcpus
+        self.memory_gib = memory_gib
+
+    @property
+    def memory_bytes(self):
+        return self.memory_gib * GIB
+
+
+_capacities = None
+_capacities_path = None
+_capacities_lock = threading.Lock()
+
+
+def get_capacities():
+    # {instance class: ClassCapacity} from the index at CAPACITY_INDEX_PATH (by
+    # default instance-classes.json next to this module, i.e. in the layer),
+    # loaded once per execution environment; BUILTIN_CAPACITIES without one
+    global _capacities, _capacities_path
+    path = os.environ.get('CAPACITY_INDEX_PATH') or DEFAULT_INDEX_PATH
+    with _capacities_lock:
+        if _capacities is None or _capacities_path != path:
+            classes = BUILTIN_CAPACITIES
+            if os.path.exists(path):
+                try:
+                    with open(path) as index_file:
+                        classes = json.load(index_file)['classes'] or BUILTIN_CAPACITIES
+                except (OSError, ValueError, KeyError) as e:
+                    logger.error(f"Error reading capacity index {path}: {e}")
+            _capacities = {db_class: ClassCapacity(*spec) for db_class, spec in classes.items()}
+            _capacities_path = path
+        return _capacities
+
+
+def instance_class_capacity(db_class):
+    # None for classes the index does not know
+    return get_capacities().get(db_class)
+
+
+def build_capacity_index(spec_paths, output_path):
+    # Reads DB instance class specs from CSV files (optionally gzip-compressed)
+    # with "Instance Type", "vCPU" and "Memory" columns, such as the AWS bulk
+    # pricing offer for AmazonRDS, and writes them to an index file. Returns
+    # the number of classes written.
+    classes = {}
+    for path in spec_paths:
+        for db_class, vcpus, memory_gib in iter_class_specs(path):
+            previous = classes.setdefault(db_class, (vcpus, memory_gib))
+            if previous != (vcpus, memory_gib):
+                logger.warning(f"Conflicting specs for {db_class}: {previous} and {(vcpus, memory_gib)}, keeping the first")
+
+    partial_path = f"{output_path}.partial"
+    with open(partial_path, 'w') as output:
+        json.dump({'classes': dict(sorted(classes.items()))}, output)
+    os.replace(partial_path, output_path)
+    return len(classes)
+
+
+def iter_class_specs(path):
+    # Yields (instance class, vCPUs, memory in GiB) for every row describing a
+    # DB instance class; rows without usable specs are skipped
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8', newline='') as spec_file:
+        reader = csv.reader(spec_file)
+        # Offer files have metadata lines before the header row
+        for row in reader:
+            if {'Instance Type', 'vCPU', 'Memory'}.issubset(row):
+                columns = {name: position for position, name in enumerate(row)}
+                break
+        else:
+            logger.warning(f"{path} has no Instance Type, vCPU and Memory columns, skipping it")
+            return
+
+        def value(row, name):
+            position = columns.get(name)
+            return row[position].strip() if position is not None and position < len(row) else ''
+
+        for row in reader:
+            db_class = value(row, 'Instance Type')
+            if not db_class.startswith('db.'):
+                continue
+            memory = MEMORY.match(value(row, 'Memory'))
+            try:
+                vcpus = int(value(row, 'vCPU'))
+                memory_gib = float(memory.group(1).replace(',', '')) if memory else 0
+            except ValueError:
+                continue
+            if vcpus > 0 and memory_gib > 0:
+                yield db_class, vcpus, memory_gib
@@ -0,0 +1,230 @@
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+from functools import partial
+
+from botocore.exceptions import ClientError
+
+from cost_optimisation.clients import get_client
+from cost_optimisation.fanout import get_region_concurrency, map_concurrently
+from cost_optimisation.findings import pack_findings, unpack_findings
+from cost_optimisation.invocation import invoke_async
+
+logger = logging.getLogger()
+
+DEFAULT_RESERVE_SECONDS = 60
+DEFAULT_MAX_AGE_HOURS = 24
+DEFAULT_MAX_INVOCATIONS = 12
+
+
+class SweepPaused(Exception):
+    # Raised by a region worker that ran out of time part-way through a region.
+    # `token` is where the next invocation picks the region up again (see
+    # SweepCheckpoint.cursor) and `findings` are those gathered so far.
+
+    def __init__(self, token, findings=None):
+        super().__init__(f"Paused at {token}")
+        self.token = token
+        self.findings = findings or []
+
+
+class RegionIncomplete(Exception):
+    # Raised by a region worker that finished a region without being able to
+    # check all of it, e.g. because some of its resources could not be
+    # described. `findings` are those it did gather; the region is reported
+    # with them but counts as failed, so findings it may have missed are not
+    # taken as resolved.
+
+    def __init__(self, reason, findings=None):
+        super().__init__(reason)
+        self.findings = findings or []
+
+
+class SweepCheckpoint:
+    # Lets a region sweep span several invocations. Regions are only started
+    # while more than CHECKPOINT_RESERVE_SECONDS of the invocation remain; when
+    # the sweep runs out of time, the unfinished regions, per-region cursors and
+    # findings so far are stored in the table named by CHECKPOINT_TABLE_NAME and
+    # the function invokes itself to carry on. The report only goes out once
+    # every region is done. Checkpoints older than CHECKPOINT_MAX_AGE_HOURS are
+    # dropped, and self-invocation stops after CHECKPOINT_MAX_INVOCATIONS, leaving
+    # the rest to the next scheduled run. Without a table, every region runs.
+    # Regions whose worker raised are done but also `failed`: their findings are
+    # incomplete. If the checkpoint cannot be saved, the sweep returns the
+    # findings of the finished regions instead, and the rest are `unswept`.
+    # Time is only checked as a region starts, so each region has to fit in the
+    # reserve; only workers that raise SweepPaused (CloudwatchLogGroupRetention)
+    # can stop part-way through one.
+
+    def __init__(self, check_name, context, event=None):
+        self.check_name = check_name
+        self.context = context
+        self.event = event if event is not None else {}
+        self.table_name = os.environ.get('CHECKPOINT_TABLE_NAME')
+        self.reserve_ms = int(os.environ.get('CHECKPOINT_RESERVE_SECONDS', DEFAULT_RESERVE_SECONDS)) * 1000
+        self.max_age = timedelta(hours=float(os.environ.get('CHECKPOINT_MAX_AGE_HOURS', DEFAULT_MAX_AGE_HOURS)))
+        self.max_invocations = int(os.environ.get('CHECKPOINT_MAX_INVOCATIONS', DEFAULT_MAX_INVOCATIONS))
+        self.regions = None
+        self.done = set()
+        self.failed = set()
+        self.cursors = {}
+        self.findings = {}
+        self.started_at = datetime.utcnow()
+        self.invocations = 0
+        # Whether sweep() handed the rest of the work to a new invocation
+        self.resumed = False
+        self._stored_invocations = None
+        self._lock = threading.Lock()
+
+    def has_time(self):
+        if not self.table_name or self.context is None:
+            return True
+        return self.context.get_remaining_time_in_millis() > self.reserve_ms
+
+    def cursor(self, region):
+        return self.cursors.get(region)
+
+    @property
+    def unswept(self):
+        # Regions the findings do not fully cover: failed or never finished
+        return [region for region in self.regions or [] if region not in self.done or region in self.failed]
+
+    def sweep(self, regions, worker):
+        # Returns the findings of every region in order once the sweep is
+        # complete, or None if it was checkpointed to finish later
+        self._load()
+        if self.regions is None:
+            self.regions = list(regions)
+        else:
+            logger.info(f"Resuming {self.check_name} sweep started at {self.started_at.isoformat()}, "
+                        f"{len(self.regions) - len(self.done)} of {len(self.regions)} regions left")
+
+        pending = [region for region in self.regions if region not in self.done]
+        map_concurrently(partial(self._run_region, worker), pending, get_region_concurrency())
+
+        if len(self.done) == len(self.regions):
+            self._delete()
+            return [finding for region in self.regions for finding in self.findings.get(region, [])]
+
+        logger.info(f"Out of time for {self.check_name}, checkpointing {len(self.regions) - len(self.done)} unfinished regions")
+        saved = self._save()
+        if saved:
+            self._resume()
+            return None
+        if saved is None:
+            # Another invocation holds a newer checkpoint and carries the sweep on
+            return None
+        # Nothing would resume the sweep, so report what is there rather than lose it
+        logger.error(f"Reporting {self.check_name} without its {len(self.regions) - len(self.done)} unfinished regions")
+        self._delete()
+        return [finding for region in self.regions if region in self.done for finding in self.findings.get(region, [])]
+
+    def _run_region(self, worker, region):
+        if not self.has_time():
+            return
+        failed = False
+        try:
+            findings = worker(region) or []
+        except SweepPaused as paused:
+            with self._lock:
+                self.cursors[region] = paused.token
+                self.findings.setdefault(region, []).extend(paused.findings)
+            return
+        except RegionIncomplete as incomplete:
+            logger.error(f"Region {region} was only partly checked: {incomplete}")
+            findings, failed = incomplete.findings, True
+        except Exception as e:
+            logger.error(f"Error in region {region}: {e}")
+            findings, failed = [], True
+        with self._lock:
+            self.done.add(region)
+            if failed:
+                self.failed.add(region)
+            self.cursors.pop(region, None)
+            self.findings.setdefault(region, []).extend(findings)
+
+    def _load(self):
+        if not self.table_name:
+            return
+        try:
+            item = get_client('dynamodb').get_item(
+                TableName=self.table_name,
+                Key={'CheckName': {'S': self.check_name}},
+                ConsistentRead=True
+            ).get('Item')
+        except ClientError as e:
+            logger.error(f"Error loading checkpoint for {self.check_name}: {e}")
+            return
+        if not item:
+            return
+        started_at = datetime.fromisoformat(item['StartedAt']['S'])
+        self._stored_invocations = int(item['Invocations']['N'])
+        if datetime.utcnow() - started_at > self.max_age:
+            logger.warning(f"Discarding checkpoint for {self.check_name} from {started_at.isoformat()}")
+            return
+        self.started_at = started_at
+        self.invocations = self._stored_invocations
+        self.regions = [region['S'] for region in item['Regions']['L']]
+        self.done = {region['S'] for region in item['Done']['L']}
+        self.failed = {region['S'] for region in item.get('Failed', {}).get('L', [])}
+        self.cursors = {region: value['S'] for region, value in item['Cursors']['M'].items()}
+        self.findings = unpack_findings(item['Findings']['B'])
+
+    def _save(self):
+        # Findings are compressed to stay well clear of the 400 KB item limit.
+        # The condition keeps two overlapping invocations from clobbering each
+        # other's progress. Returns True once saved, None if another invocation
+        # got there first and False if the checkpoint could not be saved.
+        item = {
+            'CheckName': {'S': self.check_name},
+            'StartedAt': {'S': self.started_at.isoformat()},
+            'Invocations': {'N': str(self.invocations + 1)},
+            'Regions': {'L': [{'S': region} for region in self.regions]},
+            'Done': {'L': [{'S': region} for region in sorted(self.done)]},
+            'Failed': {'L': [{'S': region} for region in sorted(self.failed)]},
+            'Cursors': {'M': {region: {'S': token} for region, token in self.cursors.items()}},
+            'Findings': {'B': pack_findings(self.findings)}
+        }
+        if self._stored_invocations is None:
+            condition = {'ConditionExpression': 'attribute_not_exists(CheckName)'}
+        else:
+            condition = {
+                'ConditionExpression': 'Invocations = :invocations',
+                'ExpressionAttributeValues': {':invocations': {'N': str(self._stored_invocations)}}
+            }
+        dynamodb_client = get_client('dynamodb')
+        try:
+            dynamodb_client.put_item(TableName=self.table_name, Item=item, **condition)
+        except dynamodb_client.exceptions.ConditionalCheckFailedException:
+            logger.warning(f"Checkpoint for {self.check_name} was saved by another invocation")
+            return None
+        except ClientError as e:
+            logger.error(f"Error saving checkpoint for {self.check_name}: {e}")
+            return False
+        self.invocations += 1
+        return True
+
+    def _delete(self):
+        if self._stored_invocations is None:
+            return
+        try:
+            get_client('dynamodb').delete_item(
+                TableName=self.table_name,
+                Key={'CheckName': {'S': self.check_name}}
+            )
+        except ClientError as e:
+            logger.error(f"Error deleting checkpoint for {self.check_name}: {e}")
+
+    def _resume(self):
+        if os.environ.get('CHECKPOINT_SELF_INVOKE', 'true').lower() != 'true' or self.context is None:
+            return
+        if self.invocations >= self.max_invocations:
+            logger.warning(f"{self.check_name} sweep reached {self.invocations} invocations, leaving the rest to the next scheduled run")
+            return
+        try:
+            # Resend the original event, so a shard worker resumes as that shard
+            invoke_async(self.context, dict(self.event, checkpoint=self.check_name))
+            self.resumed = True
+        except ClientError as e:
+            logger.error(f"Error invoking {self.check_name} to resume its sweep: {e}")
@@ -0,0 +1,54 @@
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+
+from cost_optimisation.ratelimit import attach_rate_limiter
+
+# Shared by every pooled client: a connection pool large enough for the region
+# fan-out and worker pools, adaptive client-side retries and TCP keep-alive.
+# Pooled clients also draw from the shared rate limiter (see ratelimit.py).
+DEFAULT_CONFIG = Config(
+    max_pool_connections=int(os.environ.get('CLIENT_MAX_POOL_CONNECTIONS', 50)),
+    retries={'mode': 'adaptive', 'max_attempts': 10},
+    tcp_keepalive=True
+)
+
+# Clients live at module level, so warm invocations reuse them together with
+# their open TLS connections. One session creates them all under a lock, since
+# boto3 sessions are not thread-safe; the clients themselves are.
+_session = None
+_clients = {}
+_lock = threading.Lock()
+
+
+def get_session():
+    global _session
+    with _lock:
+        if _session is None:
+            _session = boto3.session.Session()
+        return _session
+
+
+def get_client(service_name, region_name=None, config=None):
+    session = get_session()
+    credentials = session.get_credentials()
+    # Keyed by access key too, so rotated credentials get fresh clients
+    key = (service_name, region_name, credentials.access_key if credentials else None, id(config) if config else None)
+
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            client_config = DEFAULT_CONFIG.merge(config) if config else DEFAULT_CONFIG
+            client = session.client(service_name, region_name=region_name, config=client_config)
+            attach_rate_limiter(client, service_name)
+            _clients[key] = client
+        return client
+
+
+def clear_clients():
+    global _session
+    with _lock:
+        _clients.clear()
+        _session = None
@@ -0,0 +1,52 @@
+import logging
+import time
+
+from cost_optimisation.fanout import map_concurrently
+
+logger = logging.getLogger()
+
+# BatchWriteItem accepts at most 25 requests per call
+BATCH_WRITE_SIZE = 25
+BATCH_WRITE_ATTEMPTS = 5
+
+
+def scan_all(dynamodb_client, table_name, total_segments=4):
+    # Parallel scan: each segment is paginated on its own thread, so tables larger
+    # than one 1 MB scan page are read completely
+    segments = map_concurrently(
+        lambda segment: _scan_segment(dynamodb_client, table_name, segment, total_segments),
+        range(total_segments),
+        total_segments
+    )
+    return [item for items in segments for item in items]
+
+
+def _scan_segment(dynamodb_client, table_name, segment, total_segments):
+    paginator = dynamodb_client.get_paginator('scan')
+    items = []
+    for page in paginator.paginate(TableName=table_name, Segment=segment, TotalSegments=total_segments):
+        items.extend(page['Items'])
+    return items
+
+
+def batch_write(dynamodb_client, table_name, write_requests):
+    # Send PutRequest/DeleteRequest entries 25 at a time, retrying unprocessed
+    # items with exponential backoff. Returns the requests that never went through.
+    failed = []
+    for offset in range(0, len(write_requests), BATCH_WRITE_SIZE):
+        pending = write_requests[offset:offset + BATCH_WRITE_SIZE]
+        for attempt in range(BATCH_WRITE_ATTEMPTS):
+            if attempt:
+                time.sleep(min(0.1 * 2 ** attempt, 2))
+            try:
+                response = dynamodb_client.batch_write_item(RequestItems={table_name: pending})
+            except dynamodb_client.exceptions.ProvisionedThroughputExceededException as e:
+                logger.warning(f"Throttled writing to {table_name}, retrying: {e}")
+                continue
+            pending = response.get('UnprocessedItems', {}).get(table_name, [])
+            if not pending:
+                break
+        if pending:
+            logger.error(f"Failed to write {len(pending)} items to {table_name} after {BATCH_WRITE_ATTEMPTS} attempts")
+            failed.extend(pending)
+    return failed
@@ -0,0 +1,52 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from cost_optimisation.clients import get_client
+
+logger = logging.getLogger()
+
+DEFAULT_REGION_CONCURRENCY = 8
+
+
+def get_region_concurrency():
+    try:
+        return max(1, int(os.environ.get('REGION_CONCURRENCY', DEFAULT_REGION_CONCURRENCY)))
+    except ValueError:
+        logger.warning(f"Invalid REGION_CONCURRENCY value, using {DEFAULT_REGION_CONCURRENCY}")
+        return DEFAULT_REGION_CONCURRENCY
+
+
+def list_regions():
+    ec2_client = get_client('ec2')
+    return [region['RegionName'] for region in ec2_client.describe_regions()['Regions']]
+
+
+def map_concurrently(func, items, max_workers):
+    # Like map(), but on a bounded thread pool. Results keep the order of `items`.
+    items = list(items)
+    if not items:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(func, items))
+
+
+def fan_out_regions(regions, worker, max_workers=None):
+    # Run worker(region) on a bounded thread pool. Each worker returns a list of
+    # findings; a failing region is logged and contributes nothing. Findings are
+    # merged in the order of `regions`, regardless of completion order.
+    results = map_concurrently(partial(_run_region, worker), regions, max_workers or get_region_concurrency())
+
+    findings = []
+    for region_findings in results:
+        findings.extend(region_findings)
+    return findings
+
+
+def _run_region(worker, region):
+    try:
+        return worker(region) or []
+    except Exception as e:
+        logger.error(f"Error in region {region}: {e}")
+        return []
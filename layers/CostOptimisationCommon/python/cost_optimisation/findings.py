@@ -0,0 +1,198 @@
+import hashlib
+import json
+import logging
+import os
+import zlib
+
+from botocore.exceptions import ClientError
+
+from cost_optimisation.clients import get_client
+from cost_optimisation.dynamodb import batch_write
+
+logger = logging.getLogger()
+
+# Severities, least to most urgent. INFO is for actions a function has taken.
+INFO = 'info'
+LOW = 'low'
+MEDIUM = 'medium'
+HIGH = 'high'
+
+DEFAULT_CHANGE_TOLERANCE = 0.1
+
+
+class Finding:
+    # One issue with one resource. `template` is a str.format() pattern over
+    # `region`, `resource_id` and the `metrics`; it is only rendered when the
+    # report goes out. `kind` tells apart several findings a check can raise
+    # for the same resource.
+
+    __slots__ = ('check', 'region', 'resource_id', 'template', 'metrics', 'severity', 'kind')
+
+    def __init__(self, check, region, resource_id, template, metrics=None, severity=MEDIUM, kind=''):
+        self.check = check
+        self.region = region
+        self.resource_id = resource_id
+        self.template = template
+        self.metrics = metrics or {}
+        self.severity = severity
+        self.kind = kind
+
+    @property
+    def fingerprint(self):
+        # Identity only, so a finding keeps its fingerprint while its metrics
+        # and severity move between runs
+        identity = '\x1f'.join((self.check, self.region, self.resource_id, self.kind))
+        return hashlib.sha1(identity.encode('utf-8')).hexdigest()[:20]
+
+    def message(self):
+        return self.template.format(region=self.region, resource_id=self.resource_id, **self.metrics)
+
+    def __str__(self):
+        return self.message()
+
+    def differs_from(self, severity, metrics, tolerance=DEFAULT_CHANGE_TOLERANCE):
+        # Numeric metrics count as changed when they move by more than
+        # `tolerance` relative to the larger value; anything else on inequality
+        if severity != self.severity or metrics.keys() != self.metrics.keys():
+            return True
+        for name, value in self.metrics.items():
+            previous = metrics[name]
+            if _is_number(value) and _is_number(previous):
+                if abs(value - previous) > tolerance * max(abs(value), abs(previous)):
+                    return True
+            elif value != previous:
+                return True
+        return False
+
+    def to_record(self):
+        return [self.check, self.region, self.resource_id, self.template, self.metrics, self.severity, self.kind]
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(*record)
+
+
+class FindingsDelta:
+    # Findings of this run compared with the previous one. `changed` holds
+    # (finding, previous entry) pairs and `resolved` previous entries, each a
+    # dict with Region, ResourceId, Severity, Metrics and Message.
+
+    __slots__ = ('new', 'changed', 'resolved', 'unchanged')
+
+    def __init__(self):
+        self.new = []
+        self.changed = []
+        self.resolved = []
+        self.unchanged = 0
+
+    def __bool__(self):
+        return bool(self.new or self.changed or self.resolved)
+
+
+class FindingsIndex:
+    # The findings a check reported last time, kept in the table named by
+    # FINDINGS_INDEX_TABLE_NAME as one item per fingerprint under the check's
+    # partition. compare() splits a run's findings into new, changed and
+    # unchanged ones, and previous findings in the swept regions that are gone
+    # into resolved ones; update() then moves the index to this run.
+
+    def __init__(self, check_name, table_name):
+        self.check_name = check_name
+        self.table_name = table_name
+        self.tolerance = float(os.environ.get('FINDINGS_CHANGE_TOLERANCE', DEFAULT_CHANGE_TOLERANCE))
+
+    def compare(self, findings, regions):
+        # None when the previous run cannot be read
+        previous = self._load()
+        if previous is None:
+            return None
+
+        current = {}
+        for finding in findings:
+            current.setdefault(finding.fingerprint, finding)
+
+        delta = FindingsDelta()
+        for fingerprint, finding in current.items():
+            entry = previous.get(fingerprint)
+            if entry is None:
+                delta.new.append(finding)
+            elif finding.differs_from(entry['Severity'], entry['Metrics'], self.tolerance):
+                delta.changed.append((finding, entry))
+            else:
+                delta.unchanged += 1
+
+        regions = set(regions)
+        delta.resolved = [
+            entry for fingerprint, entry in previous.items()
+            if fingerprint not in current and entry['Region'] in regions
+        ]
+        return delta
+
+    def update(self, delta):
+        # Unchanged findings keep their stored metrics, so slow drift still
+        # shows up once it adds up to more than the tolerance
+        write_requests = [
+            {'PutRequest': {'Item': self._item(finding)}}
+            for finding in delta.new + [finding for finding, _ in delta.changed]
+        ]
+        write_requests.extend(
+            {'DeleteRequest': {'Key': {'Check': {'S': self.check_name}, 'Fingerprint': {'S': entry['Fingerprint']}}}}
+            for entry in delta.resolved
+        )
+        failed = batch_write(get_client('dynamodb'), self.table_name, write_requests)
+        if failed:
+            logger.warning(f"Could not update {len(failed)} entries of the {self.check_name} findings index")
+
+    def _load(self):
+        previous = {}
+        paginator = get_client('dynamodb').get_paginator('query')
+        try:
+            pages = paginator.paginate(
+                TableName=self.table_name,
+                KeyConditionExpression='#check = :check',
+                ExpressionAttributeNames={'#check': 'Check'},
+                ExpressionAttributeValues={':check': {'S': self.check_name}}
+            )
+            for page in pages:
+                for item in page['Items']:
+                    previous[item['Fingerprint']['S']] = {
+                        'Fingerprint': item['Fingerprint']['S'],
+                        'Region': item['Region']['S'],
+                        'ResourceId': item['ResourceId']['S'],
+                        'Severity': item['Severity']['S'],
+                        'Metrics': json.loads(item['Metrics']['S']),
+                        'Message': item['Message']['S']
+                    }
+        except ClientError as e:
+            logger.error(f"Error loading the findings index for {self.check_name}: {e}")
+            return None
+        return previous
+
+    def _item(self, finding):
+        return {
+            'Check': {'S': self.check_name},
+            'Fingerprint': {'S': finding.fingerprint},
+            'Region': {'S': finding.region},
+            'ResourceId': {'S': finding.resource_id},
+            'Severity': {'S': finding.severity},
+            'Metrics': {'S': json.dumps(finding.metrics, default=str)},
+            # Rendered once here, to describe the finding when it is resolved
+            'Message': {'S': finding.message()}
+        }
+
+
+def pack_findings(findings):
+    # Compressed JSON of a list of findings, or of a dict of such lists, for
+    # checkpoints and shard results
+    return zlib.compress(json.dumps(findings, default=Finding.to_record).encode())
+
+
+def unpack_findings(blob):
+    data = json.loads(zlib.decompress(blob))
+    if isinstance(data, dict):
+        return {key: [Finding.from_record(record) for record in records] for key, records in data.items()}
+    return [Finding.from_record(record) for record in data]
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
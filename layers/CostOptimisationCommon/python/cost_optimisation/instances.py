@@ -0,0 +1,36 @@
+import logging
+import re
+
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+
+DESCRIBE_INSTANCES_BATCH_SIZE = 1000
+
+_INSTANCE_ID_PATTERN = re.compile(r'i-[0-9a-f]+')
+
+
+def get_instance_states(ec2_client, instance_ids):
+    # Map instance ID to state name with up to 1000 IDs per describe_instances call.
+    # IDs EC2 no longer knows about are left out of the result.
+    instance_states = {}
+    for offset in range(0, len(instance_ids), DESCRIBE_INSTANCES_BATCH_SIZE):
+        pending = list(instance_ids[offset:offset + DESCRIBE_INSTANCES_BATCH_SIZE])
+        while pending:
+            try:
+                paginator = ec2_client.get_paginator('describe_instances')
+                for page in paginator.paginate(InstanceIds=pending):
+                    for reservation in page['Reservations']:
+                        for instance in reservation['Instances']:
+                            instance_states[instance['InstanceId']] = instance['State']['Name']
+                break
+            except ClientError as e:
+                # A single unknown ID fails the whole call; drop the IDs named in the error and retry
+                if not e.response['Error']['Code'].startswith('InvalidInstanceID'):
+                    raise
+                missing = set(_INSTANCE_ID_PATTERN.findall(e.response['Error'].get('Message', '')))
+                if not missing & set(pending):
+                    raise
+                logger.info(f"Skipping unknown instances: {', '.join(sorted(missing))}")
+                pending = [instance_id for instance_id in pending if instance_id not in missing]
+    return instance_states
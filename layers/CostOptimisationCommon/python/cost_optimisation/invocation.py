@@ -0,0 +1,67 @@
+import json
+import threading
+import time
+from collections import deque
+
+from cost_optimisation.clients import get_client
+
+# Every asynchronous invocation a function makes of itself (checkpoint resumes,
+# shard workers) goes through invoke_async, so a local run can swap Lambda for
+# an in-process stand-in with set_invoker(LocalInvoker(...)).
+_invoker = None
+
+
+def lambda_invoker(function_arn, payload):
+    get_client('lambda').invoke(
+        FunctionName=function_arn,
+        InvocationType='Event',
+        Payload=json.dumps(payload)
+    )
+
+
+def set_invoker(invoker):
+    # invoker(function_arn, payload); None restores real Lambda invocations
+    global _invoker
+    _invoker = invoker
+
+
+def invoke_async(context, payload):
+    (_invoker or lambda_invoker)(context.invoked_function_arn, payload)
+
+
+class LocalContext:
+    # Just enough of the Lambda context object for the handlers
+    def __init__(self, function_arn='arn:aws:lambda:us-east-1:123456789012:function:local', timeout_seconds=300):
+        self.invoked_function_arn = function_arn
+        self.function_name = function_arn.rsplit(':', 1)[-1]
+        self.deadline = time.monotonic() + timeout_seconds
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.deadline - time.monotonic()) * 1000))
+
+
+class LocalInvoker:
+    # In-process stand-in for asynchronous Lambda invocations. Payloads are
+    # queued (after a JSON round trip, as Lambda would deliver them) and run one
+    # after another by drain(), each with a fresh context from context_factory.
+
+    def __init__(self, handler, context_factory=LocalContext):
+        self.handler = handler
+        self.context_factory = context_factory
+        self.queue = deque()
+        self.invocations = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, function_arn, payload):
+        with self._lock:
+            self.queue.append((function_arn, json.loads(json.dumps(payload))))
+
+    def drain(self):
+        results = []
+        while True:
+            with self._lock:
+                if not self.queue:
+                    return results
+                function_arn, payload = self.queue.popleft()
+            self.invocations += 1
+            results.append(self.handler(payload, self.context_factory(function_arn)))
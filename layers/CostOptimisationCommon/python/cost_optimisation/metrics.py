@@ -0,0 +1,117 @@
+import logging
+
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+
+# GetMetricData accepts at most 500 queries per request
+MAX_QUERIES_PER_REQUEST = 500
+
+
+class MetricDataBatch:
+    # Collects metric queries and resolves them with as few GetMetricData calls
+    # as possible. Results come back in the get_metric_statistics datapoint shape
+    # ({'Timestamp': ..., '<Statistic>': value}) so existing helpers keep working.
+
+    def __init__(self, cw_client, start_time, end_time):
+        self.cw_client = cw_client
+        self.start_time = start_time
+        self.end_time = end_time
+        self._queries = []
+        # Keys whose queries failed in the last fetch(), as opposed to having no data
+        self.failed = set()
+
+    def add(self, key, namespace, metric_name, dimensions, period, statistic, unit=None):
+        metric_stat = {
+            'Metric': {
+                'Namespace': namespace,
+                'MetricName': metric_name,
+                'Dimensions': dimensions
+            },
+            'Period': period,
+            'Stat': statistic
+        }
+        if unit:
+            metric_stat['Unit'] = unit
+        self._queries.append((key, statistic, metric_stat))
+
+    def __len__(self):
+        return len(self._queries)
+
+    def fetch(self):
+        datapoints = {key: [] for key, _, _ in self._queries}
+        self.failed = set()
+        for offset in range(0, len(self._queries), MAX_QUERIES_PER_REQUEST):
+            chunk = self._queries[offset:offset + MAX_QUERIES_PER_REQUEST]
+            try:
+                self._fetch_chunk(chunk, datapoints)
+            except ClientError as e:
+                logger.error(f"Error fetching {len(chunk)} metric queries: {e}")
+                self.failed.update(key for key, _, _ in chunk)
+        return datapoints
+
+    def _fetch_chunk(self, chunk, datapoints):
+        # Query ids only need to be unique within a request
+        queries_by_id = {f"q{index}": (key, statistic) for index, (key, statistic, _) in enumerate(chunk)}
+        request = {
+            'MetricDataQueries': [
+                {'Id': f"q{index}", 'MetricStat': metric_stat, 'ReturnData': True}
+                for index, (_, _, metric_stat) in enumerate(chunk)
+            ],
+            'StartTime': self.start_time,
+            'EndTime': self.end_time
+        }
+
+        while True:
+            response = self.cw_client.get_metric_data(**request)
+            for result in response['MetricDataResults']:
+                key, statistic = queries_by_id[result['Id']]
+                datapoints[key].extend(
+                    {'Timestamp': timestamp, statistic: value}
+                    for timestamp, value in zip(result['Timestamps'], result['Values'])
+                )
+            next_token = response.get('NextToken')
+            if not next_token:
+                break
+            request['NextToken'] = next_token
+
+
+class MetricStatistics:
+    # get_metric_statistics with every needed statistic in one call, memoized by
+    # (namespace, metric, dimensions, window, period) for the life of the object.
+    # Create one per invocation so repeated lookups of a series cost nothing.
+
+    def __init__(self, cw_client):
+        self.cw_client = cw_client
+        self._cache = {}
+
+    def get(self, namespace, metric_name, dimensions, start_time, end_time, period, statistics, unit=None):
+        key = (
+            namespace,
+            metric_name,
+            tuple(sorted((dimension['Name'], dimension['Value']) for dimension in dimensions)),
+            start_time,
+            end_time,
+            period,
+            unit
+        )
+        cached = self._cache.get(key)
+        if cached and set(statistics) <= cached[0]:
+            return cached[1]
+
+        # Widen the request so earlier statistics for this series stay available
+        requested = set(statistics) | (cached[0] if cached else set())
+        request = {
+            'Namespace': namespace,
+            'MetricName': metric_name,
+            'Dimensions': dimensions,
+            'StartTime': start_time,
+            'EndTime': end_time,
+            'Period': period,
+            'Statistics': sorted(requested)
+        }
+        if unit:
+            request['Unit'] = unit
+        datapoints = self.cw_client.get_metric_statistics(**request).get('Datapoints', [])
+        self._cache[key] = (requested, datapoints)
+        return datapoints
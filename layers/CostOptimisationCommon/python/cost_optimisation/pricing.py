@@ -0,0 +1,272 @@
+import csv
+import gzip
+import heapq
+import logging
+import mmap
+import os
+import re
+import struct
+import tempfile
+import threading
+
+logger = logging.getLogger()
+
+HOURS_PER_MONTH = 730
+
+# Index file: header, then fixed-width records sorted by key. Each record is
+# the NUL-padded key "<offer>|<region>|<key>" followed by the hourly USD price.
+MAGIC = b'COPRIDX1'
+HEADER = struct.Struct('<8sII')
+PRICE = struct.Struct('<d')
+KEY_WIDTH = 96
+CHUNK_RECORDS = 200000
+
+DEFAULT_INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'price-index.bin')
+
+HOURLY_UNITS = {'hrs', 'hour', 'hours'}
+
+# Usage types carry a region prefix ("USE1-", "EU-", ...), except in us-east-1
+USAGE_TYPE_REGION_PREFIX = re.compile(r'^[A-Z]{2,4}\d?-')
+
+# RDS API engine names as they appear in the RDS offer
+RDS_ENGINES = {
+    'mysql': 'MySQL',
+    'postgres': 'PostgreSQL',
+    'mariadb': 'MariaDB',
+    'aurora-mysql': 'Aurora MySQL',
+    'aurora-postgresql': 'Aurora PostgreSQL'
+}
+
+
+class PriceIndex:
+    # Read-only lookups in an index written by build_price_index(). The file is
+    # memory-mapped and binary-searched, so lookups read a few pages and the
+    # mapping is shared by every thread and warm invocation.
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as index_file:
+            self._map = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.key_width, self.count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a price index")
+        self.record_size = self.key_width + PRICE.size
+
+    def hourly(self, offer, region, key):
+        # Hourly on-demand USD price, or None if the index has none
+        needle = _index_key(offer, region, key)
+        if len(needle) > self.key_width:
+            return None
+        needle = needle.ljust(self.key_width, b'\0')
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            offset = HEADER.size + middle * self.record_size
+            if self._map[offset:offset + self.key_width] < needle:
+                low = middle + 1
+            else:
+                high = middle
+        offset = HEADER.size + low * self.record_size
+        if low < self.count and self._map[offset:offset + self.key_width] == needle:
+            return PRICE.unpack_from(self._map, offset + self.key_width)[0]
+        return None
+
+    def monthly(self, offer, region, key):
+        hourly = self.hourly(offer, region, key)
+        return hourly * HOURS_PER_MONTH if hourly is not None else None
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_price_index():
+    # The index at PRICE_INDEX_PATH (by default price-index.bin next to this
+    # module, i.e. in the layer), or None when there is none
+    global _index
+    path = os.environ.get('PRICE_INDEX_PATH') or DEFAULT_INDEX_PATH
+    with _index_lock:
+        if _index is None or _index.path != path:
+            if not os.path.exists(path):
+                return None
+            try:
+                _index = PriceIndex(path)
+            except (OSError, ValueError) as e:
+                logger.error(f"Error opening price index {path}: {e}")
+                return None
+        return _index
+
+
+def ec2_instance_monthly_cost(region, instance_type):
+    # Linux, shared tenancy
+    index = get_price_index()
+    return index.monthly('AmazonEC2', region, instance_type) if index else None
+
+
+def rds_instance_monthly_cost(region, instance):
+    index = get_price_index()
+    engine = RDS_ENGINES.get(instance.get('Engine'))
+    if not index or not engine:
+        return None
+    deployment = 'Multi-AZ' if instance.get('MultiAZ') else 'Single-AZ'
+    return index.monthly('AmazonRDS', region, f"{instance['DBInstanceClass']}:{engine}:{deployment}")
+
+
+def elastic_ip_monthly_cost(region):
+    # Public IPv4 addresses are billed under AmazonVPC; older offer files only
+    # have the EC2 Elastic IP usage type
+    index = get_price_index()
+    if not index:
+        return None
+    cost = index.monthly('AmazonVPC', region, 'PublicIPv4:IdleAddress')
+    return cost if cost is not None else index.monthly('AmazonEC2', region, 'ElasticIP:IdleAddress')
+
+
+def fargate_monthly_cost(region, vcpus, memory_gb):
+    index = get_price_index()
+    if not index:
+        return None
+    vcpu_price = index.monthly('AmazonECS', region, 'Fargate-vCPU-Hours:perCPU')
+    memory_price = index.monthly('AmazonECS', region, 'Fargate-GB-Hours')
+    if vcpu_price is None or memory_price is None:
+        return None
+    return vcpus * vcpu_price + memory_gb * memory_price
+
+
+def add_monthly_cost(finding, monthly_cost):
+    # Records the cost of the resource on the finding and in its message
+    if monthly_cost is None:
+        return finding
+    finding.metrics['monthly_cost'] = round(monthly_cost, 2)
+    finding.template += " Estimated cost: ${monthly_cost:.2f} per month."
+    return finding
+
+
+def build_price_index(offer_paths, output_path, chunk_records=CHUNK_RECORDS):
+    # Streams AWS bulk pricing offer files (CSV, optionally gzip-compressed) row
+    # by row into an index file. At most `chunk_records` prices are held at a
+    # time: full chunks are sorted and spilled to temporary files, which are
+    # then merged. Where several rows share a key, the lowest price wins.
+    # Returns the number of records written.
+    spill_dir = tempfile.mkdtemp(prefix='price-index-', dir=os.path.dirname(os.path.abspath(output_path)))
+    spills = []
+    chunk = {}
+    skipped = 0
+    try:
+        for path in offer_paths:
+            for offer, region, key, hourly in iter_offer_prices(path):
+                index_key = _index_key(offer, region, key)
+                if len(index_key) > KEY_WIDTH:
+                    skipped += 1
+                    continue
+                index_key = index_key.ljust(KEY_WIDTH, b'\0')
+                if index_key not in chunk or hourly < chunk[index_key]:
+                    chunk[index_key] = hourly
+                if len(chunk) >= chunk_records:
+                    spills.append(_spill(chunk, spill_dir))
+                    chunk = {}
+        if chunk:
+            spills.append(_spill(chunk, spill_dir))
+
+        count = 0
+        partial_path = f"{output_path}.partial"
+        with open(partial_path, 'wb') as output:
+            output.write(HEADER.pack(MAGIC, KEY_WIDTH, 0))
+            readers = [_read_spill(path) for path in spills]
+            previous_key, previous_price = None, None
+            for index_key, hourly in heapq.merge(*readers):
+                if index_key == previous_key:
+                    previous_price = min(previous_price, hourly)
+                    continue
+                if previous_key is not None:
+                    output.write(previous_key + PRICE.pack(previous_price))
+                    count += 1
+                previous_key, previous_price = index_key, hourly
+            if previous_key is not None:
+                output.write(previous_key + PRICE.pack(previous_price))
+                count += 1
+            output.seek(0)
+            output.write(HEADER.pack(MAGIC, KEY_WIDTH, count))
+        os.replace(partial_path, output_path)
+    finally:
+        for path in spills:
+            os.remove(path)
+        os.rmdir(spill_dir)
+
+    if skipped:
+        logger.warning(f"Skipped {skipped} prices with keys longer than {KEY_WIDTH} bytes")
+    return count
+
+
+def iter_offer_prices(path):
+    # Yields (offer, region, key, hourly USD price) for the on-demand hourly
+    # prices in one offer file: every usage type, without its region prefix,
+    # and additionally EC2 instance types (Linux, shared tenancy) and RDS
+    # "<class>:<engine>:<deployment>" keys
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8', newline='') as offer_file:
+        reader = csv.reader(offer_file)
+        # Metadata lines come before the header row
+        for row in reader:
+            if row and row[0] == 'SKU':
+                columns = {name: position for position, name in enumerate(row)}
+                break
+        else:
+            return
+        if 'Region Code' not in columns:
+            logger.warning(f"{path} has no Region Code column, skipping it")
+            return
+
+        def value(row, name):
+            position = columns.get(name)
+            return row[position] if position is not None and position < len(row) else ''
+
+        for row in reader:
+            if value(row, 'TermType') != 'OnDemand' or value(row, 'Unit').lower() not in HOURLY_UNITS:
+                continue
+            if value(row, 'Currency') not in ('', 'USD'):
+                continue
+            try:
+                hourly = float(value(row, 'PricePerUnit'))
+            except ValueError:
+                continue
+            region = value(row, 'Region Code')
+            offer = value(row, 'serviceCode')
+            # Free tiers say nothing about what a resource costs
+            if hourly <= 0 or not region or not offer:
+                continue
+
+            usage_type = USAGE_TYPE_REGION_PREFIX.sub('', value(row, 'usageType'))
+            if usage_type:
+                yield offer, region, usage_type, hourly
+
+            product_family = value(row, 'Product Family')
+            if offer == 'AmazonEC2' and product_family == 'Compute Instance':
+                if (value(row, 'Operating System') == 'Linux' and value(row, 'Tenancy') == 'Shared'
+                        and value(row, 'Pre Installed S/W') in ('', 'NA') and value(row, 'CapacityStatus') in ('', 'Used')):
+                    yield offer, region, value(row, 'Instance Type'), hourly
+            elif offer == 'AmazonRDS' and product_family == 'Database Instance':
+                key = f"{value(row, 'Instance Type')}:{value(row, 'Database Engine')}:{value(row, 'Deployment Option')}"
+                yield offer, region, key, hourly
+
+
+def _index_key(offer, region, key):
+    return f"{offer}|{region}|{key}".encode('utf-8')
+
+
+def _spill(chunk, spill_dir):
+    handle, path = tempfile.mkstemp(dir=spill_dir)
+    with os.fdopen(handle, 'wb') as spill:
+        for index_key in sorted(chunk):
+            spill.write(index_key + PRICE.pack(chunk[index_key]))
+    return path
+
+
+def _read_spill(path):
+    record_size = KEY_WIDTH + PRICE.size
+    with open(path, 'rb', buffering=1024 * 1024) as spill:
+        while True:
+            record = spill.read(record_size)
+            if len(record) < record_size:
+                return
+            yield record[:KEY_WIDTH], PRICE.unpack(record[KEY_WIDTH:])[0]
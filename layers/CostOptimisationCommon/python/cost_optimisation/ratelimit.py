@@ -0,0 +1,162 @@
+import logging
+import os
+import threading
+import time
+from fnmatch import fnmatchcase
+
+from cost_optimisation.adaptive import THROTTLE_ERROR_CODES
+
+logger = logging.getLogger()
+
+# Calls per second per execution environment (see RateLimiter)
+DEFAULT_RATE_LIMITS = 'cloudwatch.GetMetricData=20,cloudwatch.GetMetricStatistics=100,logs.PutRetentionPolicy=5,*=50'
+
+
+class TokenBucket:
+    # Hands out one token per call at `rate` tokens per second, with bursts of
+    # up to `burst`. Callers that find it empty reserve the next token and sleep
+    # until it is due. The rate follows AIMD between `max_rate` / 16 and
+    # `max_rate`: halved whenever a call is throttled, +1 for every `rate`
+    # successful calls.
+
+    def __init__(self, max_rate, burst=None):
+        self.max_rate = float(max_rate)
+        self.min_rate = self.max_rate / 16
+        self.rate = self.max_rate
+        self.burst = float(burst if burst is not None else max(1.0, self.max_rate))
+        self.calls = 0
+        self.throttled = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        # Returns how long the caller waited
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            self.calls += 1
+            self.wait_seconds += wait
+            self.max_wait_seconds = max(self.max_wait_seconds, wait)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def feedback(self, throttled):
+        with self._lock:
+            if throttled:
+                self.throttled += 1
+                self.rate = max(self.min_rate, self.rate / 2)
+            else:
+                self.rate = min(self.max_rate, self.rate + 1 / self.rate)
+
+    def reset_counters(self):
+        with self._lock:
+            self.calls = 0
+            self.throttled = 0
+            self.wait_seconds = 0.0
+            self.max_wait_seconds = 0.0
+
+
+class RateLimiter:
+    # One TokenBucket per (service, operation, region), shared by every pooled
+    # client in the execution environment, so all threads calling the same API
+    # in the same region draw from the same budget. `spec` lists calls per
+    # second for "service.Operation" patterns, e.g.
+    # "cloudwatch.GetMetricData=20,ec2.Describe*=50,*=100"; the first match
+    # wins and operations matching none are not limited.
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.limits = []
+        for entry in spec.split(','):
+            if not entry.strip():
+                continue
+            pattern, _, rate = entry.partition('=')
+            try:
+                self.limits.append((pattern.strip(), float(rate)))
+            except ValueError:
+                logger.warning(f"Ignoring invalid rate limit {entry.strip()!r}")
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, service_name, operation_name, region_name):
+        # None when the operation is not limited
+        key = (service_name, operation_name, region_name)
+        bucket = self._buckets.get(key, False)
+        if bucket is not False:
+            return bucket
+        with self._lock:
+            if key not in self._buckets:
+                name = f"{service_name}.{operation_name}"
+                rate = next((rate for pattern, rate in self.limits if fnmatchcase(name, pattern)), None)
+                self._buckets[key] = TokenBucket(rate) if rate and rate > 0 else None
+            return self._buckets[key]
+
+    def summary(self):
+        with self._lock:
+            buckets = sorted(((key, bucket) for key, bucket in self._buckets.items() if bucket is not None and bucket.calls), key=lambda item: item[0])
+        return [
+            f"{service}.{operation} in {region}: {bucket.calls} calls, {bucket.throttled} throttled, "
+            f"waited {round(bucket.wait_seconds, 3)}s (max {round(bucket.max_wait_seconds, 3)}s), "
+            f"rate {round(bucket.rate, 1)}/{round(bucket.max_rate, 1)} per second"
+            for (service, operation, region), bucket in buckets
+        ]
+
+    def reset_counters(self):
+        with self._lock:
+            buckets = [bucket for bucket in self._buckets.values() if bucket is not None]
+        for bucket in buckets:
+            bucket.reset_counters()
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    # The process-wide limiter, configured from RATE_LIMITS
+    global _limiter
+    spec = os.environ.get('RATE_LIMITS', DEFAULT_RATE_LIMITS)
+    limiter = _limiter
+    if limiter is not None and limiter.spec == spec:
+        return limiter
+    with _limiter_lock:
+        if _limiter is None or _limiter.spec != spec:
+            _limiter = RateLimiter(spec)
+        return _limiter
+
+
+def attach_rate_limiter(client, service_name):
+    # Hooks the client's events: a token is taken before every attempt,
+    # retries included, and each attempt's outcome feeds back into the
+    # bucket's rate
+    region_name = client.meta.region_name
+
+    def before_send(event_name, **kwargs):
+        bucket = get_rate_limiter().bucket(service_name, event_name.rsplit('.', 1)[-1], region_name)
+        if bucket is not None:
+            bucket.acquire()
+
+    def needs_retry(operation, response=None, **kwargs):
+        bucket = get_rate_limiter().bucket(service_name, operation.name, region_name)
+        if bucket is not None and response is not None:
+            error_code = response[1].get('Error', {}).get('Code')
+            bucket.feedback(throttled=error_code in THROTTLE_ERROR_CODES)
+        # None leaves the retry decision to botocore
+
+    client.meta.events.register('before-send', before_send)
+    client.meta.events.register('needs-retry', needs_retry)
+
+
+def log_rate_limit_stats():
+    # Log and reset the counters, so each invocation reports its own waits
+    limiter = get_rate_limiter()
+    for line in limiter.summary():
+        logger.info(f"Rate limit: {line}")
+    limiter.reset_counters()
@@ -0,0 +1,169 @@
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+
+from botocore.exceptions import ClientError
+
+from cost_optimisation.clients import get_client
+from cost_optimisation.fanout import list_regions
+
+logger = logging.getLogger()
+
+DEFAULT_REGION_INDEX_TTL_HOURS = 24
+
+
+def _region_list(name):
+    return {region.strip() for region in os.environ.get(name, '').split(',') if region.strip()}
+
+
+class ActiveRegionIndex:
+    # Remembers, per check, how many resources each region held the last time it
+    # was scanned, in the table named by REGION_INDEX_TABLE_NAME. While the index
+    # is younger than REGION_INDEX_TTL_HOURS only regions with resources (or
+    # regions the index has never seen) are scanned; after that every region is
+    # scanned once to refresh it. When CONFIG_AGGREGATOR_NAME is set, an expired
+    # index is rebuilt from one aggregated AWS Config resource count instead.
+    # REGION_ALLOWLIST / REGION_DENYLIST (comma-separated) always apply.
+
+    def __init__(self, check_name, config_resource_type=None):
+        self.check_name = check_name
+        self.config_resource_type = config_resource_type
+        self.table_name = os.environ.get('REGION_INDEX_TABLE_NAME')
+        self.ttl = timedelta(hours=float(os.environ.get('REGION_INDEX_TTL_HOURS', DEFAULT_REGION_INDEX_TTL_HOURS)))
+        self.counts = {}
+        self.refreshed_at = None
+        self.full_refresh = True
+        self._observed = {}
+        # Counts taken from AWS Config, written on save() along with the observed ones
+        self._rebuilt_counts = {}
+        self._lock = threading.Lock()
+
+    def regions(self):
+        allowlist = _region_list('REGION_ALLOWLIST')
+        denylist = _region_list('REGION_DENYLIST')
+        all_regions = list_regions()
+        regions = [
+            region for region in all_regions
+            if (not allowlist or region in allowlist) and region not in denylist
+        ]
+
+        self._load()
+        if self.full_refresh and self._rebuild_from_config(all_regions):
+            self.full_refresh = False
+        if self.full_refresh:
+            logger.info(f"Region index for {self.check_name} is missing or expired, scanning all {len(regions)} regions")
+            return regions
+
+        active = [region for region in regions if self.counts.get(region, 1) > 0]
+        logger.info(f"Region index for {self.check_name}: scanning {len(active)} of {len(regions)} regions")
+        return active
+
+    def record(self, region, count):
+        with self._lock:
+            self._observed[region] = count
+
+    def save(self):
+        # Only the regions this invocation counted are written, each to its own
+        # map entry, so shard workers saving at the same time keep each other's
+        # counts. The refresh time only ever moves forward.
+        if not self.table_name:
+            return
+        with self._lock:
+            counts = dict(self._rebuilt_counts)
+            counts.update(self._observed)
+        if not counts:
+            # Nothing was scanned here, e.g. by a dispatcher that handed every
+            # region to shard workers, so there is nothing to count or refresh
+            return
+        refreshed = self.full_refresh or bool(self._rebuilt_counts)
+        key = {'CheckName': {'S': self.check_name}}
+        dynamodb_client = get_client('dynamodb')
+        try:
+            # Nested paths can only be set once the map exists
+            dynamodb_client.update_item(
+                TableName=self.table_name,
+                Key=key,
+                UpdateExpression='SET #regions = if_not_exists(#regions, :empty)',
+                ExpressionAttributeNames={'#regions': 'Regions'},
+                ExpressionAttributeValues={':empty': {'M': {}}}
+            )
+            regions = list(counts)
+            names = {f"#r{index}": region for index, region in enumerate(regions)}
+            names['#regions'] = 'Regions'
+            dynamodb_client.update_item(
+                TableName=self.table_name,
+                Key=key,
+                UpdateExpression='SET ' + ', '.join(f"#regions.#r{index} = :n{index}" for index in range(len(regions))),
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues={f":n{index}": {'N': str(counts[region])} for index, region in enumerate(regions)}
+            )
+        except ClientError as e:
+            logger.error(f"Error saving region index for {self.check_name}: {e}")
+            return
+
+        if not refreshed:
+            return
+        refreshed_at = (self.refreshed_at if self._rebuilt_counts else datetime.utcnow()).isoformat()
+        try:
+            dynamodb_client.update_item(
+                TableName=self.table_name,
+                Key=key,
+                UpdateExpression='SET RefreshedAt = :refreshed_at',
+                ConditionExpression='attribute_not_exists(RefreshedAt) OR RefreshedAt < :refreshed_at',
+                ExpressionAttributeValues={':refreshed_at': {'S': refreshed_at}}
+            )
+        except dynamodb_client.exceptions.ConditionalCheckFailedException:
+            # Another invocation refreshed the index more recently
+            pass
+        except ClientError as e:
+            logger.error(f"Error saving region index refresh time for {self.check_name}: {e}")
+
+    def _load(self):
+        if not self.table_name:
+            return
+        try:
+            item = get_client('dynamodb').get_item(
+                TableName=self.table_name,
+                Key={'CheckName': {'S': self.check_name}}
+            ).get('Item')
+        except ClientError as e:
+            logger.error(f"Error loading region index for {self.check_name}: {e}")
+            return
+        if not item:
+            return
+        self.counts = {region: int(value['N']) for region, value in item.get('Regions', {}).get('M', {}).items()}
+        if 'RefreshedAt' not in item:
+            # Counts saved by a sweep that has not finished a full refresh yet
+            return
+        self.refreshed_at = datetime.fromisoformat(item['RefreshedAt']['S'])
+        self.full_refresh = datetime.utcnow() - self.refreshed_at > self.ttl
+
+    def _rebuild_from_config(self, all_regions):
+        aggregator = os.environ.get('CONFIG_AGGREGATOR_NAME')
+        if not aggregator or not self.config_resource_type:
+            return False
+        try:
+            config_client = get_client('config')
+            counts = {}
+            request = {
+                'ConfigurationAggregatorName': aggregator,
+                'Filters': {'ResourceType': self.config_resource_type},
+                'GroupByKey': 'AWS_REGION'
+            }
+            while True:
+                response = config_client.get_aggregate_discovered_resource_counts(**request)
+                for group in response['GroupedResourceCounts']:
+                    counts[group['GroupName']] = group['ResourceCount']
+                if not response.get('NextToken'):
+                    break
+                request['NextToken'] = response['NextToken']
+        except ClientError as e:
+            logger.error(f"Error reading resource counts from aggregator {aggregator}: {e}")
+            return False
+
+        # Regions missing from the aggregate hold no resources of this type
+        self.counts = {region: counts.get(region, 0) for region in all_regions}
+        self._rebuilt_counts = dict(self.counts)
+        self.refreshed_at = datetime.utcnow()
+        return True
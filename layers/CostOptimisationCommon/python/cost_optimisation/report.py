@@ -0,0 +1,227 @@
+import heapq
+import io
+import json
+import logging
+import os
+import threading
+import zlib
+from datetime import datetime
+
+from botocore.exceptions import ClientError
+
+from cost_optimisation.clients import get_client
+from cost_optimisation.findings import FindingsIndex
+
+logger = logging.getLogger()
+
+# S3 parts must be at least 5 MiB, except the last one
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+DEFAULT_TOP_K = 10
+
+
+class ReportSink:
+    # Streams report records to a gzip-compressed JSON Lines object in S3 through
+    # a multipart upload. Compressed output is buffered only up to `part_size`
+    # before it is uploaded as a part, so the rendered report is never held in
+    # memory whole. Use as a context manager: the upload completes on a clean
+    # exit and is aborted on an error or when nothing was written.
+
+    def __init__(self, s3_client, bucket, key, part_size=DEFAULT_PART_SIZE):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.count = 0
+        self.bytes_written = 0
+        self._compressor = zlib.compressobj(wbits=31)  # gzip container
+        self._buffer = io.BytesIO()
+        self._parts = []
+        self._upload_id = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None and self.count:
+            try:
+                self.close()
+            except Exception:
+                # Parts of an upload that is neither completed nor aborted are billed indefinitely
+                self.abort()
+                raise
+        else:
+            self.abort()
+        return False
+
+    def write(self, record):
+        line = (json.dumps(record, default=str) + '\n').encode('utf-8')
+        with self._lock:
+            self._buffer.write(self._compressor.compress(line))
+            self.count += 1
+            if self._buffer.tell() >= self.part_size:
+                self._upload_part()
+
+    def close(self):
+        with self._lock:
+            self._buffer.write(self._compressor.flush())
+            self._upload_part()
+            self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self._upload_id,
+                MultipartUpload={'Parts': self._parts}
+            )
+
+    def abort(self):
+        if self._upload_id is None:
+            return
+        try:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+        except ClientError as e:
+            logger.error(f"Error aborting upload of s3://{self.bucket}/{self.key}: {e}")
+
+    def _upload_part(self):
+        if self._upload_id is None:
+            self._upload_id = self.s3_client.create_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                ContentType='application/gzip'
+            )['UploadId']
+        body = self._buffer.getvalue()
+        part_number = len(self._parts) + 1
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self._upload_id,
+            PartNumber=part_number,
+            Body=body
+        )
+        self._parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+        self.bytes_written += len(body)
+        self._buffer = io.BytesIO()
+
+
+def publish_report(sns_client, topic_arn, check_name, title, findings, regions=None):
+    # Findings are rendered here, once, and streamed out record by record; the
+    # findings themselves arrive as one list, since the delta and the cost
+    # ranking need all of them. Passing `regions` says the findings are
+    # everything wrong in those regions; with FINDINGS_INDEX_TABLE_NAME set the
+    # report is then cut down to the findings that are new, changed or resolved
+    # since the previous run, and nothing is sent if there are none.
+    # With REPORT_BUCKET set, the records are streamed to
+    # s3://REPORT_BUCKET/REPORT_PREFIX/<check>/<date>/<time>.jsonl.gz and SNS only
+    # carries a summary with the counts and the object key. Without it, the
+    # whole report goes out as one SNS message. Either way, findings with a
+    # monthly_cost metric are ranked and the REPORT_TOP_K most expensive are
+    # listed first.
+    index = None
+    delta = None
+    table_name = os.environ.get('FINDINGS_INDEX_TABLE_NAME')
+    if regions is not None and table_name:
+        index = FindingsIndex(check_name, table_name)
+        delta = index.compare(findings, regions)
+
+    if delta is not None:
+        logger.info(f"{check_name}: {len(delta.new)} new, {len(delta.changed)} changed, "
+                    f"{len(delta.resolved)} resolved and {delta.unchanged} unchanged findings")
+        if not delta:
+            return
+        records = _delta_records(check_name, delta)
+        summary = f"{len(delta.new)} new, {len(delta.changed)} changed and {len(delta.resolved)} resolved findings; {delta.unchanged} unchanged findings are not repeated."
+        reported = delta.new + [finding for finding, _ in delta.changed]
+    elif findings:
+        records = (_record(finding, 'open') for finding in findings)
+        summary = f"{len(findings)} findings."
+        reported = findings
+    else:
+        return
+
+    top = _top_by_cost(reported, int(os.environ.get('REPORT_TOP_K', DEFAULT_TOP_K)))
+    bucket = os.environ.get('REPORT_BUCKET')
+    if bucket:
+        _publish_to_s3(sns_client, topic_arn, check_name, title, summary, top, records, bucket)
+    else:
+        lines = [title] + top + (["All findings:"] if top else []) + _report_lines(records, delta is not None)
+        sns_client.publish(TopicArn=topic_arn, Message="\n".join(lines))
+
+    # Only once the report is out, so a failed send is reported again next run
+    if delta is not None:
+        index.update(delta)
+
+
+def _top_by_cost(findings, top_k):
+    # Lines naming the top_k findings with the highest monthly cost, picked with
+    # a heap rather than by sorting every finding
+    priced = [finding for finding in findings if 'monthly_cost' in finding.metrics]
+    if not priced or top_k <= 0:
+        return []
+    total = sum(finding.metrics['monthly_cost'] for finding in priced)
+    top = heapq.nlargest(top_k, priced, key=lambda finding: finding.metrics['monthly_cost'])
+    lines = [f"Estimated cost of {len(priced)} priced findings: ${total:,.2f} per month. Most expensive:"]
+    lines.extend(f"- {finding.message()}" for finding in top)
+    return lines
+
+
+def _publish_to_s3(sns_client, topic_arn, check_name, title, summary, top, records, bucket):
+    now = datetime.utcnow()
+    key = f"{os.environ.get('REPORT_PREFIX', 'reports')}/{check_name}/{now:%Y/%m/%d}/{now:%H%M%S}.jsonl.gz"
+    with ReportSink(get_client('s3'), bucket, key) as sink:
+        for record in records:
+            record['generated_at'] = now.isoformat()
+            sink.write(record)
+
+    logger.info(f"Report for {check_name} written to s3://{bucket}/{key}: {sink.count} records, {sink.bytes_written} bytes compressed")
+    sns_client.publish(
+        TopicArn=topic_arn,
+        Message="\n".join([title, f"{summary} Full report (gzip-compressed JSON Lines): s3://{bucket}/{key}"] + top)
+    )
+
+
+def _record(finding, status):
+    return {
+        'check': finding.check,
+        'status': status,
+        'fingerprint': finding.fingerprint,
+        'region': finding.region,
+        'resource_id': finding.resource_id,
+        'severity': finding.severity,
+        'metrics': finding.metrics,
+        'message': finding.message()
+    }
+
+
+def _delta_records(check_name, delta):
+    for finding in delta.new:
+        yield _record(finding, 'new')
+    for finding, entry in delta.changed:
+        record = _record(finding, 'changed')
+        record['previous'] = {'severity': entry['Severity'], 'metrics': entry['Metrics'], 'message': entry['Message']}
+        yield record
+    for entry in delta.resolved:
+        yield {
+            'check': check_name,
+            'status': 'resolved',
+            'fingerprint': entry['Fingerprint'],
+            'region': entry['Region'],
+            'resource_id': entry['ResourceId'],
+            'severity': entry['Severity'],
+            'metrics': entry['Metrics'],
+            'message': entry['Message']
+        }
+
+
+def _report_lines(records, sectioned):
+    if not sectioned:
+        return [record['message'] for record in records]
+    lines = []
+    status = None
+    for record in records:
+        if record['status'] != status:
+            status = record['status']
+            lines.append(f"{status.capitalize()}:")
+        if status == 'changed':
+            lines.append(f"{record['message']} (previously: {record['previous']['message']})")
+        else:
+            lines.append(record['message'])
+    return lines
@@ -0,0 +1,187 @@
+import logging
+import os
+import time
+from collections import defaultdict
+
+from botocore.exceptions import ClientError
+
+from cost_optimisation.clients import get_client
+from cost_optimisation.dynamodb import batch_write
+from cost_optimisation.metrics import MetricDataBatch
+from cost_optimisation.timestamps import epoch_seconds, utc_datetime
+
+logger = logging.getLogger()
+
+BUCKET_SECONDS = 86400
+BATCH_GET_SIZE = 100
+DEFAULT_SETTLE_MINUTES = 30
+
+
+class Aggregate:
+    # Sum, count and maximum of a series' datapoints over the rolling window,
+    # and the number of days that had any
+
+    __slots__ = ('total', 'count', 'maximum', 'days')
+
+    def __init__(self, total=0.0, count=0, maximum=None, days=0):
+        self.total = total
+        self.count = count
+        self.maximum = maximum
+        self.days = days
+
+    @property
+    def average(self):
+        # 0 without data, like the averaging helpers it replaces
+        return self.total / self.count if self.count else 0
+
+    def add(self, total, count, maximum):
+        # One day's bucket
+        self.total += total
+        self.count += count
+        if count:
+            self.days += 1
+        if maximum is not None and (self.maximum is None or maximum > self.maximum):
+            self.maximum = maximum
+
+
+class RollingAggregates:
+    # Per-series rolling aggregates over the last `window_days` complete UTC days,
+    # kept in the table named by ROLLING_AGGREGATE_TABLE_NAME as one (sum, count,
+    # max) bucket per day plus a watermark. Each run only fetches datapoints from
+    # the watermark up to the last day boundary that is at least
+    # ROLLING_SETTLE_MINUTES old, folds them into the buckets and drops buckets
+    # that have left the window. Without a table the whole window is fetched.
+    # Queries are added like MetricDataBatch queries, one statistic each, and
+    # fetch() returns an Aggregate per key.
+
+    def __init__(self, check_name, cw_client, window_days=14, now=None):
+        self.check_name = check_name
+        self.cw_client = cw_client
+        self.table_name = os.environ.get('ROLLING_AGGREGATE_TABLE_NAME')
+        settle_seconds = int(os.environ.get('ROLLING_SETTLE_MINUTES', DEFAULT_SETTLE_MINUTES)) * 60
+        now = int(now if now is not None else time.time())
+        self.window_days = window_days
+        self.end = (now - settle_seconds) // BUCKET_SECONDS * BUCKET_SECONDS
+        self.window_start = self.end - window_days * BUCKET_SECONDS
+        self._queries = []
+        # Keys whose new datapoints could not be fetched in the last fetch()
+        self.failed = set()
+
+    @property
+    def start_time(self):
+        return utc_datetime(self.window_start)
+
+    @property
+    def end_time(self):
+        # Datapoints from here on are not in the aggregates yet
+        return utc_datetime(self.end)
+
+    def add(self, key, namespace, metric_name, dimensions, period, statistic, unit=None):
+        # `period` must divide a day, so datapoints never straddle two buckets
+        series_key = '#'.join([
+            self.check_name,
+            self.cw_client.meta.region_name,
+            namespace,
+            metric_name,
+            ','.join(f"{dimension['Name']}={dimension['Value']}" for dimension in sorted(dimensions, key=lambda d: d['Name'])),
+            str(period),
+            statistic,
+            unit or ''
+        ])
+        self._queries.append((key, series_key, (namespace, metric_name, dimensions, period, statistic, unit)))
+
+    def fetch(self):
+        states = self._load([series_key for _, series_key, _ in self._queries])
+
+        # Series sharing a watermark are fetched together
+        by_since = defaultdict(list)
+        for query in self._queries:
+            watermark, _ = states.get(query[1], (None, {}))
+            since = max(watermark or self.window_start, self.window_start)
+            if since < self.end:
+                by_since[since].append(query)
+
+        updated = {}
+        self.failed = set()
+        for since, queries in by_since.items():
+            batch = MetricDataBatch(self.cw_client, utc_datetime(since), utc_datetime(self.end))
+            for _, series_key, (namespace, metric_name, dimensions, period, statistic, unit) in queries:
+                batch.add(series_key, namespace, metric_name, dimensions, period, statistic, unit)
+            datapoints = batch.fetch()
+
+            for key, series_key, (_, _, _, _, statistic, _) in queries:
+                if series_key in batch.failed:
+                    # Keep the watermark, so the next run retries this stretch
+                    self.failed.add(key)
+                    continue
+                _, buckets = states.get(series_key, (None, {}))
+                for datapoint in datapoints[series_key]:
+                    day = epoch_seconds(datapoint['Timestamp']) // BUCKET_SECONDS * BUCKET_SECONDS
+                    value = datapoint[statistic]
+                    total, count, maximum = buckets.get(day, (0.0, 0, None))
+                    buckets[day] = (total + value, count + 1, value if maximum is None else max(maximum, value))
+                states[series_key] = (self.end, buckets)
+                updated[series_key] = states[series_key]
+
+        results = {}
+        for key, series_key, _ in self._queries:
+            aggregate = Aggregate()
+            _, buckets = states.get(series_key, (None, {}))
+            for day, bucket in buckets.items():
+                if self.window_start <= day < self.end:
+                    aggregate.add(*bucket)
+            results[key] = aggregate
+
+        self._save(updated)
+        return results
+
+    def _load(self, series_keys):
+        # {series_key: (watermark, {day: (total, count, maximum)})}
+        states = {}
+        if not self.table_name:
+            return states
+        dynamodb_client = get_client('dynamodb')
+        series_keys = list(dict.fromkeys(series_keys))
+        for offset in range(0, len(series_keys), BATCH_GET_SIZE):
+            request = {self.table_name: {'Keys': [{'SeriesKey': {'S': key}} for key in series_keys[offset:offset + BATCH_GET_SIZE]]}}
+            try:
+                while request:
+                    response = dynamodb_client.batch_get_item(RequestItems=request)
+                    for item in response['Responses'].get(self.table_name, []):
+                        states[item['SeriesKey']['S']] = (
+                            int(item['Watermark']['N']),
+                            {
+                                int(day): (float(bucket['L'][0]['N']), int(bucket['L'][1]['N']), float(bucket['L'][2]['N']) if 'N' in bucket['L'][2] else None)
+                                for day, bucket in item['Buckets']['M'].items()
+                            }
+                        )
+                    request = response.get('UnprocessedKeys')
+            except ClientError as e:
+                logger.error(f"Error loading rolling aggregates for {self.check_name}: {e}")
+        return states
+
+    def _save(self, states):
+        if not self.table_name or not states:
+            return
+        write_requests = []
+        for series_key, (watermark, buckets) in states.items():
+            # Expired buckets are dropped on every write
+            buckets = {day: bucket for day, bucket in buckets.items() if day >= self.window_start}
+            item = {
+                'SeriesKey': {'S': series_key},
+                'Watermark': {'N': str(watermark)},
+                'Buckets': {'M': {
+                    str(day): {'L': [
+                        {'N': repr(float(total))},
+                        {'N': str(count)},
+                        {'N': repr(float(maximum))} if maximum is not None else {'NULL': True}
+                    ]}
+                    for day, (total, count, maximum) in buckets.items()
+                }},
+                # Series nobody updates any more age out with their window
+                'ExpiresAt': {'N': str(watermark + (self.end - self.window_start))}
+            }
+            write_requests.append({'PutRequest': {'Item': item}})
+        failed = batch_write(get_client('dynamodb'), self.table_name, write_requests)
+        if failed:
+            logger.warning(f"Could not save {len(failed)} rolling aggregates for {self.check_name}")
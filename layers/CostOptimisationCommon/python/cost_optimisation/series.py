@@ -0,0 +1,58 @@
+import warnings
+
+import numpy as np
+
+from cost_optimisation.timestamps import epoch_seconds
+
+# NumPy helpers for evaluating many metric series at once. Only functions that
+# ship numpy in their requirements.txt import this module.
+
+
+def to_matrix(series, statistics, start_time, period, length):
+    # Lay out datapoint lists (get_metric_statistics shape) on a common time grid.
+    # Row i holds series[i][*][statistics[i]]; slots without data are NaN.
+    matrix = np.full((len(series), length), np.nan)
+    start = epoch_seconds(start_time)
+    for row, (datapoints, statistic) in enumerate(zip(series, statistics)):
+        for datapoint in datapoints:
+            column = int((epoch_seconds(datapoint['Timestamp']) - start) // period)
+            if 0 <= column < length:
+                matrix[row, column] = datapoint[statistic]
+    return matrix
+
+
+def n_of_m_breaches(values, thresholds, below, datapoints_to_alarm, evaluation_periods):
+    # For every row, True when any run of `evaluation_periods` consecutive slots
+    # holds at least `datapoints_to_alarm` breaching datapoints. Missing (NaN)
+    # datapoints never breach, matching CloudWatch's default missing-data handling.
+    rows, length = values.shape
+    if rows == 0 or length == 0:
+        return np.zeros(rows, dtype=bool)
+
+    thresholds = np.asarray(thresholds, dtype=float)[:, None]
+    below = np.asarray(below, dtype=bool)[:, None]
+    with np.errstate(invalid='ignore'):
+        breaching = np.where(below, values < thresholds, values > thresholds)
+
+    window = min(evaluation_periods, length)
+    counts = np.zeros((rows, length + 1), dtype=np.int32)
+    np.cumsum(breaching, axis=1, out=counts[:, 1:])
+    window_counts = counts[:, window:] - counts[:, :-window]
+    return (window_counts >= datapoints_to_alarm).any(axis=1)
+
+
+def summarize(values, percentiles):
+    # Per-row percentiles and maximum of the datapoints, ignoring missing (NaN)
+    # slots, as {'p<N>': array, 'max': array}. Rows without data come out NaN.
+    rows = values.shape[0]
+    if rows == 0 or values.shape[1] == 0:
+        empty = np.full(rows, np.nan)
+        return dict({f"p{percentile:g}": empty for percentile in percentiles}, max=empty)
+
+    with warnings.catch_warnings():
+        # All-NaN rows are expected for instances that reported nothing
+        warnings.simplefilter('ignore', RuntimeWarning)
+        quantiles = np.nanpercentile(values, percentiles, axis=1) if percentiles else []
+        summary = {f"p{percentile:g}": quantiles[index] for index, percentile in enumerate(percentiles)}
+        summary['max'] = np.nanmax(values, axis=1)
+    return summary
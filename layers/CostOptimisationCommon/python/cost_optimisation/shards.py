@@ -0,0 +1,210 @@
+import logging
+import os
+import time
+import uuid
+from datetime import datetime
+from functools import partial
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+from cost_optimisation.checkpoint import SweepCheckpoint
+from cost_optimisation.clients import get_client
+from cost_optimisation.findings import pack_findings, unpack_findings
+from cost_optimisation.invocation import invoke_async
+
+logger = logging.getLogger()
+
+BATCH_GET_SIZE = 100
+DEFAULT_RUN_TTL_HOURS = 48
+
+
+def run_sweep(check_name, event, context, regions, worker, with_checkpoint=False):
+    # Entry point for a handler's region sweep. Returns the findings to report
+    # when this invocation should send the consolidated report, or None when
+    # the work carries on in other invocations. Three modes:
+    # - dispatcher: with SHARD_COUNT > 1 (and SHARD_TABLE_NAME set), a plain
+    #   invocation splits `regions` into shards and invokes one worker per shard
+    # - worker: an event carrying {'shard': {'regions': [...]}} sweeps only those
+    #   regions; if the shard belongs to a dispatched run, it stores its findings
+    #   and the last worker to finish aggregates them all
+    # - single: otherwise every region is swept here
+    # Each mode checkpoints before the deadline (see SweepCheckpoint); with
+    # `with_checkpoint` the worker is also passed the checkpoint as `checkpoint`,
+    # for workers that can pause part-way through a region. Regions that failed
+    # or were left unfinished (see SweepCheckpoint.unswept) and the regions of
+    # shards that failed or gave up are listed in event['unswept_regions'] for
+    # swept_regions(); whatever findings they have are still returned.
+    event = event if isinstance(event, dict) else {}
+    shard = event.get('shard')
+    if shard:
+        return _run_worker(check_name, event, context, shard, worker, with_checkpoint)
+
+    shard_count = min(int(os.environ.get('SHARD_COUNT', 1)), len(regions))
+    if shard_count > 1 and os.environ.get('SHARD_TABLE_NAME') and context is not None and 'checkpoint' not in event:
+        failed_shards = _dispatch(check_name, context, regions, shard_count)
+        if failed_shards is not None:
+            # Shards that could not be invoked run here, as their worker would
+            findings = None
+            for failed_shard in failed_shards:
+                shard_event = {'shard': failed_shard}
+                findings = _run_worker(check_name, shard_event, context, failed_shard, worker, with_checkpoint)
+                if 'unswept_regions' in shard_event:
+                    event['unswept_regions'] = shard_event['unswept_regions']
+            return findings
+        logger.warning(f"Dispatching {check_name} failed, sweeping every region in this invocation")
+
+    return _sweep(SweepCheckpoint(check_name, context, event), regions, worker, with_checkpoint)
+
+
+def split_regions(regions, shard_count):
+    # Contiguous, near-equal slices, so concatenating the shards' findings keeps
+    # the usual region order
+    return [regions[len(regions) * index // shard_count:len(regions) * (index + 1) // shard_count] for index in range(shard_count)]
+
+
+def swept_regions(event, regions):
+    # The regions the findings run_sweep() returned fully cover: all of
+    # `regions` (or of a standalone shard's own), except those that failed or
+    # whose shard did
+    event = event if isinstance(event, dict) else {}
+    shard = event.get('shard')
+    if shard and not shard.get('run_id'):
+        regions = shard['regions']
+    unswept = set(event.get('unswept_regions', ()))
+    return [region for region in regions if region not in unswept]
+
+
+def _sweep(checkpoint, regions, worker, with_checkpoint):
+    if with_checkpoint:
+        worker = partial(worker, checkpoint=checkpoint)
+    findings = checkpoint.sweep(regions, worker)
+    unswept = checkpoint.unswept
+    if findings is not None and unswept:
+        logger.warning(f"{checkpoint.check_name} finished with incomplete findings for {len(unswept)} regions: {', '.join(unswept)}")
+        checkpoint.event['unswept_regions'] = unswept
+    return findings
+
+
+def _dispatch(check_name, context, regions, shard_count):
+    # Returns the shards that could not be invoked, or None if the run could
+    # not be recorded
+    run_id = f"{check_name}#{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}#{uuid.uuid4().hex[:8]}"
+    try:
+        get_client('dynamodb').put_item(
+            TableName=os.environ['SHARD_TABLE_NAME'],
+            Item={
+                'RunKey': {'S': run_id},
+                'CheckName': {'S': check_name},
+                'ShardCount': {'N': str(shard_count)},
+                'Remaining': {'N': str(shard_count)},
+                'StartedAt': {'S': datetime.utcnow().isoformat()},
+                'ExpiresAt': {'N': _expires_at()}
+            }
+        )
+    except ClientError as e:
+        logger.error(f"Error recording shard run {run_id}: {e}")
+        return None
+
+    failed_shards = []
+    for index, shard_regions in enumerate(split_regions(regions, shard_count)):
+        shard = {'run_id': run_id, 'index': index, 'regions': shard_regions}
+        try:
+            invoke_async(context, {'shard': shard})
+        except (BotoCoreError, ClientError) as e:
+            logger.error(f"Error invoking shard {index} of {run_id}, sweeping it in the dispatcher: {e}")
+            failed_shards.append(shard)
+    logger.info(f"Dispatched {check_name} run {run_id} as {shard_count} shards over {len(regions)} regions")
+    return failed_shards
+
+
+def _run_worker(check_name, event, context, shard, worker, with_checkpoint):
+    run_id = shard.get('run_id')
+    checkpoint_name = f"{run_id}#{shard['index']}" if run_id else f"{check_name}#{','.join(shard['regions'])}"
+    if not run_id:
+        # A standalone shard reports on its own
+        return _sweep(SweepCheckpoint(checkpoint_name, context, event), shard['regions'], worker, with_checkpoint)
+
+    # A shard that fails or gives up still counts down the run, so the last
+    # worker sends the report; its failed and unfinished regions are marked
+    # unswept in it
+    checkpoint = SweepCheckpoint(checkpoint_name, context, event)
+    try:
+        findings = _sweep(checkpoint, shard['regions'], worker, with_checkpoint)
+    except Exception as e:
+        logger.error(f"Shard {shard['index']} of {run_id} failed: {e}")
+        findings, unswept = [], list(shard['regions'])
+    else:
+        if findings is None:
+            if checkpoint.resumed:
+                return None
+            logger.warning(f"Shard {shard['index']} of {run_id} gave up, reporting only its finished regions")
+            findings = [finding for region in checkpoint.regions if region in checkpoint.done for finding in checkpoint.findings.get(region, [])]
+        unswept = checkpoint.unswept
+
+    table_name = os.environ['SHARD_TABLE_NAME']
+    dynamodb_client = get_client('dynamodb')
+    item = {
+        'RunKey': {'S': checkpoint_name},
+        'Findings': {'B': pack_findings(findings)},
+        'ExpiresAt': {'N': _expires_at()}
+    }
+    if unswept:
+        item['Unswept'] = {'L': [{'S': region} for region in unswept]}
+    try:
+        # Conditional, so a redelivered invocation cannot count its shard twice
+        dynamodb_client.put_item(
+            TableName=table_name,
+            Item=item,
+            ConditionExpression='attribute_not_exists(RunKey)'
+        )
+    except dynamodb_client.exceptions.ConditionalCheckFailedException:
+        logger.warning(f"Shard {shard['index']} of {run_id} was already reported")
+        return None
+    # The decrement is atomic, so exactly one worker sees the run reach zero
+    remaining = dynamodb_client.update_item(
+        TableName=table_name,
+        Key={'RunKey': {'S': run_id}},
+        UpdateExpression='ADD Remaining :minus_one',
+        ExpressionAttributeValues={':minus_one': {'N': '-1'}},
+        ReturnValues='ALL_NEW'
+    )['Attributes']
+    if int(remaining['Remaining']['N']) > 0:
+        logger.info(f"Shard {shard['index']} of {run_id} done, {remaining['Remaining']['N']} still running")
+        return None
+
+    logger.info(f"Last shard of {run_id} done, aggregating findings")
+    findings, unswept = _aggregate(dynamodb_client, table_name, run_id, int(remaining['ShardCount']['N']))
+    if unswept:
+        logger.warning(f"{run_id} is reported with incomplete findings for {len(unswept)} regions its shards did not finish: {', '.join(unswept)}")
+        event['unswept_regions'] = unswept
+    return findings
+
+
+def _aggregate(dynamodb_client, table_name, run_id, shard_count):
+    keys = [run_id] + [f"{run_id}#{index}" for index in range(shard_count)]
+    shard_findings = {}
+    unswept = []
+    for offset in range(0, len(keys), BATCH_GET_SIZE):
+        request = {table_name: {'Keys': [{'RunKey': {'S': key}} for key in keys[offset:offset + BATCH_GET_SIZE]], 'ConsistentRead': True}}
+        while request:
+            response = dynamodb_client.batch_get_item(RequestItems=request)
+            for item in response['Responses'].get(table_name, []):
+                if 'Findings' in item:
+                    shard_findings[item['RunKey']['S']] = unpack_findings(item['Findings']['B'])
+                unswept.extend(region['S'] for region in item.get('Unswept', {}).get('L', []))
+            request = response.get('UnprocessedKeys')
+
+    # Shards keep the order they were dispatched in; the run's items are done with
+    findings = [finding for key in keys[1:] for finding in shard_findings.get(key, [])]
+    for key in keys:
+        try:
+            dynamodb_client.delete_item(TableName=table_name, Key={'RunKey': {'S': key}})
+        except ClientError as e:
+            logger.error(f"Error deleting shard item {key}: {e}")
+    return findings, unswept
+
+
+def _expires_at():
+    # Items of runs that never finish age out through the table's TTL
+    ttl_seconds = float(os.environ.get('SHARD_RUN_TTL_HOURS', DEFAULT_RUN_TTL_HOURS)) * 3600
+    return str(int(time.time() + ttl_seconds))
@@ -0,0 +1,13 @@
+from datetime import datetime, timezone
+
+
+def epoch_seconds(timestamp):
+    # Whole seconds since the epoch; naive datetimes are taken as UTC, as
+    # boto3 and datetime.utcnow() produce them
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return int(timestamp.timestamp())
+
+
+def utc_datetime(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc)
@@ -0,0 +1,34 @@
+import argparse
+import logging
+import os
+import sys
+
+# Builds the index of DB instance class vCPUs and memory that the RDS checks
+# scale their thresholds by, from CSV files with "Instance Type", "vCPU" and
+# "Memory" columns, e.g. the AmazonRDS offer file also used for the price index:
+#   curl -o rds.csv https://pricing.us-east-1.amazonaws.com/offers/v1.0/aws/AmazonRDS/current/index.csv
+#   python tools/build_capacity_index.py rds.csv
+# By default the index is written into the layer, so it ships with the functions.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'layers', 'CostOptimisationCommon', 'python'))
+
+from cost_optimisation.capacity import DEFAULT_INDEX_PATH, build_capacity_index  # noqa: E402
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build the DB instance class capacity index from spec files')
+    parser.add_argument('specs', nargs='+', help='CSV files with Instance Type, vCPU and Memory columns')
+    parser.add_argument('--output', default=DEFAULT_INDEX_PATH, help='index file to write')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    count = build_capacity_index(args.specs, args.output)
+    print(f"Wrote {count} instance classes to {args.output}")
+    if not count:
+        # Fail the build rather than ship an index without any classes
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+import argparse
+import logging
+import os
+import sys
+import time
+
+# Builds the price index the checks use to put a monthly cost on findings, from
+# AWS bulk pricing offer files (CSV, optionally .gz), e.g.
+#   curl -o ec2.csv https://pricing.us-east-1.amazonaws.com/offers/v1.0/aws/AmazonEC2/current/index.csv
+#   python tools/build_price_index.py ec2.csv rds.csv ecs.csv vpc.csv
+# The files are streamed, so multi-GB offers need little memory. By default the
+# index is written into the layer, so it ships with the functions.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'layers', 'CostOptimisationCommon', 'python'))
+
+from cost_optimisation.pricing import DEFAULT_INDEX_PATH, build_price_index  # noqa: E402
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build the offline price index from AWS bulk pricing offer files')
+    parser.add_argument('offers', nargs='+', help='offer files (index.csv from the AWS Price List bulk API)')
+    parser.add_argument('--output', default=DEFAULT_INDEX_PATH, help='index file to write')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    started = time.perf_counter()
+    count = build_price_index(args.offers, args.output)
+    print(f"Wrote {count} prices to {args.output} ({os.path.getsize(args.output)} bytes) in {round(time.perf_counter() - started, 1)}s")
+    if not count:
+        # Fail the build rather than ship an index without any prices
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()